@@ -0,0 +1,621 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Self
+import asyncio
+import socket
+import threading
+import struct
+import time
+import utils
+from journal import Journal
+from metrics import Metrics
+
+BROADCAST_POLL_INTERVAL = 0.005 # s between checks whether a queued broadcast was written
+
+
+async def receive_data(reader: asyncio.StreamReader, size):
+    """Receive a fixed amount of data from a stream."""
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Socket connection lost")
+
+
+async def receive_client_hello(reader: asyncio.StreamReader):
+    """Read a legacy or extended ClientHello, like utils.receive_client_hello."""
+    hello_type = await receive_data(reader, utils.HELLO_TYPE_SIZE)
+    if hello_type == utils.CLIENT_HELLO_V2:
+        body_size = struct.unpack("!H", await receive_data(reader, 2))[0]
+    else:
+        body_size = 12 # A, p, g
+    return hello_type, await receive_data(reader, body_size)
+
+
+async def read_frame_size(reader: asyncio.StreamReader, max_frame_size=None):
+    """Wait for the next frame and return the ciphertext size from its header,
+    raising FrameTooLargeError above `max_frame_size` before the frame is read."""
+    message_size = struct.unpack("!I", await receive_data(reader, 4))[0]
+    utils.check_frame_size(message_size, max_frame_size)
+    return message_size
+
+
+async def read_sequence_number(reader: asyncio.StreamReader):
+    """Read the sequence number following the size of a sequenced frame."""
+    return struct.unpack("!I", await receive_data(reader, 4))[0]
+
+
+async def read_frame(reader: asyncio.StreamReader, iv_size=utils.AES_BLOCK_SIZE,
+                     mac_size=utils.MAC_SIZE, message_size=None):
+    """Return (iv, ciphertext, mac) of the next frame, like utils.FrameReader.
+
+    The parts are memoryviews of one bytes object read for the frame, which
+    is never reused, so they stay valid. With `message_size` the header was
+    already read by read_frame_size.
+    """
+    if message_size is None:
+        message_size = await read_frame_size(reader)
+    frame = await receive_data(reader, iv_size + message_size + mac_size)
+    view = memoryview(frame)
+    return (view[:iv_size],
+            view[iv_size:iv_size + message_size],
+            view[iv_size + message_size:])
+
+
+class AsyncConnection:
+    """Counterpart of server.Connection running as a task on the event loop."""
+
+    def __init__(self, client_id, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 addr, remove_callback: Callable[[Self], None],
+                 log: utils.Logger, handshake_context: utils.HandshakeContext = None,
+                 metrics: Metrics = None, upload_dir=utils.DEFAULT_UPLOAD_DIR,
+                 limits: utils.ConnectionLimits = None,
+                 deadline_callback: Callable[[Self, str], None] = None,
+                 admission: utils.HandshakeAdmission = None, journal: Journal = None):
+        self.client_id = client_id
+        self.reader = reader
+        self.writer = writer
+        self.deadline_callback = deadline_callback or (lambda connection, reason: None)
+        self.admission = admission # admitted this connection's handshake, released after it
+        self.limits = limits or utils.ConnectionLimits()
+        self.budget = self.limits.budget()
+        # drain() waits, and so does reading the client, while more replies than this are unsent
+        writer.transport.set_write_buffer_limits(high=self.limits.max_pending_output)
+        self.addr = addr
+        self.remove_callback = remove_callback
+        self.log = log.child(f"Client {client_id}: ")
+        self.p = None
+        self.g = None
+        self.stop_event = asyncio.Event()
+        self.handshake_context = handshake_context
+        self.metrics = metrics or Metrics()
+        self.frames_in = self.frames_out = self.bytes_in = self.bytes_out = 0
+        self.acks: utils.Acknowledgements | None = None
+        self.ack_timer: asyncio.TimerHandle | None = None
+        self.record_size = None
+        self.frame_writer: utils.FrameWriter | None = None
+        # chunks are written from the loop: one 64 KiB write is shorter than decrypting it
+        self.channels = utils.Channels(upload_dir, self.log)
+        self.journal = journal
+        self.durable: Future | None = None # commit of the last messages journaled
+        self.task: asyncio.Task | None = None
+
+    async def run(self):
+        """Handle the client logic."""
+        try:
+            try:
+                self.deadline_callback(self, "handshake")
+                self.cipher = await self.perform_key_exchange()
+            except Exception:
+                self.metrics.shard().add("handshake_errors")
+                raise
+            finally:
+                if self.admission:
+                    self.admission.release()
+            await self.handle_client_message()
+        except Exception as e:
+            self.log.error("Caught error with client {}: {}", self.client_id, e)
+        finally:
+            self.channels.close()
+            self.writer.close()
+            self.remove_callback(self)
+
+    def stop(self, if_remove_from_connections=True):
+        """Close the connection and clean up."""
+        if self.ack_timer:
+            self.ack_timer.cancel()
+        self.writer.close()
+        self.log.info("Connection with {} closed.", self.addr)
+        if if_remove_from_connections:
+            self.remove_callback(self)
+        self.stop_event.set()
+
+    @property
+    def channel_summary(self):
+        """(id, messages, bytes) of the open channels, for `ls`."""
+        return self.channels.summary()
+
+    def expire(self, reason):
+        """Called by the reaper when the client took longer than the `reason` timeout."""
+        self.metrics.shard().add("connections_reaped")
+        self.log.info("{} exceeded the {} timeout, closing", self.addr, reason)
+        if self.frame_writer:
+            self.write_messages([utils.ServerMessages.END_SESSION])
+        self.stop()
+        if self.writer.transport.get_write_buffer_size():
+            self.writer.transport.abort() # close() would wait for a client that does not read
+
+    async def perform_key_exchange(self):
+        self.log.info("Waiting for ClientHello")
+        hello_type, body = await receive_client_hello(self.reader)
+        start = time.perf_counter()
+        handshake = utils.ServerHandshake(hello_type, body, self.handshake_context)
+        self.p, self.g = handshake.p, handshake.g
+
+        self.log.verbose("Received ClientHello with msg={}", hello_type.decode())
+        self.log.verbose("Received ClientHello with A={!h} {}", handshake.client_public_key,
+                         handshake.describe_group())
+
+        if handshake.resumed:
+            handshake.compute_keys()
+        else:
+            # in the handshake process pool, or the loop's default thread pool
+            key_exchange_result = await asyncio.get_running_loop().run_in_executor(
+                handshake.executor, handshake.key_exchange_job())
+            handshake.compute_keys(key_exchange_result)
+
+        if handshake.resumed:
+            self.log.verbose("Resuming session from ticket - key exchange skipped")
+            self.log.verbose("Sending ServerHello cipher suite={}", handshake.cipher_suite.name)
+        else:
+            self.log.verbose("Sending ServerHello with B={!h} cipher suite={}",
+                             handshake.public_key, handshake.cipher_suite.name)
+            self.log.verbose("Shared key K computed: {!h}.", handshake.shared_key)
+        self.log.verbose("Symmetric key derived: {!h}.", handshake.symmetric_key)
+        self.writer.write(handshake.server_hello())
+        await self.writer.drain()
+        if handshake.acknowledgements:
+            self.acks = utils.Acknowledgements(*handshake.acknowledgements)
+            self.log.verbose("Acknowledging every {} frames or after {} ms",
+                             *handshake.acknowledgements)
+        self.record_size = handshake.record_size
+        if handshake.channels:
+            self.channels.limit = handshake.channels
+            self.log.verbose("Multiplexing up to {} channels", handshake.channels)
+        self.channels.transfers = handshake.transfers
+        # the transport may keep a frame it could not send at once, so no buffer reuse
+        self.frame_writer = utils.FrameWriter(handshake.cipher, reuse=False)
+
+        stats = self.metrics.shard()
+        stats.observe("handshake", time.perf_counter() - start)
+        stats.add("handshakes")
+        if handshake.resumed:
+            stats.add("handshakes_resumed")
+        return handshake.cipher
+
+    async def handle_client_message(self):
+        self.log.info("Connection was established - waiting for messages from the client.")
+        stats = self.metrics.shard()
+        frame_overhead = 4 + self.cipher.iv_size + self.cipher.mac_size
+        if self.acks:
+            frame_overhead += 4 # sequence number
+        aad = b""
+        while not self.stop_event.is_set():
+            self.deadline_callback(self, "idle")
+            try:
+                # idle wait, not timed
+                message_size = await read_frame_size(self.reader, self.limits.max_frame_size)
+            except utils.FrameTooLargeError as e:
+                stats.add("frames_refused")
+                self.log.error("Refused frame: {}", e)
+                await self.send_message(utils.ServerMessages.FAIL)
+                self.stop()
+                return
+            self.deadline_callback(self, "frame")
+            started = time.perf_counter()
+            if self.acks:
+                sequence = await read_sequence_number(self.reader)
+                aad = utils.sequence_aad(sequence)
+            iv, ciphertext, mac = await read_frame(self.reader, self.cipher.iv_size,
+                                                   self.cipher.mac_size, message_size)
+            read = time.perf_counter()
+            stats.observe("recv", read - started)
+            stats.add("frames_in")
+            stats.add("bytes_in", frame_overhead + message_size)
+            self.frames_in += 1
+            self.bytes_in += frame_overhead + message_size
+
+            try:
+                self.cipher.verify(iv, ciphertext, mac, aad)
+                verified = time.perf_counter()
+                stats.observe("verify", verified - read)
+                plaintext = self.cipher.decrypt_verified_bytes(iv, ciphertext, mac, aad)
+                if self.record_size:
+                    messages = utils.unpack_record(plaintext)
+                else:
+                    messages = [plaintext]
+                stats.observe("decrypt", time.perf_counter() - verified)
+                if self.acks:
+                    self.acks.receive(sequence, len(messages))
+            except (utils.AuthenticationError, utils.SequenceError) as e:
+                stats.add("mac_failures")
+                self.log.error("Authentication failed: {}", e)
+                self.log.error("MAC received: {!h}", bytes(mac))
+
+                await self.send_message(utils.ServerMessages.FAIL)
+                self.stop()
+
+                return
+            except ValueError as e: # authentic, but its padding or records are malformed
+                stats.add("record_errors")
+                self.log.error("Malformed record: {}", e)
+                await self.send_message(utils.ServerMessages.FAIL)
+                self.stop()
+                return
+
+            try:
+                texts, replies, ended = self.channels.receive(messages, confirm=not self.acks)
+            except (utils.TransferError, OSError, ValueError) as e:
+                self.log.error("Rejected file transfer: {}", e)
+                await self.send_message(utils.ServerMessages.FAIL)
+                self.stop()
+                return
+
+            for channel, decrypted_message in texts:
+                if self.channels.multiplexed:
+                    self.log.info("Received text on channel {}: {!t}", channel, decrypted_message)
+                else:
+                    self.log.info("Received text: {!t}", decrypted_message)
+            if self.journal:
+                records = [(channel, text) for channel, text in texts
+                           if text not in utils.CONTROL_MESSAGES]
+                if records:
+                    self.durable = self.journal.append(self.client_id, records)
+            self.log.verbose("Received message size: {}", message_size)
+            self.log.verbose("Received IV: {!h}", iv)
+            self.log.verbose("Received ciphertext: {!h}", ciphertext)
+            self.log.verbose("Received MAC: {!h}", mac)
+
+            if ended:
+                self.stop()
+                return
+
+            if self.acks and self.acks.due():
+                replies.append(self.acknowledge())
+            elif self.acks and self.ack_timer is None:
+                self.ack_timer = asyncio.get_running_loop().call_later(
+                    self.acks.deadline() - time.monotonic(), self.acknowledge_late)
+            if replies:
+                await self.wait_until_durable()
+                await self.send_messages(replies)
+
+            if self.budget:
+                delay = self.budget.charge(1, frame_overhead + message_size)
+                if delay:
+                    stats.add("throttled")
+                    await asyncio.sleep(delay) # the client's frames wait in the socket buffer
+
+    def acknowledge(self):
+        if self.ack_timer:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        return self.acks.acknowledge()
+
+    def acknowledge_late(self):
+        """Timer callback: no new frame filled the window before the ACK delay ran out."""
+        self.ack_timer = None
+        if self.durable:
+            asyncio.create_task(self.acknowledge_when_durable())
+        elif self.acks.pending and not self.stop_event.is_set():
+            self.write_messages([self.acknowledge()])
+
+    async def acknowledge_when_durable(self):
+        # frames read meanwhile are in a later commit, which the ACK must wait for too
+        try:
+            while self.durable:
+                await self.wait_until_durable()
+        except OSError as e:
+            self.log.error("Journal commit failed: {}", e)
+            self.stop()
+            return
+        if self.acks.pending and not self.stop_event.is_set():
+            self.write_messages([self.acknowledge()])
+
+    async def wait_until_durable(self):
+        """Wait until the journal committed what the client is about to get OK or ACK for."""
+        durable = self.durable
+        if durable:
+            await asyncio.wrap_future(durable)
+            if self.durable is durable:
+                self.durable = None
+
+    async def send_message(self, message):
+        await self.send_messages([message])
+
+    async def send_messages(self, messages):
+        try:
+            self.write_messages(messages)
+            await self.writer.drain()
+        except ConnectionError:
+            self.log.error("Lost connection to the client.")
+            self.stop()
+        except Exception as e:
+            self.log.error("Caught Error while sending the message to client: {}", e)
+            self.stop()
+            raise e
+
+    def broadcast_frame(self, message):
+        """A frame of `message` in its own buffer, so a broadcast thread can encrypt it."""
+        messages = self.channels.outgoing([message])
+        plaintext = utils.pack_record(messages) if self.record_size else messages[0]
+        return b"".join(utils.FrameWriter(self.frame_writer.cipher, reuse=False).parts(plaintext))
+
+    def write_broadcast(self, frame, report: utils.BroadcastReport):
+        """Queue a broadcast frame in the transport's buffer, or drop it when the
+        client is gone or has more than max_pending_output bytes unsent."""
+        transport = self.writer.transport
+        stats = self.metrics.shard()
+        if (self.stop_event.is_set() or transport.is_closing() or
+                transport.get_write_buffer_size() + len(frame) > self.limits.max_pending_output):
+            stats.add("broadcasts_dropped")
+            report.drop()
+            return
+        self.writer.write(frame)
+        stats.add("frames_out")
+        stats.add("bytes_out", len(frame))
+        self.frames_out += 1
+        self.bytes_out += len(frame)
+        if transport.get_write_buffer_size():
+            asyncio.create_task(self.report_written(report))
+        else:
+            stats.add("broadcasts_delivered")
+            stats.observe("broadcast", report.delivered())
+
+    async def report_written(self, report: utils.BroadcastReport):
+        """Wait until the transport's buffer, holding a broadcast frame, is written out."""
+        transport = self.writer.transport
+        deadline = time.monotonic() + utils.BROADCAST_TIMEOUT
+        while transport.get_write_buffer_size() and not transport.is_closing():
+            if time.monotonic() > deadline:
+                return # still queued, the report counts it as such
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+        stats = self.metrics.shard()
+        if transport.is_closing():
+            stats.add("broadcasts_dropped")
+            report.drop()
+        else:
+            stats.add("broadcasts_delivered")
+            stats.observe("broadcast", report.delivered())
+
+    def write_messages(self, messages):
+        """Encrypt messages into the writer's buffer, without waiting for them to be sent;
+        all in one record when the client negotiated coalescing."""
+        messages = self.channels.outgoing(messages)
+        for message in messages:
+            self.log.info("Sending: {}", message)
+            self.log.verbose("Sent text (length: {}): {}", len(message),
+                             getattr(message, "value", message))
+
+        for plaintext in [utils.pack_record(messages)] if self.record_size else messages:
+            start = time.perf_counter()
+            parts = self.frame_writer.parts(plaintext)
+            frame_size = sum(map(len, parts))
+            if self.log.is_enabled(utils.LogLevel.VERBOSE):
+                self.log.verbose("Sent frame (length: {}): {!h}", frame_size, b"".join(parts))
+
+            # gathered with sendmsg by transports that support it (Python 3.12+)
+            self.writer.writelines(parts)
+            stats = self.metrics.shard()
+            stats.observe("reply", time.perf_counter() - start)
+            stats.add("frames_out")
+            stats.add("bytes_out", frame_size)
+            self.frames_out += 1
+            self.bytes_out += frame_size
+
+
+class AsyncConnectionsHandler(threading.Thread):
+    """Drop-in replacement for server.ConnectionsHandler serving every
+    connection from one asyncio event loop instead of a thread per client.
+
+    The loop runs in this thread, so the console in DiffieHellmanServer keeps
+    calling the same blocking methods, which are forwarded to the loop.
+    """
+
+    def __init__(self, server_socket: socket.socket, log: utils.Logger,
+                 handshake_context: utils.HandshakeContext = None, metrics: Metrics = None,
+                 upload_dir=utils.DEFAULT_UPLOAD_DIR,
+                 shutdown_timeout=utils.DEFAULT_SHUTDOWN_TIMEOUT, first_client_id=0,
+                 client_id_step=1, limits: utils.ConnectionLimits = None,
+                 broadcast_threads=utils.DEFAULT_BROADCAST_THREADS, journal: Journal = None):
+        super().__init__()
+        self.server_socket = server_socket
+        self.connection_log = log
+        self.log = log.child("ConnectionsHandler: ")
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.started_event = threading.Event()
+        self.stopped: asyncio.Event | None = None
+        self.server: asyncio.Server | None = None
+        self.next_client_id = first_client_id
+        self.client_id_step = client_id_step
+        self.handshake_context = handshake_context
+        self.metrics = metrics or Metrics()
+        self.upload_dir = upload_dir
+        self.shutdown_timeout = shutdown_timeout
+        self.limits = limits or utils.ConnectionLimits()
+        self.admission = self.limits.admission()
+        self.deadlines = utils.Deadlines()
+        self.reaper_wakeup: asyncio.Event | None = None
+        self.broadcast_threads = broadcast_threads
+        self.broadcast_executor = ThreadPoolExecutor(broadcast_threads, "broadcast")
+        self.journal = journal
+        # by client id, the console thread iterates over snapshot()
+        self.connections: dict[int, AsyncConnection] = {}
+
+    def run(self):
+        """Serve connections on the event loop until stopped."""
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        except Exception as e:
+            self.log.error("Caught Error: {}", e)
+        finally:
+            self.started_event.set()
+            self.loop.close()
+            self.log.info("Stopped")
+
+    async def serve(self):
+        self.stopped = asyncio.Event()
+        self.reaper_wakeup = asyncio.Event()
+        reaper = asyncio.create_task(self.reap())
+        self.server = await asyncio.start_server(self.accept_connection, sock=self.server_socket)
+        self.started_event.set()
+        await self.stopped.wait()
+        reaper.cancel()
+        await asyncio.gather(reaper, return_exceptions=True) # its CancelledError, not raised
+
+    def set_deadline(self, connection: AsyncConnection, reason):
+        """Close the connection unless it moves on within the `reason` timeout."""
+        if self.deadlines.set(connection, self.limits.timeouts[reason], reason):
+            self.reaper_wakeup.set()
+
+    async def reap(self):
+        """Close the connections whose deadline passed, one task for all of them."""
+        while True:
+            deadline = self.deadlines.next_deadline()
+            try:
+                await asyncio.wait_for(self.reaper_wakeup.wait(),
+                                       None if deadline is None else deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                pass
+            self.reaper_wakeup.clear()
+            for connection, reason in self.deadlines.expire():
+                connection.expire(reason)
+
+    async def accept_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        self.metrics.shard().add("connections_accepted")
+        refused = self.admission.admit(addr[0])
+        if refused:
+            self.metrics.shard().add(f"handshakes_rejected_{refused}")
+            writer.transport.abort()
+            return
+        self.log.info("Connection {} will be established with {}", self.next_client_id, addr)
+        connection = AsyncConnection(self.next_client_id,
+                                     reader,
+                                     writer,
+                                     addr,
+                                     self.remove_connection,
+                                     self.connection_log,
+                                     self.handshake_context,
+                                     self.metrics,
+                                     self.upload_dir,
+                                     self.limits,
+                                     self.set_deadline,
+                                     self.admission,
+                                     self.journal)
+        connection.task = asyncio.current_task()
+        with self.lock:
+            self.connections[connection.client_id] = connection
+        self.next_client_id += self.client_id_step
+        await connection.run()
+
+    def run_on_loop(self, coroutine):
+        """Run a coroutine on the handler's loop and wait for its result."""
+        self.started_event.wait()
+        if self.loop.is_closed():
+            coroutine.close()
+            return None
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def broadcast(self, text) -> utils.BroadcastReport:
+        """Send `text` to every client and return at once; the broadcast threads
+        encrypt the copies in parallel and the loop writes them."""
+        message = utils.broadcast_message(text)
+        connections = [connection for connection in self.snapshot() if connection.frame_writer]
+        report = utils.BroadcastReport(len(connections))
+        for i in range(min(self.broadcast_threads, len(connections))):
+            self.broadcast_executor.submit(self.encrypt_broadcast,
+                                           connections[i::self.broadcast_threads], message,
+                                           report)
+        return report
+
+    def encrypt_broadcast(self, connections: list[AsyncConnection], message,
+                          report: utils.BroadcastReport):
+        """Job of a broadcast thread: the copies for some of the clients, handed to the loop."""
+        frames = []
+        for connection in connections:
+            try:
+                frames.append((connection, connection.broadcast_frame(message)))
+            except Exception as e:
+                self.log.error("Broadcast to client {} failed: {}", connection.client_id, e)
+                report.drop()
+        try:
+            self.loop.call_soon_threadsafe(self.write_broadcast, frames, report)
+        except RuntimeError: # the loop is closed, the server stopped
+            for _ in frames:
+                report.drop()
+
+    def write_broadcast(self, frames, report: utils.BroadcastReport):
+        for connection, frame in frames:
+            connection.write_broadcast(frame, report)
+
+    def stop(self):
+        """Stop accepting connections and close the remaining ones."""
+        self.run_on_loop(self.shutdown())
+        self.join()
+        self.broadcast_executor.shutdown(cancel_futures=True)
+
+    async def shutdown(self):
+        self.server.close()
+        await self.close_connections(self.snapshot())
+        self.stopped.set()
+
+    def snapshot(self) -> list[AsyncConnection]:
+        """The current connections, safe to iterate from the console thread."""
+        with self.lock:
+            return list(self.connections.values())
+
+    def remove_connection(self, connection):
+        """Remove a connection from the registry."""
+        with self.lock:
+            self.connections.pop(connection.client_id, None)
+        self.deadlines.discard(connection)
+
+    async def end_session(self, connection: AsyncConnection):
+        if connection.frame_writer: # no key to send EndSession with before the handshake ends
+            await connection.send_message(utils.ServerMessages.END_SESSION)
+            await asyncio.sleep(utils.END_SESSION_GRACE) # give client time to read the message
+        connection.stop(False)
+        if connection.task and connection.task is not asyncio.current_task():
+            await asyncio.gather(connection.task, return_exceptions=True)
+
+    async def close_connections(self, connections: list[AsyncConnection]):
+        """End the sessions concurrently, cancelling what is left after shutdown_timeout."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(self.end_session(c) for c in connections),
+                                                  return_exceptions=True),
+                                   self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            lingering = [c for c in connections if c.task and not c.task.done()]
+            self.log.error("{} connections did not end within {} s", len(lingering),
+                           self.shutdown_timeout)
+            for connection in lingering:
+                connection.stop(False)
+                connection.task.cancel()
+        with self.lock:
+            for connection in connections:
+                self.connections.pop(connection.client_id, None)
+
+    def close_all_connections(self):
+        connections = self.snapshot()
+        self.log.info("Closing all {} connections", len(connections))
+        self.run_on_loop(self.close_connections(connections))
+
+    def close_connection(self, id):
+        """Close a specific connection by id, False if there is none."""
+        with self.lock:
+            connection = self.connections.get(id)
+        if connection is None:
+            return False
+        self.run_on_loop(self.close_connections([connection]))
+        return True
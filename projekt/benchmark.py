@@ -0,0 +1,1602 @@
+"""Benchmarks for the mini TLS server and protocol.
+
+Every scenario starts its own server.py subprocesses on localhost, so nothing
+besides this directory is needed:
+
+    python benchmark.py engines --connections 100,1000,5000
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+import utils
+import async_server
+import client
+import metrics
+import session
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_G = 5
+DEFAULT_P = 23
+SILENT_LOG = utils.Logger(None, utils.LogLevel.SILENT)
+DEFAULT_SUITES = utils.format_cipher_suites(utils.DEFAULT_CIPHER_SUITES)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def running_server(*server_args, address_space_mb=None, stdout=subprocess.DEVNULL):
+    """Start server.py in a subprocess and yield (process, port); pass stdout=subprocess.PIPE
+    to read what its console prints."""
+    port = free_port()
+
+    def limit_address_space():
+        if address_space_mb:
+            limit = address_space_mb * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    process = subprocess.Popen([sys.executable, "server.py", "--host", "127.0.0.1",
+                                "--port", str(port), *server_args],
+                               cwd=PROJECT_DIR, stdin=subprocess.PIPE,
+                               stdout=stdout, stderr=subprocess.DEVNULL,
+                               preexec_fn=limit_address_space)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("server did not start")
+                time.sleep(0.05)
+        yield process, port
+    finally:
+        process.kill()
+        process.wait()
+
+
+def cpu_seconds(pid):
+    """User and system CPU time of a process and its direct children, e.g. workers."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue # exited meanwhile
+        if int(entry) == pid or int(fields[1]) == pid:
+            total += (int(fields[11]) + int(fields[12])) / ticks # utime, stime
+    return total
+
+
+def process_stats(pid):
+    """Read resident memory, its peak (MB) and thread count of a process from /proc."""
+    stats = {}
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM", "VmSize"):
+                stats[key] = int(value.split()[0]) / 1024
+            elif key == "Threads":
+                stats[key] = int(value)
+    return stats
+
+
+async def open_session(host, port, g=DEFAULT_G, p=DEFAULT_P):
+    """Open a connection and perform the ClientHello/ServerHello exchange."""
+    reader, writer = await asyncio.open_connection(host, port)
+    private_key = utils.generate_private_key()
+    public_key = utils.calculate_public_key(g, private_key, p)
+    writer.write(struct.pack("!11sIII", b"ClientHello", public_key, p, g))
+    _, server_public_key = struct.unpack("!11sI", await reader.readexactly(15))
+    shared_key = utils.calculate_shared_secret(server_public_key, private_key, p)
+    return reader, writer, utils.derive_symmetric_key(shared_key)
+
+
+async def send_frame(writer, key, text):
+    iv = os.urandom(utils.AES_BLOCK_SIZE)
+    ciphertext = utils.aes_cbc_encrypt(iv, text, key)
+    writer.write(struct.pack("!I", len(ciphertext)) + iv + ciphertext
+                 + utils.calculate_hmac(ciphertext, key))
+    await writer.drain()
+
+
+async def read_frame(reader, key):
+    iv, ciphertext, mac = await async_server.read_frame(reader)
+    if mac != utils.calculate_hmac(ciphertext, key):
+        raise ValueError("MAC mismatch")
+    return utils.aes_cbc_decrypt(iv, ciphertext, key)
+
+
+async def hold_sessions(port, count, concurrency, timeout):
+    """Open `count` idle sessions; return the ones that completed a round trip."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def open_one():
+        async with semaphore:
+            try:
+                return await asyncio.wait_for(open_session("127.0.0.1", port), timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return None
+
+    sessions = [s for s in await asyncio.gather(*(open_one() for _ in range(count))) if s]
+
+    async def ping(session):
+        reader, writer, key = session
+        try:
+            await send_frame(writer, key, "ping")
+            return await asyncio.wait_for(read_frame(reader, key), timeout) == "OK"
+        except (OSError, ValueError, asyncio.TimeoutError):
+            return False
+
+    alive = await asyncio.gather(*(ping(s) for s in sessions))
+    return [s for s, ok in zip(sessions, alive) if ok]
+
+
+def close_sessions(sessions):
+    for _, writer, _ in sessions:
+        writer.close()
+
+
+def print_table(headers, rows):
+    widths = [max(len(str(x)) for x in column) for column in zip(headers, *rows)]
+    for row in [headers, ["-" * w for w in widths], *rows]:
+        print("  ".join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+
+async def measure_sessions(process, port, count, args):
+    sessions = await hold_sessions(port, count, args.concurrency, args.timeout)
+    stats = process_stats(process.pid)
+    close_sessions(sessions)
+    return sessions, stats
+
+
+def bench_engines(args):
+    """Concurrent idle sessions, memory and threads per server engine."""
+    rows = []
+    for engine in utils.SERVER_ENGINES:
+        for count in args.connections:
+            with running_server("--engine", engine,
+                                address_space_mb=args.address_space_mb) as (process, port):
+                baseline = process_stats(process.pid)
+                start = time.monotonic()
+                sessions, stats = asyncio.run(measure_sessions(process, port, count, args))
+                elapsed = time.monotonic() - start
+            per_session = (stats["VmRSS"] - baseline["VmRSS"]) * 1024 / max(len(sessions), 1)
+            rows.append([engine, count, len(sessions), f"{elapsed:.1f}",
+                         f"{stats['VmRSS']:.1f}", f"{per_session:.1f}",
+                         f"{stats['VmSize']:.0f}", stats["Threads"]])
+    print_table(["engine", "requested", "alive", "open s", "RSS MB", "KB/session",
+                 "VmSize MB", "threads"], rows)
+
+
+async def measure_shutdown(process, port, count, args):
+    """Type `shutdown` with `count` sessions open; return (sessions, notified, seconds),
+    seconds is None when the server was still running after args.wait."""
+    sessions = await hold_sessions(port, count, args.concurrency, args.timeout)
+    # connected but silent clients, their connections are stuck in the handshake
+    silent = [socket.create_connection(("127.0.0.1", port)) for _ in range(args.silent)]
+    await asyncio.sleep(0.5)
+
+    async def ended(session):
+        reader, _, key = session
+        try:
+            return await asyncio.wait_for(read_frame(reader, key),
+                                          args.wait) == utils.ServerMessages.END_SESSION
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False
+
+    start = time.monotonic()
+    process.stdin.write(b"shutdown\n")
+    process.stdin.flush()
+    notified = sum(await asyncio.gather(*(ended(s) for s in sessions)))
+    try:
+        await asyncio.to_thread(process.wait, args.wait)
+        elapsed = time.monotonic() - start
+    except subprocess.TimeoutExpired:
+        elapsed = None
+    close_sessions(sessions)
+    for sock in silent:
+        sock.close()
+    return sessions, notified, elapsed
+
+
+def bench_shutdown(args):
+    """Time from the `shutdown` command to the server's exit with N open sessions."""
+    rows = []
+    for engine in utils.SERVER_ENGINES:
+        for count in args.connections:
+            with running_server("--engine", engine) as (process, port):
+                sessions, notified, elapsed = asyncio.run(
+                    measure_shutdown(process, port, count, args))
+            rows.append([engine, count, len(sessions), args.silent, notified,
+                         f"{elapsed:.2f}" if elapsed is not None else f"> {args.wait:g}"])
+    print_table(["engine", "requested", "sessions", "silent", "got EndSession", "shutdown s"],
+                rows)
+
+
+async def flood_oversized(port, claimed_size, duration):
+    """Announce one frame of `claimed_size` bytes and stream them; return bytes sent."""
+    _, writer, _ = await open_session("127.0.0.1", port)
+    writer.write(struct.pack("!I", claimed_size))
+    chunk = bytes(64 * 1024)
+    sent = 0
+    deadline = time.monotonic() + duration
+    try:
+        while sent < claimed_size and time.monotonic() < deadline:
+            writer.write(chunk)
+            await asyncio.wait_for(writer.drain(), max(deadline - time.monotonic(), 0.001))
+            sent += len(chunk)
+    except (OSError, asyncio.TimeoutError):
+        pass # refused, or the server stopped reading
+    writer.close()
+    return sent
+
+
+async def flood_frames(port, message_size, duration):
+    """Pipeline frames without ever reading a reply; return the bytes sent."""
+    _, writer, key = await open_session("127.0.0.1", port)
+    iv = os.urandom(utils.AES_BLOCK_SIZE)
+    ciphertext = utils.aes_cbc_encrypt(iv, "x" * message_size, key)
+    frame = (struct.pack("!I", len(ciphertext)) + iv + ciphertext
+             + utils.calculate_hmac(ciphertext, key))
+    sent = 0
+    deadline = time.monotonic() + duration
+    try:
+        while time.monotonic() < deadline:
+            writer.write(frame * 16)
+            await asyncio.wait_for(writer.drain(), max(deadline - time.monotonic(), 0.001))
+            sent += 16 * len(frame)
+    except (OSError, asyncio.TimeoutError):
+        pass
+    writer.close()
+    return sent
+
+
+async def measure_flood(port, mode, args):
+    """Flood from `args.sessions` sessions at once, return the bytes they sent."""
+    def flood():
+        if mode == "oversized":
+            return flood_oversized(port, args.claimed_megabytes * 1024 * 1024, args.duration)
+        return flood_frames(port, args.message_size, args.duration)
+
+    return sum(await asyncio.gather(*(flood() for _ in range(args.sessions))))
+
+
+def server_counters(metrics_port):
+    """The server's counters, scraped from its --metrics-port endpoint."""
+    url = f"http://127.0.0.1:{metrics_port}/metrics"
+    with urllib.request.urlopen(url, timeout=5) as response:
+        text = response.read().decode()
+    prefix = f"{metrics.PROMETHEUS_PREFIX}_"
+    return {line.split()[0][len(prefix):-len("_total")]: int(float(line.split()[1]))
+            for line in text.splitlines()
+            if line.startswith(prefix) and line.split()[0].endswith("_total")}
+
+
+def bench_flood(args):
+    """Server memory under clients that announce huge frames or never read replies.
+
+    oversized: each session announces a `--claimed-megabytes` frame and
+    streams zeros; pipelined: each session sends frames as fast as the
+    server takes them and never reads an OK. Extra server flags, e.g. the
+    per-connection budgets, are given with `--server-args`.
+    """
+    rows = []
+    for mode in args.modes:
+        metrics_port = free_port()
+        with running_server("--engine", args.engine, "--metrics-port", str(metrics_port),
+                            *args.server_args.split()) as (process, port):
+            baseline = process_stats(process.pid)["VmRSS"]
+            sent = asyncio.run(measure_flood(port, mode, args))
+            alive = process.poll() is None
+            peak, read, refused = "-", "-", "-"
+            if alive:
+                peak = f"{process_stats(process.pid)['VmHWM']:.1f}"
+                counters = server_counters(metrics_port)
+                read = f"{counters['frames_in'] / args.duration:.0f}"
+                refused = counters["frames_refused"]
+        # sent includes what the socket buffers took in without the server reading it
+        rows.append([mode, args.sessions, f"{sent / 1e6:.1f}",
+                     f"{sent / 1e6 / args.duration:.1f}", read, refused, f"{baseline:.1f}",
+                     peak, "yes" if alive else "NO"])
+    print_table(["mode", "sessions", "sent MB", "MB/s", "frames read/s", "refused",
+                 "idle RSS MB", "peak RSS MB", "server alive"], rows)
+
+
+async def stall(port, kind):
+    """Open a connection that stops sending: before ClientHello (silent), after the
+    handshake (idle) or in the middle of a frame (partial). Return (reader, writer,
+    monotonic time the server's deadline starts)."""
+    if kind == "silent":
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    else:
+        reader, writer, _ = await open_session("127.0.0.1", port)
+        if kind == "partial":
+            writer.write(struct.pack("!I", 64) + bytes(8))
+            await writer.drain()
+    return reader, writer, time.monotonic()
+
+
+async def measure_reaper(port, args):
+    """Lateness of the reaper for every stalled connection and the ping latencies of
+    steady sessions, before and while the stalled connections are opened and reaped."""
+    sessions = await hold_sessions(port, args.steady, args.steady, args.timeout)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    lateness = {kind: [] for kind in args.kinds}
+
+    async def stalled(kind):
+        async with semaphore:
+            try:
+                reader, writer, since = await asyncio.wait_for(stall(port, kind), args.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return
+        try:
+            await asyncio.wait_for(reader.read(), args.deadline + args.wait) # until closed
+            lateness[kind].append(time.monotonic() - since - args.deadline)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        writer.close()
+
+    async def stall_all():
+        await asyncio.gather(*(stalled(args.kinds[i % len(args.kinds)])
+                               for i in range(args.stalled)))
+
+    idle, during = [], []
+    for latencies, phase in ((idle, lambda: asyncio.sleep(args.idle)), (during, stall_all)):
+        stop = asyncio.Event()
+        pingers = [asyncio.create_task(ping_until(s, latencies, stop)) for s in sessions]
+        await phase()
+        stop.set()
+        await asyncio.gather(*pingers)
+    close_sessions(sessions)
+    return lateness, idle, during
+
+
+def bench_reaper(args):
+    """Stalled connections closed on schedule by the reaper, and the cost to active clients.
+
+    `--stalled` connections stop sending before ClientHello, after the
+    handshake or in the middle of a frame, to a server whose handshake, idle
+    and frame timeouts are all `--deadline` seconds, while `--steady`
+    sessions keep pinging. Lateness is how long after its deadline the
+    client saw its connection closed.
+    """
+    timeouts = [f"--{name}-timeout" for name in ("handshake", "idle", "frame")]
+    reaping, pings = [], []
+    for engine in utils.SERVER_ENGINES:
+        metrics_port = free_port()
+        server_args = [arg for name in timeouts for arg in (name, str(args.deadline))]
+        with running_server("--engine", engine, "--metrics-port", str(metrics_port),
+                            *server_args) as (process, port):
+            lateness, idle, during = asyncio.run(measure_reaper(port, args))
+            reaped = server_counters(metrics_port)["connections_reaped"]
+            threads = process_stats(process.pid)["Threads"]
+        for kind, values in lateness.items():
+            late = [f"{percentile(values, f) * 1000:.0f}" if values else "-"
+                    for f in (0.5, 0.99, 1.0)]
+            reaping.append([engine, kind, len(range(args.kinds.index(kind), args.stalled,
+                                                    len(args.kinds))), len(values), *late])
+        pings.append([engine, args.steady, reaped, threads, *latency_columns(idle),
+                      *latency_columns(during), f"{max(during) * 1000:.2f}"])
+    print_table(["engine", "kind", "stalled", "closed", "p50 late ms", "p99 late ms",
+                 "max late ms"], reaping)
+    print()
+    print_table(["engine", "steady", "reaped", "threads after", "idle p50 ms", "idle p99 ms",
+                 "reaping p50 ms", "reaping p99 ms", "reaping max ms"], pings)
+
+
+def legacy_read_frame(sock):
+    """Frame parsing as done before utils.FrameReader: four receive_data calls."""
+    message_size = struct.unpack("!I", utils.receive_data(sock, 4))[0]
+    iv = utils.receive_data(sock, utils.AES_BLOCK_SIZE)
+    ciphertext = utils.receive_data(sock, message_size)
+    mac = utils.receive_data(sock, utils.MAC_SIZE)
+    return iv, ciphertext, mac
+
+
+def bench_framing(args):
+    """Frames/s parsed from a socketpair: FrameReader vs four receive_data calls."""
+    rows = []
+    for payload_size in args.payload_sizes:
+        frame = (struct.pack("!I", payload_size) + os.urandom(utils.AES_BLOCK_SIZE)
+                 + os.urandom(payload_size) + os.urandom(utils.MAC_SIZE))
+        count = max(1, args.megabytes * 1024 * 1024 // len(frame))
+        for name in ("receive_data", "FrameReader"):
+            receiver, sender = socket.socketpair()
+            batch = frame * max(1, 64 * 1024 // len(frame))
+            frames_per_batch = len(batch) // len(frame)
+            batches = -(-count // frames_per_batch)
+            writer = threading.Thread(target=lambda: [sender.sendall(batch)
+                                                      for _ in range(batches)])
+            read_frame = (utils.FrameReader(receiver).read_frame if name == "FrameReader"
+                          else lambda: legacy_read_frame(receiver))
+            start = time.perf_counter()
+            writer.start()
+            for _ in range(batches * frames_per_batch):
+                read_frame()
+            elapsed = time.perf_counter() - start
+            writer.join()
+            receiver.close()
+            sender.close()
+            frames = batches * frames_per_batch
+            rows.append([payload_size, name, frames, f"{frames / elapsed:,.0f}",
+                         f"{frames * len(frame) / elapsed / 1024 ** 2:,.1f}"])
+    print_table(["payload B", "reader", "frames", "frames/s", "MB/s"], rows)
+
+
+def bench_suites(args):
+    """Encrypt+decrypt throughput and per-frame overhead of each cipher suite."""
+    rows = []
+    for payload_size in args.payload_sizes:
+        message = "x" * payload_size
+        for suite, cipher_class in utils.CIPHERS.items():
+            cipher = cipher_class(os.urandom(cipher_class.key_size))
+            count = max(1, args.megabytes * 1024 * 1024 // payload_size)
+            start = time.perf_counter()
+            for _ in range(count):
+                iv, ciphertext, mac = cipher.encrypt(message)
+                cipher.decrypt(iv, ciphertext, mac)
+            elapsed = time.perf_counter() - start
+            overhead = 4 + len(iv) + len(ciphertext) + len(mac) - payload_size
+            rows.append([payload_size, suite.name, f"{count / elapsed:,.0f}",
+                         f"{count * payload_size / elapsed / 1024 ** 2:,.1f}", overhead])
+    print_table(["payload B", "suite", "frames/s", "MB/s", "overhead B"], rows)
+
+
+class BytesSocket:
+    """Stands in for a socket whose recv_into serves a prepared byte string."""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def recv_into(self, view):
+        size = min(len(view), len(self.data) - self.offset)
+        view[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+def traced_peak(call):
+    """Peak bytes allocated by Python while `call` runs, as seen by tracemalloc."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        call()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_copies(args):
+    """Memory allocated per frame on the send and receive paths, traced with tracemalloc.
+
+    The peak of one frame, as a multiple of the payload, counts the payload
+    sized buffers alive at once: the frame itself is 1x, every extra copy
+    (padding, concatenation, slicing) adds another.
+    """
+    key = os.urandom(32)
+    rows = []
+    for payload_size in args.payload_sizes:
+        payload = os.urandom(payload_size)
+        for suite, cipher_class in utils.CIPHERS.items():
+            cipher = cipher_class(key)
+            writer = utils.FrameWriter(cipher)
+            frame = bytes(writer.frame(payload)) # also grows the reused buffer once
+
+            def concatenate():
+                iv, ciphertext, mac = cipher.encrypt(payload)
+                return struct.pack("!I", len(ciphertext)) + iv + ciphertext + mac
+
+            reader = utils.FrameReader(None, buffer_size=len(frame))
+
+            def receive():
+                reader.socket = BytesSocket(frame) # the connection's buffer is not per frame
+                iv, ciphertext, mac = reader.read_frame(cipher.iv_size, cipher.mac_size)
+                cipher.verify(iv, ciphertext, mac)
+                return cipher.decrypt_verified_bytes(iv, ciphertext, mac)
+
+            for path, call in (("send: encrypt + concatenate", concatenate),
+                               ("send: FrameWriter", lambda: writer.frame(payload)),
+                               ("receive: FrameReader + decrypt", receive)):
+                peak = traced_peak(call)
+                count = max(1, args.megabytes * 1024 * 1024 // payload_size)
+                start = time.perf_counter()
+                for _ in range(count):
+                    call()
+                elapsed = time.perf_counter() - start
+                rows.append([payload_size, suite.name, path, f"{peak:,}",
+                             f"{peak / payload_size:.2f}", f"{count / elapsed:,.0f}"])
+    print_table(["payload B", "suite", "path", "peak B", "x payload", "frames/s"], rows)
+
+
+def bench_gather(args):
+    """Sending frames over a socketpair: joined, gathered with sendmsg or encrypted in place.
+
+    "concatenate" is size + iv + ciphertext + mac and sendall, "sendmsg"
+    hands the four parts to utils.send_buffers, "in place" encrypts into
+    the reused frame buffer of utils.FrameWriter; FrameWriter.parts() picks
+    between the last two by message size. Peak is the memory traced while
+    building and sending one frame.
+    """
+    key = os.urandom(32)
+    rows = []
+    for payload_size in args.payload_sizes:
+        payload = os.urandom(payload_size)
+        count = max(1, args.megabytes * 1024 * 1024 // payload_size)
+        for suite, cipher_class in utils.CIPHERS.items():
+            cipher = cipher_class(key)
+            writer = utils.FrameWriter(cipher)
+            writer.frame(payload) # grow the reused buffer once
+            sender, receiver = socket.socketpair()
+
+            def concatenate():
+                iv, ciphertext, mac = cipher.encrypt(payload)
+                sender.sendall(struct.pack("!I", len(ciphertext)) + iv + ciphertext + mac)
+
+            def gather():
+                iv, ciphertext, mac = cipher.encrypt(payload)
+                utils.send_buffers(sender, [struct.pack("!I", len(ciphertext)), iv,
+                                            ciphertext, mac])
+
+            def in_place():
+                sender.sendall(writer.frame(payload))
+
+            def drain():
+                while receiver.recv_into(sink):
+                    pass
+
+            sink = bytearray(1024 * 1024)
+            drainer = threading.Thread(target=drain)
+            drainer.start()
+            for name, call in (("concatenate", concatenate), ("sendmsg", gather),
+                               ("in place", in_place)):
+                peak = traced_peak(call)
+                start = time.perf_counter()
+                for _ in range(count):
+                    call()
+                elapsed = time.perf_counter() - start
+                rows.append([payload_size, suite.name, name, f"{peak:,}",
+                             f"{count * payload_size / elapsed / 1024 ** 2:,.1f}"])
+            sender.close()
+            drainer.join()
+            receiver.close()
+    print_table(["payload B", "suite", "send", "peak B", "MB/s"], rows)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure_connects(port, count, **client_kwargs):
+    """Latencies of `count` sequential DiffieHellmanClient.connect calls."""
+    dh_client = client.DiffieHellmanClient("127.0.0.1", port, False, DEFAULT_G, DEFAULT_P,
+                                           log=SILENT_LOG, **client_kwargs)
+    dh_client.generate_keys()
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        dh_client.connect()
+        latencies.append(time.perf_counter() - start)
+        if not dh_client.connected:
+            raise RuntimeError("handshake failed")
+        dh_client.notify_and_dissconnect()
+        dh_client.server_listener.join()
+    return latencies
+
+
+def latency_columns(latencies):
+    return [f"{percentile(latencies, f) * 1000:.2f}" for f in (0.5, 0.99)]
+
+
+def bench_resumption(args):
+    """Reconnect latency of DiffieHellmanClient.connect with and without tickets."""
+    rows = []
+    with running_server() as (_, port):
+        for resumption in (False, True):
+            latencies = measure_connects(port, args.reconnects, resumption=resumption,
+                                         dh_group=utils.DH_GROUP_NAMES.get(args.dh_group))
+            rows.append(["resumption" if resumption else "full handshake", args.reconnects,
+                         *latency_columns(latencies)])
+    print_table(["reconnect", "count", "p50 ms", "p99 ms"], rows)
+
+
+def bench_handshakes(args):
+    """Full handshake latency per group, with and without the server keypair pool.
+
+    handshakes/s is the inverse of the mean connect latency: sequential
+    handshakes with the client's own keypair generated once up front.
+    """
+    rows = []
+    for group_name in args.groups:
+        for pool_size in (0, utils.DEFAULT_KEYPAIR_POOL_SIZE):
+            with running_server("--keypair-pool-size", str(pool_size)) as (_, port):
+                time.sleep(args.warmup)
+                latencies = measure_connects(port, args.handshakes, resumption=False,
+                                             dh_group=utils.DH_GROUP_NAMES.get(group_name))
+            rows.append([group_name, pool_size, args.handshakes,
+                         f"{len(latencies) / sum(latencies):,.1f}", *latency_columns(latencies)])
+    print_table(["group", "pool", "count", "handshakes/s", "p50 ms", "p99 ms"], rows)
+
+
+def bench_keyexchange(args):
+    """CPU cost of one key exchange per group, without sockets or the keypair pool.
+
+    Each exchange generates both keypairs, computes both shared secrets and
+    derives the symmetric key, so it is what a handshake costs both peers.
+    """
+    rows = []
+    for group_name in args.groups:
+        group = utils.DH_GROUP_NAMES[group_name]
+        start = time.perf_counter()
+        for _ in range(args.exchanges):
+            client_private, client_public = group.generate_keypair()
+            server_private, server_public = group.generate_keypair()
+            client_public = group.decode_public_key(group.encode_public_key(client_public))
+            server_public = group.decode_public_key(group.encode_public_key(server_public))
+            client_secret = group.shared_secret(client_private, server_public)
+            server_secret = group.shared_secret(server_private, client_public)
+            assert client_secret == server_secret
+            utils.derive_symmetric_key(server_secret)
+        elapsed = time.perf_counter() - start
+        rows.append([group_name, args.exchanges, f"{args.exchanges / elapsed:,.1f}",
+                     f"{elapsed / args.exchanges * 1000:.2f}"])
+    print_table(["group", "count", "exchanges/s", "ms/exchange"], rows)
+
+
+async def ping_until(session, latencies, stop: asyncio.Event):
+    """Round trip "ping" on an open session until stop is set."""
+    reader, writer, key = session
+    while not stop.is_set():
+        start = time.perf_counter()
+        await send_frame(writer, key, "ping")
+        await read_frame(reader, key)
+        latencies.append(time.perf_counter() - start)
+
+
+async def bare_handshake(port, client_hello, source="127.0.0.1"):
+    """Send a prepared ClientHelv2 and read the ServerHello, without computing K.
+
+    Leaves the Diffie-Hellman work of the storm to the server alone. Any
+    `source` address in 127.0.0.0/8 works for a client on loopback.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, local_addr=(source, 0))
+    try:
+        writer.write(client_hello)
+        await reader.readexactly(utils.HELLO_TYPE_SIZE)
+        await reader.readexactly(struct.unpack("!H", await reader.readexactly(2))[0])
+    finally:
+        writer.close()
+
+
+def storm_client_hello(group):
+    _, public_key = group.generate_keypair()
+    return utils.CLIENT_HELLO_V2 + utils.pack_extensions({
+        utils.HelloExtension.CIPHER_SUITES: bytes(utils.DEFAULT_CIPHER_SUITES),
+        utils.HelloExtension.DH_GROUP: struct.pack("!H", group.group_id),
+        utils.HelloExtension.KEY_SHARE: group.encode_public_key(public_key)})
+
+
+async def measure_storm(port, args, group):
+    """Ping latencies of steady sessions while idle and during a handshake storm."""
+    sessions = await hold_sessions(port, args.steady, args.steady, args.timeout)
+    client_hello = storm_client_hello(group)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def storm_one():
+        async with semaphore:
+            try:
+                await asyncio.wait_for(bare_handshake(port, client_hello), args.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                failures.append(e)
+
+    failures = []
+
+    async def storm():
+        await asyncio.gather(*(storm_one() for _ in range(args.handshakes)))
+
+    idle, during = [], []
+    for latencies, phase in ((idle, lambda: asyncio.sleep(args.idle)), (during, storm)):
+        stop = asyncio.Event()
+        pingers = [asyncio.create_task(ping_until(s, latencies, stop)) for s in sessions]
+        start = time.perf_counter()
+        await phase()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*pingers)
+    close_sessions(sessions)
+    return idle, during, elapsed, len(failures)
+
+
+def bench_storm(args):
+    """Message latency of connected clients while many new clients handshake at once.
+
+    Steady sessions keep pinging the server, first while it is idle, then
+    while `--handshakes` ClientHellos arrive; the server runs with and
+    without handshake worker processes.
+    """
+    group = utils.DH_GROUP_NAMES[args.group]
+    rows = []
+    for workers in args.workers:
+        with running_server("--engine", args.engine, "--handshake-workers", str(workers),
+                            "--keypair-pool-size", "0") as (_, port):
+            idle, during, storm_time, failed = asyncio.run(measure_storm(port, args, group))
+        rows.append([workers, args.handshakes, failed,
+                     f"{(args.handshakes - failed) / storm_time:,.1f}",
+                     *latency_columns(idle), *latency_columns(during),
+                     f"{max(during) * 1000:.2f}"])
+    print_table(["workers", "handshakes", "failed", "handshakes/s", "idle p50 ms", "idle p99 ms",
+                 "storm p50 ms", "storm p99 ms", "storm max ms"], rows)
+
+
+async def measure_round_trips(port, args):
+    """Ping round trips completed by `args.sessions` sessions in `args.duration` s."""
+    sessions = await hold_sessions(port, args.sessions, args.sessions, args.timeout)
+    latencies = []
+    stop = asyncio.Event()
+    pingers = [asyncio.create_task(ping_until(s, latencies, stop)) for s in sessions]
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*pingers)
+    close_sessions(sessions)
+    return latencies
+
+
+async def measure_admission(port, args, group):
+    """Handshakes served to a flooding address and to a well-behaved one, and the ping
+    latencies of established sessions, during `args.duration` seconds of flood."""
+    sessions = await hold_sessions(port, args.steady, args.steady, args.timeout)
+    client_hello = storm_client_hello(group)
+    stop = asyncio.Event()
+    flood = {"served": 0, "refused": 0}
+    regular = []
+
+    async def flood_one():
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(bare_handshake(port, client_hello, args.flood_address),
+                                       args.timeout)
+                flood["served"] += 1
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                flood["refused"] += 1
+                await asyncio.sleep(0.01) # leave the one machine's CPU to the server
+
+    async def regular_client():
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(bare_handshake(port, client_hello), args.timeout)
+                regular.append(time.perf_counter() - start)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                regular.append(None)
+            await asyncio.sleep(args.interval)
+
+    latencies = []
+    tasks = [asyncio.create_task(ping_until(s, latencies, stop)) for s in sessions]
+    tasks += [asyncio.create_task(flood_one()) for _ in range(args.concurrency)]
+    tasks.append(asyncio.create_task(regular_client()))
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    close_sessions(sessions)
+    return flood, regular, latencies
+
+
+def bench_admission(args):
+    """Established sessions and a regular client while one address floods handshakes.
+
+    For every `--limits` entry (server.py arguments, ";" separated, "" for
+    none) `--concurrency` connections from `--flood-address` handshake in a
+    loop for `--duration` seconds, while `--steady` sessions ping and a
+    client on 127.0.0.1 handshakes every `--interval` seconds.
+    """
+    group = utils.DH_GROUP_NAMES[args.group]
+    rows = []
+    for limits in args.limits:
+        with running_server("--engine", args.engine, *limits.split()) as (_, port):
+            flood, regular, latencies = asyncio.run(measure_admission(port, args, group))
+        served = [latency for latency in regular if latency is not None]
+        rows.append([limits or "none", f"{flood['served'] / args.duration:.1f}",
+                     f"{flood['refused'] / args.duration:.1f}", f"{len(served)}/{len(regular)}",
+                     f"{percentile(served, 0.5) * 1000:.1f}" if served else "-",
+                     *latency_columns(latencies)])
+    print_table(["limits", "flood served/s", "flood refused/s", "regular ok",
+                 "regular handshake ms", "ping p50 ms", "ping p99 ms"], rows)
+
+
+def bench_logging(args):
+    """Server message throughput with --verbose off and on, and the cost of a log call.
+
+    The call cost compares the old verbose lines, an f-string with .hex()
+    built before the verbose check, with a Logger call below its level.
+    """
+    rows = []
+    for verbose in (False, True):
+        with running_server("--engine", args.engine,
+                            *(["--verbose"] if verbose else [])) as (_, port):
+            latencies = asyncio.run(measure_round_trips(port, args))
+        rows.append(["on" if verbose else "off", len(latencies),
+                     f"{len(latencies) / args.duration:,.1f}", *latency_columns(latencies)])
+    print_table(["verbose", "messages", "messages/s", "p50 ms", "p99 ms"], rows)
+    print()
+
+    ciphertext = os.urandom(args.message_size)
+    log = utils.Logger(None, utils.LogLevel.INFO)
+    verbose = False
+
+    def print_if_verbose(*args):
+        if verbose:
+            print(*args)
+
+    calls = {
+        "f-string, verbose off": lambda: print_if_verbose(
+            f"[V] Received ciphertext: {ciphertext.hex()}"),
+        "Logger, verbose off": lambda: log.verbose("Received ciphertext: {!h}", ciphertext),
+    }
+    rows = []
+    for name, call in calls.items():
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            call()
+        elapsed = time.perf_counter() - start
+        rows.append([name, args.message_size, f"{elapsed / args.calls * 1e9:,.0f}"])
+    print_table(["log call", "bytes", "ns/call"], rows)
+
+
+def bench_metrics(args):
+    """Cost of one metrics update on the frame path, next to a lock-guarded counter."""
+    metrics_registry = metrics.Metrics()
+    stats = metrics_registry.shard()
+    lock = threading.Lock()
+    locked = {"frames_in": 0}
+
+    def locked_add():
+        with lock:
+            locked["frames_in"] += 1
+
+    calls = {
+        "Metrics.shard()": metrics_registry.shard,
+        "shard.add()": lambda: stats.add("frames_in"),
+        "shard.observe()": lambda: stats.observe("recv", 0.0003),
+        "perf_counter()": time.perf_counter,
+        "locked counter": locked_add,
+    }
+    rows = []
+    for name, call in calls.items():
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            call()
+        elapsed = time.perf_counter() - start
+        rows.append([name, f"{elapsed / args.calls * 1e9:,.0f}"])
+    print_table(["call", "ns/call"], rows)
+
+
+class LoadSession:
+    """One headless client of the load scenario, pipelining through a ClientSession."""
+
+    def __init__(self, host, port, group, args):
+        self.session = session.ClientSession(host, port, args.cipher_suites, group,
+                                             DEFAULT_P, DEFAULT_G, resumption=False,
+                                             window=args.pipeline, ack_every=args.ack_every,
+                                             coalesce_delay_ms=args.coalesce_delay_ms)
+        self.latencies = []
+
+    async def connect(self):
+        await self.session.connect()
+
+    async def pipeline(self, payload, count):
+        """Send `count` messages, the session keeps up to its window unconfirmed."""
+        sent_at = deque()
+
+        async def read_replies():
+            confirmed = 0
+            async for reply in self.session.replies():
+                acknowledged = utils.parse_ack(reply)
+                if acknowledged is None and reply != utils.ServerMessages.OK.encode():
+                    raise ValueError(f"unexpected reply {reply}")
+                now = time.perf_counter()
+                upto = confirmed + 1 if acknowledged is None else acknowledged + 1
+                for _ in range(upto - confirmed):
+                    self.latencies.append(now - sent_at.popleft())
+                confirmed = upto
+                if confirmed == count:
+                    return
+            raise ConnectionError("connection closed before every message was confirmed")
+
+        replies = asyncio.create_task(read_replies())
+        for _ in range(count):
+            await self.session.wait_for_window()
+            sent_at.append(time.perf_counter())
+            await self.session.send(payload)
+        await replies
+
+    async def close(self):
+        await self.session.close()
+
+
+async def run_load(host, port, args):
+    """Handshake every session, then let them all pipeline their messages at once."""
+    group = utils.DH_GROUP_NAMES.get(args.group)
+    sessions = [LoadSession(host, port, group, args) for _ in range(args.sessions)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    handshake_latencies = []
+
+    async def connect(session: LoadSession):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(session.connect(), args.timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    ConnectionError):
+                return False
+            handshake_latencies.append(time.perf_counter() - start)
+            return True
+
+    start = time.perf_counter()
+    connected = await asyncio.gather(*(connect(s) for s in sessions))
+    handshake_time = time.perf_counter() - start
+    sessions = [s for s, ok in zip(sessions, connected) if ok]
+
+    payload = "x" * args.message_size
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*(s.pipeline(payload, args.messages) for s in sessions),
+                                    return_exceptions=True)
+    message_time = time.perf_counter() - start
+    await asyncio.gather(*(s.close() for s in sessions))
+
+    latencies = [latency for s in sessions for latency in s.latencies]
+    if not latencies:
+        raise RuntimeError("no session completed a round trip")
+    messages = len(latencies)
+    return {
+        "sessions": len(sessions),
+        "failed_handshakes": args.sessions - len(sessions),
+        "failed_sessions": sum(isinstance(outcome, Exception) for outcome in outcomes),
+        "handshakes_per_s": len(handshake_latencies) / handshake_time,
+        "handshake_p50_ms": percentile(handshake_latencies, 0.5) * 1000,
+        "handshake_p99_ms": percentile(handshake_latencies, 0.99) * 1000,
+        "messages": messages,
+        "messages_per_s": messages / message_time,
+        "mb_per_s": messages * args.message_size / message_time / 1e6,
+        "rtt_p50_ms": percentile(latencies, 0.5) * 1000,
+        "rtt_p99_ms": percentile(latencies, 0.99) * 1000,
+        "rtt_p999_ms": percentile(latencies, 0.999) * 1000,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_DIR, text=True,
+                              capture_output=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_load(args):
+    """Throughput and OK round-trip latency of many pipelining sessions.
+
+    `--sessions` clients handshake, then each sends `--messages` messages
+    keeping up to `--pipeline` unconfirmed. Without `--port` the scenario
+    starts its own server.py; `--json` writes the results for comparing
+    commits.
+    """
+    if args.port:
+        results = asyncio.run(run_load(args.host, args.port, args))
+    else:
+        with running_server("--engine", args.engine) as (_, port):
+            results = asyncio.run(run_load("127.0.0.1", port, args))
+
+    rows = [[name, f"{value:,.2f}" if isinstance(value, float) else value]
+            for name, value in results.items()]
+    print_table(["metric", "value"], rows)
+    if args.json:
+        parameters = {name: value for name, value in vars(args).items() if name != "func"}
+        report = {"commit": git_commit(), "parameters": parameters, "results": results}
+        with open(args.json, "w") as output:
+            json.dump(report, output, indent=2)
+            output.write("\n")
+
+
+def load_in_process(port, args):
+    return asyncio.run(run_load("127.0.0.1", port, args))
+
+
+def bench_workers(args):
+    """Messages/s of the load scenario against servers with --workers N.
+
+    The sessions are split between `--client-processes` processes, so a
+    single client process does not cap the throughput before the server.
+    CPU s is the time the server and its workers spent on the CPU.
+    """
+    processes = args.client_processes
+    client_args = argparse.Namespace(**{**vars(args), "sessions": args.sessions // processes})
+    rows = []
+    for workers in args.workers:
+        with running_server("--engine", args.engine, "--workers", str(workers)) as (
+                process, port):
+            cpu_before = cpu_seconds(process.pid)
+            with ProcessPoolExecutor(processes) as pool:
+                results = list(pool.map(load_in_process, [port] * processes,
+                                        [client_args] * processes))
+            cpu = cpu_seconds(process.pid) - cpu_before
+        messages = sum(result["messages"] for result in results)
+        elapsed = max(result["messages"] / result["messages_per_s"] for result in results)
+        rows.append([workers, sum(result["sessions"] for result in results),
+                     f"{messages / elapsed:,.0f}",
+                     f"{messages * args.message_size / elapsed / 1e6:.1f}",
+                     f"{max(result['rtt_p99_ms'] for result in results):.1f}", f"{cpu:.1f}"])
+    print_table(["workers", "sessions", "messages/s", "MB/s", "p99 ms", "CPU s"], rows)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def measure_transfer(port, path, chunk_size, args):
+    """Send the file over a fresh session, return seconds until every chunk was confirmed."""
+    transfer = session.ClientSession("127.0.0.1", port, args.cipher_suites,
+                                     utils.DH_GROUP_NAMES.get(args.group), resumption=False,
+                                     coalesce_delay_ms=args.coalesce_delay_ms)
+    await transfer.connect()
+    start = time.perf_counter()
+    await transfer.send_file(path, chunk_size)
+    await transfer.drain_acknowledgements()
+    elapsed = time.perf_counter() - start
+    if transfer.unacknowledged:
+        raise ConnectionError("connection closed before the file was confirmed")
+    await transfer.close()
+    return elapsed
+
+
+def bench_transfer(args):
+    """File transfer speed and server memory by chunk size.
+
+    Sends a `--megabytes` file of random bytes with `sendfile` chunks of each
+    `--chunk-sizes`, 0 sending the whole file as a single message, to a fresh
+    server and checks the stored copy. The server's peak resident memory
+    shows whether it buffered the whole file.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "payload.bin")
+        with open(path, "wb") as file:
+            for _ in range(args.megabytes):
+                file.write(os.urandom(1024 * 1024))
+        expected = file_digest(path)
+        upload_dir = os.path.join(directory, "uploads")
+        size = os.path.getsize(path)
+
+        rows = []
+        for chunk_size in args.chunk_sizes:
+            # the whole file as one message is a frame above the default --max-frame-size
+            with running_server("--engine", args.engine, "--upload-dir", upload_dir,
+                                "--max-frame-size", str(2 * size + 64 * 1024)) as (
+                    process, port):
+                elapsed = asyncio.run(measure_transfer(port, path, chunk_size or size, args))
+                peak_rss = process_stats(process.pid)["VmHWM"]
+            received = os.path.join(upload_dir, os.path.basename(path))
+            intact = file_digest(received) == expected
+            os.remove(received)
+            rows.append([chunk_size or "whole file", f"{size / 1e6 / elapsed:.1f}",
+                         f"{peak_rss:.1f}", "yes" if intact else "NO"])
+    print_table(["chunk size", "MB/s", "server peak RSS MB", "intact"], rows)
+
+
+async def measure_streams(process, port, streams, mode, args):
+    """Open `streams` senders as connections or as channels of one connection,
+    send args.messages on each; return (setup s, send s, server stats)."""
+    group = utils.DH_GROUP_NAMES.get(args.group)
+    multiplexed = mode == "channels"
+    start = time.perf_counter()
+    if multiplexed:
+        carrier = session.ClientSession("127.0.0.1", port, args.cipher_suites, group,
+                                        resumption=False, channels=streams + 1)
+        await carrier.connect()
+        senders = [await carrier.open_channel() for _ in range(streams)]
+        sessions = [carrier]
+    else:
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def connect():
+            async with semaphore:
+                sender = session.ClientSession("127.0.0.1", port, args.cipher_suites, group,
+                                               resumption=False)
+                await sender.connect()
+                return sender
+        senders = sessions = await asyncio.gather(*[connect() for _ in range(streams)])
+    setup = time.perf_counter() - start
+    stats = process_stats(process.pid)
+
+    message = "x" * args.message_size
+    start = time.perf_counter()
+    await asyncio.gather(*[sender.send_many([message] * args.messages) for sender in senders])
+    for sender in sessions:
+        await sender.drain_acknowledgements()
+        if sender.unacknowledged:
+            raise ConnectionError("connection closed before the messages were confirmed")
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*[sender.close() for sender in sessions])
+    return setup, elapsed, stats
+
+
+def bench_channels(args):
+    """Many connections against the channels of one connection.
+
+    Opens each of `--streams` senders either as its own connection, a full
+    handshake each, or as a channel of a single connection, one ChannelOpen
+    message each, then sends `--messages` messages on every sender. Shows
+    the setup time, the message rate and the server's memory and threads.
+    """
+    rows = []
+    for streams in args.streams:
+        for mode in ("connections", "channels"):
+            with running_server("--engine", args.engine) as (process, port):
+                baseline = process_stats(process.pid)
+                setup, elapsed, stats = asyncio.run(
+                    measure_streams(process, port, streams, mode, args))
+            rows.append([streams, mode, f"{setup * 1000:.0f}",
+                         f"{streams * args.messages / elapsed:.0f}",
+                         f"{stats['VmRSS'] - baseline['VmRSS']:.1f}", stats["Threads"]])
+    print_table(["streams", "as", "setup ms", "msgs/s", "server RSS +MB", "threads"], rows)
+
+
+async def measure_broadcast(process, port, metrics_port, stalled, args):
+    """Type `broadcast` args.rounds times to args.clients reading sessions and `stalled`
+    sessions that stopped reading; return the reading sessions' latencies from
+    the command to the copy received, and the server's counters."""
+    group = utils.DH_GROUP_NAMES.get(args.group)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def connect():
+        async with semaphore:
+            receiver = session.ClientSession("127.0.0.1", port, args.cipher_suites, group,
+                                             resumption=False)
+            await receiver.connect()
+            return receiver
+    receivers = await asyncio.gather(*(connect() for _ in range(args.clients)))
+    silent = await asyncio.gather(*(connect() for _ in range(stalled)))
+    for receiver in silent:
+        receiver.writer.transport.pause_reading() # the server's copies pile up in the socket
+    replies = {receiver: receiver.replies() for receiver in receivers}
+
+    async def received(receiver, tag, start):
+        async for reply in replies[receiver]:
+            text = utils.parse_broadcast(reply)
+            if text is not None and text.startswith(tag):
+                return time.perf_counter() - start
+        raise ConnectionError("connection closed before the broadcast arrived")
+
+    payload = "x" * args.message_size
+    latencies = []
+    for round in range(args.rounds):
+        start = time.perf_counter()
+        process.stdin.write(f"broadcast {round} {payload}\n".encode())
+        process.stdin.flush()
+        latencies += await asyncio.wait_for(
+            asyncio.gather(*(received(receiver, f"{round} ".encode(), start)
+                             for receiver in receivers)),
+            args.timeout)
+        await asyncio.sleep(args.interval) # the console waits for the stalled copies meanwhile
+    counters = await asyncio.to_thread(server_counters, metrics_port)
+    for receiver in silent:
+        receiver.writer.transport.abort()
+    await asyncio.gather(*(receiver.close() for receiver in receivers))
+    return latencies, counters
+
+
+def bench_broadcast(args):
+    """Delivery latency of `broadcast` with clients that stopped reading.
+
+    Connects `--clients` sessions that read and, for each of `--stalled`,
+    that many sessions that never read again, then types `broadcast` into
+    the server's console `--rounds` times. Shows how long the reading
+    clients waited for their copy and how many copies the server wrote or
+    dropped for the clients that fell behind.
+    """
+    rows = []
+    for engine in args.engines:
+        for stalled in args.stalled:
+            metrics_port = free_port()
+            with running_server("--engine", engine, "--metrics-port", str(metrics_port),
+                                *args.server_args.split()) as (process, port):
+                latencies, counters = asyncio.run(
+                    measure_broadcast(process, port, metrics_port, stalled, args))
+            rows.append([engine, args.clients, stalled,
+                         *(f"{percentile(latencies, f) * 1000:.1f}" for f in (0.5, 0.99, 1.0)),
+                         counters["broadcasts_delivered"], counters["broadcasts_dropped"]])
+    print_table(["engine", "reading", "stalled", "p50 ms", "p99 ms", "max ms", "delivered",
+                 "dropped"], rows)
+
+
+def bench_journal(args):
+    """Messages/s of the load scenario with the journal at different commit intervals.
+
+    Runs the load against a server without a journal, with `--journal` at
+    each `--commit-ms` interval, where every OK and ACK waits for the fsync
+    of the group commit holding its messages, and with --journal-no-sync.
+    The journal is written under `--directory`; on tmpfs fsync costs
+    nothing and the intervals do not differ.
+    """
+    modes = [("off", [])]
+    modes += [(f"{interval:g} ms", ["--journal-commit-ms", str(interval)])
+              for interval in args.commit_ms]
+    modes.append(("no sync", ["--journal-no-sync"]))
+    rows = []
+    for mode, journal_args in modes:
+        metrics_port = free_port()
+        with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+            if journal_args:
+                journal_args = ["--journal", directory, *journal_args]
+            with running_server("--engine", args.engine, "--metrics-port", str(metrics_port),
+                                *journal_args) as (_, port):
+                results = asyncio.run(run_load("127.0.0.1", port, args))
+                counters = server_counters(metrics_port)
+        commits = counters["journal_commits"]
+        rows.append([mode, f"{results['messages_per_s']:,.0f}", f"{results['rtt_p50_ms']:.1f}",
+                     f"{results['rtt_p99_ms']:.1f}", commits,
+                     f"{counters['journal_records'] / commits:.0f}" if commits else "-"])
+    print_table(["journal", "messages/s", "p50 ms", "p99 ms", "fsyncs", "records/fsync"], rows)
+
+
+def comma_separated_ints(value):
+    return [int(x) for x in value.split(",")]
+
+
+def add_load_arguments(parser):
+    """Arguments of the sessions driving the load and workers scenarios."""
+    parser.add_argument("--sessions", type=int, default=50,
+                        help="Concurrent sessions (default: %(default)s)")
+    parser.add_argument("--messages", type=int, default=200,
+                        help="Messages sent by each session (default: %(default)s)")
+    parser.add_argument("--message-size", type=int, default=1024,
+                        help="Characters per message (default: %(default)s)")
+    parser.add_argument("--pipeline", type=int, default=utils.DEFAULT_SEND_WINDOW,
+                        help=("Messages per session waiting for confirmation at once"
+                              " (default: %(default)s)"))
+    parser.add_argument("--ack-every", type=int, default=utils.DEFAULT_ACK_EVERY,
+                        help=("Frames per cumulative ACK, 0 asks for the OK per message"
+                              " (default: %(default)s)"))
+    parser.add_argument("--coalesce-delay-ms", type=int, default=utils.DEFAULT_COALESCE_DELAY_MS,
+                        help=("Max delay before batched messages are sent as one record,"
+                              " 0 sends a frame per message (default: %(default)s)"))
+    parser.add_argument("--group", choices=[*utils.DH_GROUP_NAMES, "custom"],
+                        default=utils.X25519.name, help="Key exchange group (default: %(default)s)")
+    parser.add_argument("--cipher-suites", type=utils.parse_cipher_suites,
+                        default=utils.DEFAULT_CIPHER_SUITES,
+                        help=("Offered cipher suites, in order of preference"
+                              f" (default: {DEFAULT_SUITES})"))
+    parser.add_argument("--engine", choices=utils.SERVER_ENGINES, default=utils.SERVER_ENGINES[0],
+                        help="Engine of the started server (default: %(default)s)")
+    # above the server's listen backlog of 5 handshakes start waiting for SYN retries
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Handshakes in flight at once (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=30.0,
+                        help="Seconds before a handshake counts as failed (default: %(default)s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the mini TLS server")
+    scenarios = parser.add_subparsers(dest="scenario", required=True)
+
+    engines = scenarios.add_parser("engines", help=bench_engines.__doc__)
+    engines.add_argument("--connections", type=comma_separated_ints, default=[100, 1000],
+                         help="Comma separated numbers of idle sessions (default: 100,1000)")
+    engines.add_argument("--concurrency", type=int, default=100,
+                         help="Sessions opened at the same time (default: %(default)s)")
+    engines.add_argument("--timeout", type=float, default=5.0,
+                         help="Seconds before a handshake counts as failed (default: %(default)s)")
+    engines.add_argument("--address-space-mb", type=int, default=None,
+                         help="RLIMIT_AS for the server process, emulates a memory budget")
+    engines.set_defaults(func=bench_engines)
+
+    shutdown = scenarios.add_parser("shutdown", help=bench_shutdown.__doc__)
+    shutdown.add_argument("--connections", type=comma_separated_ints, default=[10, 100, 1000],
+                          help="Comma separated numbers of open sessions (default: 10,100,1000)")
+    shutdown.add_argument("--silent", type=int, default=2,
+                          help="Extra clients that never send ClientHello (default: %(default)s)")
+    shutdown.add_argument("--concurrency", type=int, default=4,
+                          help="Sessions opened at the same time (default: %(default)s)")
+    shutdown.add_argument("--timeout", type=float, default=5.0,
+                          help="Seconds before a handshake counts as failed (default: %(default)s)")
+    shutdown.add_argument("--wait", type=float, default=60.0,
+                          help="Seconds to wait for the server to exit (default: %(default)s)")
+    shutdown.set_defaults(func=bench_shutdown)
+
+    flood = scenarios.add_parser("flood", help=bench_flood.__doc__)
+    flood.add_argument("--modes", type=lambda value: value.split(","),
+                       default=["oversized", "pipelined"],
+                       help="Comma separated flood modes (default: oversized,pipelined)")
+    flood.add_argument("--sessions", type=int, default=4,
+                       help="Flooding sessions (default: %(default)s)")
+    flood.add_argument("--duration", type=float, default=5.0,
+                       help="Seconds of flooding (default: %(default)s)")
+    flood.add_argument("--claimed-megabytes", type=int, default=256,
+                       help="Frame size announced in oversized mode (default: %(default)s)")
+    flood.add_argument("--message-size", type=int, default=1024,
+                       help="Characters per pipelined message (default: %(default)s)")
+    flood.add_argument("--engine", choices=utils.SERVER_ENGINES, default=utils.SERVER_ENGINES[0],
+                       help="Server engine (default: %(default)s)")
+    flood.add_argument("--server-args", default="",
+                       help="Extra server.py arguments, e.g. \"--max-frames-per-second 1000\"")
+    flood.set_defaults(func=bench_flood)
+
+    reaper = scenarios.add_parser("reaper", help=bench_reaper.__doc__)
+    reaper.add_argument("--stalled", type=int, default=5000,
+                        help="Stalled connections, spread over the kinds (default: %(default)s)")
+    reaper.add_argument("--kinds", type=lambda value: value.split(","),
+                        default=["silent", "idle", "partial"],
+                        help="Comma separated ways to stall (default: silent,idle,partial)")
+    reaper.add_argument("--deadline", type=float, default=5.0,
+                        help="Server handshake, idle and frame timeout (default: %(default)s)")
+    reaper.add_argument("--steady", type=int, default=4,
+                        help="Sessions pinging the server meanwhile (default: %(default)s)")
+    reaper.add_argument("--idle", type=float, default=2.0,
+                        help="Seconds of pinging before the stalls (default: %(default)s)")
+    reaper.add_argument("--concurrency", type=int, default=4,
+                        help="Connections opened at the same time (default: %(default)s)")
+    reaper.add_argument("--timeout", type=float, default=5.0,
+                        help="Seconds before a handshake counts as failed (default: %(default)s)")
+    reaper.add_argument("--wait", type=float, default=30.0,
+                        help="Seconds past the deadline before a connection counts as not"
+                             " closed (default: %(default)s)")
+    reaper.set_defaults(func=bench_reaper)
+
+    framing = scenarios.add_parser("framing", help=bench_framing.__doc__)
+    framing.add_argument("--payload-sizes", type=comma_separated_ints, default=[64, 1024 * 1024],
+                         help="Comma separated ciphertext sizes in bytes (default: 64,1048576)")
+    framing.add_argument("--megabytes", type=int, default=256,
+                         help="Data streamed per measurement (default: %(default)s)")
+    framing.set_defaults(func=bench_framing)
+
+    suites = scenarios.add_parser("suites", help=bench_suites.__doc__)
+    suites.add_argument("--payload-sizes", type=comma_separated_ints,
+                        default=[64, 1024, 64 * 1024, 1024 * 1024],
+                        help="Comma separated message sizes in bytes"
+                             " (default: 64,1024,65536,1048576)")
+    suites.add_argument("--megabytes", type=int, default=64,
+                        help="Data encrypted per measurement (default: %(default)s)")
+    suites.set_defaults(func=bench_suites)
+
+    copies = scenarios.add_parser("copies", help=bench_copies.__doc__)
+    copies.add_argument("--payload-sizes", type=comma_separated_ints,
+                        default=[64, 16 * 1024, 1024 * 1024],
+                        help="Payload sizes in bytes (default: 64,16384,1048576)")
+    copies.add_argument("--megabytes", type=int, default=64,
+                        help="Payload megabytes timed per path (default: %(default)s)")
+    copies.set_defaults(func=bench_copies)
+
+    gather = scenarios.add_parser("gather", help=bench_gather.__doc__)
+    gather.add_argument("--payload-sizes", type=comma_separated_ints,
+                        default=[1024, 16 * 1024, 64 * 1024, 1024 * 1024],
+                        help="Payload sizes in bytes (default: 1024,16384,65536,1048576)")
+    gather.add_argument("--megabytes", type=int, default=64,
+                        help="Payload megabytes sent per variant (default: %(default)s)")
+    gather.set_defaults(func=bench_gather)
+
+    resumption = scenarios.add_parser("resumption", help=bench_resumption.__doc__)
+    resumption.add_argument("--reconnects", type=int, default=200,
+                            help="Reconnects per measurement (default: %(default)s)")
+    resumption.add_argument("--dh-group", choices=[*utils.DH_GROUP_NAMES, "custom"],
+                            default=utils.MODP_2048.name)
+    resumption.set_defaults(func=bench_resumption)
+
+    handshakes = scenarios.add_parser("handshakes", help=bench_handshakes.__doc__)
+    handshakes.add_argument("--groups", type=lambda value: value.split(","),
+                            default=[*utils.DH_GROUP_NAMES, "custom"],
+                            help="Comma separated groups "
+                                 "(default: modp2048,modp3072,x25519,custom)")
+    handshakes.add_argument("--handshakes", type=int, default=200,
+                            help="Sequential handshakes per measurement (default: %(default)s)")
+    handshakes.add_argument("--warmup", type=float, default=1.0,
+                            help="Seconds to let the server fill its pool (default: %(default)s)")
+    handshakes.set_defaults(func=bench_handshakes)
+
+    keyexchange = scenarios.add_parser("keyexchange", help=bench_keyexchange.__doc__)
+    keyexchange.add_argument("--groups", type=lambda value: value.split(","),
+                             default=list(utils.DH_GROUP_NAMES),
+                             help="Comma separated groups (default: modp2048,modp3072,x25519)")
+    keyexchange.add_argument("--exchanges", type=int, default=100,
+                             help="Key exchanges per group (default: %(default)s)")
+    keyexchange.set_defaults(func=bench_keyexchange)
+
+    storm = scenarios.add_parser("storm", help=bench_storm.__doc__)
+    storm.add_argument("--workers", type=comma_separated_ints, default=[0, 2],
+                       help="Comma separated --handshake-workers values (default: 0,2)")
+    storm.add_argument("--engine", choices=utils.SERVER_ENGINES, default=utils.SERVER_ENGINES[0],
+                       help="Server engine (default: %(default)s)")
+    storm.add_argument("--group", choices=list(utils.DH_GROUP_NAMES), default=utils.MODP_3072.name,
+                       help="Group of the storm handshakes (default: %(default)s)")
+    storm.add_argument("--steady", type=int, default=10,
+                       help="Connected sessions measuring latency (default: %(default)s)")
+    storm.add_argument("--handshakes", type=int, default=300,
+                       help="Handshakes in the storm (default: %(default)s)")
+    storm.add_argument("--concurrency", type=int, default=20,
+                       help="Storm handshakes in flight at once (default: %(default)s)")
+    storm.add_argument("--idle", type=float, default=2.0,
+                       help=("Seconds of latency measurement before the storm"
+                             " (default: %(default)s)"))
+    storm.add_argument("--timeout", type=float, default=30.0,
+                       help="Seconds before a handshake counts as failed (default: %(default)s)")
+    storm.set_defaults(func=bench_storm)
+
+    admission = scenarios.add_parser("admission", help=bench_admission.__doc__)
+    admission.add_argument("--limits", type=lambda value: value.split(";"),
+                           default=["", "--ip-handshake-rate 20", "--handshake-rate 20",
+                                    "--max-pending-handshakes 2"],
+                           help=("\";\" separated server.py arguments to compare (default: none,"
+                                 " then each kind of limit)"))
+    admission.add_argument("--engine", choices=utils.SERVER_ENGINES,
+                           default=utils.SERVER_ENGINES[0],
+                           help="Server engine (default: %(default)s)")
+    admission.add_argument("--group", choices=list(utils.DH_GROUP_NAMES),
+                           default=utils.MODP_3072.name,
+                           help="Group of the handshakes (default: %(default)s)")
+    admission.add_argument("--flood-address", default="127.0.0.2",
+                           help="Loopback source address of the flood (default: %(default)s)")
+    admission.add_argument("--concurrency", type=int, default=20,
+                           help="Flood connections in flight at once (default: %(default)s)")
+    admission.add_argument("--steady", type=int, default=4,
+                           help="Established sessions measuring latency (default: %(default)s)")
+    admission.add_argument("--interval", type=float, default=0.2,
+                           help="Seconds between the regular client's handshakes"
+                                " (default: %(default)s)")
+    admission.add_argument("--duration", type=float, default=10.0,
+                           help="Seconds of flood (default: %(default)s)")
+    admission.add_argument("--timeout", type=float, default=10.0,
+                           help=("Seconds before a handshake counts as failed"
+                                 " (default: %(default)s)"))
+    admission.set_defaults(func=bench_admission)
+
+    logging = scenarios.add_parser("logging", help=bench_logging.__doc__)
+    logging.add_argument("--engine", choices=utils.SERVER_ENGINES, default=utils.SERVER_ENGINES[0],
+                         help="Server engine (default: %(default)s)")
+    logging.add_argument("--sessions", type=int, default=10,
+                         help="Sessions sending messages (default: %(default)s)")
+    logging.add_argument("--duration", type=float, default=5.0,
+                         help="Seconds of sending per measurement (default: %(default)s)")
+    logging.add_argument("--message-size", type=int, default=1024,
+                         help="Ciphertext bytes formatted by a log call (default: %(default)s)")
+    logging.add_argument("--calls", type=int, default=100_000,
+                         help="Log calls timed per variant (default: %(default)s)")
+    logging.add_argument("--timeout", type=float, default=5.0,
+                         help="Seconds before a handshake counts as failed (default: %(default)s)")
+    logging.set_defaults(func=bench_logging)
+
+    metrics_parser = scenarios.add_parser("metrics", help=bench_metrics.__doc__)
+    metrics_parser.add_argument("--calls", type=int, default=1_000_000,
+                                help="Calls timed per variant (default: %(default)s)")
+    metrics_parser.set_defaults(func=bench_metrics)
+
+    load = scenarios.add_parser("load", help=bench_load.__doc__)
+    add_load_arguments(load)
+    load.add_argument("--host", default=utils.DEFAULT_HOST_CLIENT,
+                      help="Host of the server given with --port (default: %(default)s)")
+    load.add_argument("--port", type=int, default=None,
+                      help="Load an already running server instead of starting one")
+    load.add_argument("--json", metavar="PATH", default=None,
+                      help="Also write parameters, commit and results as JSON to PATH")
+    load.set_defaults(func=bench_load)
+
+    workers = scenarios.add_parser("workers", help=bench_workers.__doc__)
+    add_load_arguments(workers)
+    workers.add_argument("--workers", type=comma_separated_ints, default=[0, 1, 2, 4],
+                         help="Comma separated --workers values of the server (default: 0,1,2,4)")
+    workers.add_argument("--client-processes", type=int, default=os.cpu_count(),
+                         help="Processes generating the load (default: CPU count, %(default)s)")
+    workers.set_defaults(func=bench_workers)
+
+    transfer = scenarios.add_parser("transfer", help=bench_transfer.__doc__)
+    transfer.add_argument("--megabytes", type=int, default=64,
+                          help="Size of the transferred file in MiB (default: %(default)s)")
+    transfer.add_argument("--chunk-sizes", type=comma_separated_ints,
+                          default=[16 * 1024, utils.DEFAULT_CHUNK_SIZE, 1024 * 1024, 0],
+                          help=("Chunk sizes to compare, 0 sends the whole file as one message"
+                                " (default: 16384,65536,1048576,0)"))
+    transfer.add_argument("--coalesce-delay-ms", type=int,
+                          default=utils.DEFAULT_COALESCE_DELAY_MS,
+                          help=("Max delay before batched messages are sent as one record,"
+                                " 0 sends a frame per message (default: %(default)s)"))
+    transfer.add_argument("--group", choices=list(utils.DH_GROUP_NAMES),
+                          default=utils.X25519.name, help="Key exchange group (default: %(default)s)")
+    transfer.add_argument("--cipher-suites", type=utils.parse_cipher_suites,
+                          default=utils.DEFAULT_CIPHER_SUITES,
+                          help=("Offered cipher suites, in order of preference"
+                                f" (default: {DEFAULT_SUITES})"))
+    transfer.add_argument("--engine", choices=utils.SERVER_ENGINES,
+                          default=utils.SERVER_ENGINES[0],
+                          help="Engine of the started server (default: %(default)s)")
+    transfer.set_defaults(func=bench_transfer)
+
+    channels = scenarios.add_parser("channels", help=bench_channels.__doc__)
+    channels.add_argument("--streams", type=comma_separated_ints, default=[10, 100, 500],
+                          help="Senders to compare (default: 10,100,500)")
+    channels.add_argument("--messages", type=int, default=100,
+                          help="Messages sent by each sender (default: %(default)s)")
+    channels.add_argument("--message-size", type=int, default=256,
+                          help="Characters per message (default: %(default)s)")
+    channels.add_argument("--group", choices=list(utils.DH_GROUP_NAMES),
+                          default=utils.X25519.name,
+                          help="Key exchange group (default: %(default)s)")
+    channels.add_argument("--cipher-suites", type=utils.parse_cipher_suites,
+                          default=utils.DEFAULT_CIPHER_SUITES,
+                          help=("Offered cipher suites, in order of preference"
+                                f" (default: {DEFAULT_SUITES})"))
+    channels.add_argument("--engine", choices=utils.SERVER_ENGINES,
+                          default=utils.SERVER_ENGINES[0],
+                          help="Engine of the started server (default: %(default)s)")
+    channels.add_argument("--concurrency", type=int, default=4,
+                          help="Handshakes in flight at once (default: %(default)s)")
+    channels.set_defaults(func=bench_channels)
+
+    broadcast = scenarios.add_parser("broadcast", help=bench_broadcast.__doc__)
+    broadcast.add_argument("--clients", type=int, default=100,
+                           help="Sessions reading the broadcasts (default: %(default)s)")
+    broadcast.add_argument("--stalled", type=comma_separated_ints, default=[0, 50],
+                           help="Sessions that never read, to compare (default: 0,50)")
+    broadcast.add_argument("--rounds", type=int, default=20,
+                           help="Broadcasts per server (default: %(default)s)")
+    broadcast.add_argument("--message-size", type=int, default=16 * 1024,
+                           help="Characters per broadcast (default: %(default)s)")
+    broadcast.add_argument("--interval", type=float, default=1.2,
+                           help="Seconds between broadcasts (default: %(default)s)")
+    broadcast.add_argument("--engines", type=lambda value: value.split(","),
+                           default=list(utils.SERVER_ENGINES),
+                           help="Server engines to compare (default: threads,asyncio)")
+    broadcast.add_argument("--server-args", default="",
+                           help="Extra server.py arguments, e.g. \"--workers 2\"")
+    broadcast.add_argument("--group", choices=list(utils.DH_GROUP_NAMES),
+                           default=utils.X25519.name,
+                           help="Key exchange group (default: %(default)s)")
+    broadcast.add_argument("--cipher-suites", type=utils.parse_cipher_suites,
+                           default=utils.DEFAULT_CIPHER_SUITES,
+                           help=("Offered cipher suites, in order of preference"
+                                 f" (default: {DEFAULT_SUITES})"))
+    broadcast.add_argument("--concurrency", type=int, default=4,
+                           help="Handshakes in flight at once (default: %(default)s)")
+    broadcast.add_argument("--timeout", type=float, default=30.0,
+                           help="Seconds a round may take (default: %(default)s)")
+    broadcast.set_defaults(func=bench_broadcast)
+
+    journal = scenarios.add_parser("journal", help=bench_journal.__doc__)
+    add_load_arguments(journal)
+    journal.add_argument("--commit-ms", type=lambda value: [float(x) for x in value.split(",")],
+                         default=[0, 1, 5, 20],
+                         help="--journal-commit-ms values to compare (default: 0,1,5,20)")
+    journal.add_argument("--directory", default=PROJECT_DIR,
+                         help="Where the journals are written (default: this directory)")
+    journal.set_defaults(func=bench_journal)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,102 +1,167 @@
 from typing import Optional, Callable
-import socket
-import struct
+import asyncio
 import os
+import socket
 import sys
 import utils
+from metrics import Metrics
+from session import ClientSession, send_lines
 import threading
 import time
 
 
 class ServerListener(threading.Thread):
-    def __init__(self, client_socket: socket.socket, printer: utils.ThreadPrinter,
-                 symmetric_key, close_connection_callback: Callable[[], None],
-                 notify_and_disconnect_callback: Callable[[], None]):
+    def __init__(self, frame_reader: utils.FrameReader, log: utils.Logger,
+                 cipher, close_connection_callback: Callable[[], None],
+                 notify_and_disconnect_callback: Callable[[], None], metrics: Metrics = None,
+                 coalesced=False):
         super().__init__()
-        self.client_socket = client_socket
-        self.printer = printer
+        self.frame_reader = frame_reader
+        self.log = log
         self.stop_event = threading.Event()
-        self.symmetric_key = symmetric_key
+        self.cipher = cipher
         self.close_connection_callback = close_connection_callback
         self.notify_and_disconnect_callback = notify_and_disconnect_callback
-
-    def print(self, *args, **kwargs):
-        self.printer.print(*args, **kwargs)
+        self.metrics = metrics or Metrics()
+        self.coalesced = coalesced
 
     def stop(self):
         self.stop_event.set()
 
+    def handle_message(self, decrypted_message):
+        decrypted_message = bytes(decrypted_message)
+        self.log.info("Received text: {!t}", decrypted_message)
+
+        if decrypted_message == utils.ServerMessages.OK.encode():
+            self.log.info("[From Server] Message authenticity verified successfully.")
+        elif decrypted_message == utils.ServerMessages.FAIL.encode():
+            self.notify_and_disconnect_callback()
+            self.log.info("[From Server] Message authenticity verification failed.")
+            self.stop_event.set()
+        elif decrypted_message == utils.ServerMessages.END_SESSION.encode():
+            self.close_connection_callback()
+            self.log.info("[From Server] Session ended by server. Disconnecting...")
+            self.stop_event.set()
+        elif (text := utils.parse_broadcast(decrypted_message)) is not None:
+            self.log.info("[From Server] Broadcast: {!t}", text)
+        else:
+            self.log.info("[From Server] Unknown message: {!t}", decrypted_message)
+
     def run(self):
         """Processes server messages. Activated after completing key exchange."""
+        stats = self.metrics.shard()
+        frame_overhead = 4 + self.cipher.iv_size + self.cipher.mac_size
         try:
             while not self.stop_event.is_set():
-                message_size_data = utils.receive_data(self.client_socket, 4)
-                message_size = struct.unpack("!I", message_size_data)[0]
-                iv = utils.receive_data(self.client_socket, utils.AES_BLOCK_SIZE)  # 16B
-                ciphertext = utils.receive_data(self.client_socket, message_size)
-                mac = utils.receive_data(self.client_socket, 32)  # 32B
-
-                calculated_mac = utils.calculate_hmac(ciphertext, self.symmetric_key)
-                if mac != calculated_mac:
-                    self.print("Authentication failed - something is wrong with the server")
-                    self.print("MAC received: ", mac, "\nMAC calculated: ", calculated_mac)
+                self.frame_reader.fill(4) # idle until the next frame starts, not timed
+                started = time.perf_counter()
+                iv, ciphertext, mac = self.frame_reader.read_frame(self.cipher.iv_size,
+                                                                   self.cipher.mac_size)
+                read = time.perf_counter()
+                stats.observe("recv", read - started)
+                stats.add("frames_in")
+                stats.add("bytes_in", frame_overhead + len(ciphertext))
+
+                try:
+                    self.cipher.verify(iv, ciphertext, mac)
+                    verified = time.perf_counter()
+                    stats.observe("verify", verified - read)
+                    if self.coalesced:
+                        messages = utils.unpack_record(
+                            self.cipher.decrypt_verified_bytes(iv, ciphertext, mac))
+                    else:
+                        messages = [self.cipher.decrypt_verified_bytes(iv, ciphertext, mac)]
+                    stats.observe("decrypt", time.perf_counter() - verified)
+                except utils.AuthenticationError as e:
+                    stats.add("mac_failures")
+                    self.log.error("Authentication failed - something is wrong with the server: {}",
+                                   e)
+                    self.log.error("MAC received: {!h}", bytes(mac))
                     self.notify_and_disconnect_callback()
 
                     return
-
-                decrypted_message = utils.aes_cbc_decrypt(iv, ciphertext, self.symmetric_key)
-                self.print(f"Received text: {decrypted_message}")
-
-                if decrypted_message == utils.ServerMessages.OK:
-                    self.print("[From Server] Message authenticity verified successfully.")
-                elif decrypted_message == utils.ServerMessages.FAIL:
+                except ValueError as e:
+                    stats.add("record_errors")
+                    self.log.error("Malformed record from the server: {}", e)
                     self.notify_and_disconnect_callback()
-                    self.print("[From Server] Message authenticity verification failed.")
-                    self.stop_event.set()
-                elif decrypted_message == utils.ServerMessages.END_SESSION:
-                    self.close_connection_callback()
-                    self.print("[From Server] Session ended by server. Disconnecting...")
-                    self.stop_event.set()
-                else:
-                    self.print(f"[From Server] Unknown message: {decrypted_message}")
+                    return
+
+                for decrypted_message in messages:
+                    self.handle_message(decrypted_message)
+                    if self.stop_event.is_set():
+                        break
         except Exception as e:
-            self.print(f"Caught Error in ServerListener: {e}")
+            self.log.error("Caught Error in ServerListener: {}", e)
         finally:
-            self.print("ServerListener stopped.")
+            self.metrics.retire()
+            self.log.info("ServerListener stopped.")
 
 
 class DiffieHellmanClient:
-    def __init__(self, host, port, verbose, g, p):
+    def __init__(self, host, port, verbose, g, p,
+                 cipher_suites=utils.DEFAULT_CIPHER_SUITES, resumption=True,
+                 log: Optional[utils.Logger] = None,
+                 dh_group: Optional[utils.DHGroup] = None, log_file=None,
+                 record_size=utils.DEFAULT_RECORD_SIZE, coalesce_delay_ms=0):
         self.host = host
         self.port = port
+        self.dh_group = dh_group
         self.g = g
         self.p = p
+        self.cipher_suites = cipher_suites
+        self.resumption = resumption
+        self.session_ticket = None
+        self.resumption_secret = None
+        self.resumed = False
         self.client_socket = None
         self.connected = False
-        self.verbose = verbose
-        self.printer = utils.ThreadPrinter()
-        self.printer.start()
+        self.owns_log = log is None
+        if log is None:
+            self.console, self.log = utils.start_loggers(verbose, log_file)
+        else:
+            self.console = self.log = log
+        self.metrics = Metrics()
         self.server_listener: Optional[ServerListener] = None
+        # coalescing is offered with a delay, record_size is what the server agreed to
+        self.offered_record_size = record_size if coalesce_delay_ms else None
+        self.coalesce_delay = coalesce_delay_ms / 1000
+        self.record_size = None
+        self.transfers = False # the server told file messages apart by their MessageKind
+        self.batch = utils.RecordBuilder(record_size)
+        self.batch_lock = threading.Lock()
+        self.batch_started = threading.Condition(self.batch_lock)
+        self.flush_deadline = None # monotonic time the pending batch is sent by
+        self.frame_writer: Optional[utils.FrameWriter] = None
+        # the console, the flusher and the listener (EndSession on FAIL) all send
+        self.send_lock = threading.Lock()
+        self.stopped = False
+        if self.coalesce_delay:
+            # one thread sends every batch when its delay runs out, not a timer per record
+            threading.Thread(target=self.flush_when_due, name="flusher", daemon=True).start()
 
     def stop(self):
         self.notify_and_dissconnect()
+        with self.batch_lock:
+            self.stopped = True
+            self.batch_started.notify()
         if self.server_listener:
             self.server_listener.stop()
             self.server_listener.join()
-        if self.printer:
-            self.printer.stop()
-            self.printer.join()
+        if self.owns_log:
+            utils.stop_loggers(self.console, self.log)
 
-    def print(self, *args, **kwargs):
-        self.printer.print(*args, **kwargs)
+    def print(self, message=""):
+        self.console.info(message)
 
-    def print_if_verbose(self, *args, **kwargs):
-        if self.verbose:
-            self.print(*args, **kwargs)
+    def generate_keys(self):
+        if self.dh_group:
+            self.private_key, self.public_key = self.dh_group.generate_keypair()
+        else:
+            self.private_key = utils.generate_private_key()
+            self.public_key = utils.calculate_public_key(self.g, self.private_key, self.p)
 
     def start(self):
-        self.private_key = utils.generate_private_key()
-        self.public_key = utils.calculate_public_key(self.g, self.private_key, self.p)
+        self.generate_keys()
 
         try:
             self.handle_input()
@@ -107,42 +172,71 @@ class DiffieHellmanClient:
             self.print("Client shut down\n")
 
     def perform_key_exchange(self, private_key, public_key):
-        hello_message = struct.pack("!11sIII", b"ClientHello",
-                                    public_key, self.p, self.g)
-        self.client_socket.sendall(hello_message)
-        self.print_if_verbose(f"[V] Sent ClientHello with A={public_key}, p={self.p}, g={self.g}")
-
-        server_hello = utils.receive_data(self.client_socket, 15)  # 11 + 4
-        server_hello_msg, server_public_key = struct.unpack("!11sI", server_hello)
-
-        self.print_if_verbose(f"[V] Received ServerHello with msg={server_hello_msg.decode()}")
-        self.print_if_verbose(f"[V] Received ServerHello with B={server_public_key}")
-
-        shared_key = utils.calculate_shared_secret(server_public_key, private_key, self.p)
-        symmetric_key = utils.derive_symmetric_key(shared_key)
-
-        self.print_if_verbose(f"[V] Shared key K computed: {shared_key}")
-        self.print_if_verbose(f"[V] Symmetric key derived: {symmetric_key.hex()}")
-
-        return symmetric_key
+        ticket = self.session_ticket if self.resumption else None
+        handshake = utils.ClientHandshake(private_key, public_key, self.cipher_suites,
+                                          self.dh_group, self.p, self.g,
+                                          ticket, self.resumption_secret,
+                                          record_size=self.offered_record_size,
+                                          transfers=True)
+        self.client_socket.sendall(handshake.client_hello())
+        self.log.verbose("Sent ClientHello with A={!h}, {}, cipher suites={}, ticket={}",
+                         public_key, handshake.describe_group(),
+                         [suite.name for suite in self.cipher_suites], ticket is not None)
+
+        hello_type, body = utils.receive_server_hello(self.frame_reader.receive_data)
+        cipher = handshake.complete(hello_type, body)
+
+        self.log.verbose("Received ServerHello with msg={}", hello_type.decode())
+        self.resumed = handshake.resumed
+        if self.resumed:
+            self.log.verbose("Session resumed from ticket, cipher suite={}",
+                             handshake.cipher_suite.name)
+        else:
+            self.log.verbose("Received ServerHello with B={!h} cipher suite={}",
+                             handshake.server_public_key, handshake.cipher_suite.name)
+            self.log.verbose("Shared key K computed: {!h}", handshake.shared_key)
+        self.log.verbose("Symmetric key derived: {!h}", handshake.symmetric_key)
+
+        self.session_ticket = handshake.session_ticket
+        self.resumption_secret = handshake.resumption_secret
+        self.record_size = handshake.record_size
+        self.transfers = handshake.transfers
+        if self.record_size:
+            self.log.verbose("Coalescing messages into records of up to {} bytes",
+                             self.record_size)
+        return cipher
 
     def connect(self):
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.settimeout(None) # continuous listenening for messages
-            self.print(f"Connecting to server at {self.host}:{self.port}...")
+            self.log.info("Connecting to server at {}:{}...", self.host, self.port)
             self.client_socket.connect((self.host, self.port))
-
-            self.symmetric_key = self.perform_key_exchange(self.private_key, self.public_key)
-            self.print("Successfully connected to the server")
+            self.frame_reader = utils.FrameReader(self.client_socket)
+
+            start = time.perf_counter()
+            try:
+                self.cipher = self.perform_key_exchange(self.private_key, self.public_key)
+                self.frame_writer = utils.FrameWriter(self.cipher)
+            except Exception:
+                self.metrics.shard().add("handshake_errors")
+                raise
+            self.batch = utils.RecordBuilder(self.record_size or utils.DEFAULT_RECORD_SIZE)
+            stats = self.metrics.shard()
+            stats.observe("handshake", time.perf_counter() - start)
+            stats.add("handshakes")
+            if self.resumed:
+                stats.add("handshakes_resumed")
+            self.log.info("Successfully connected to the server")
             self.connected = True
 
-            self.server_listener = ServerListener(self.client_socket, self.printer,
-                                                  self.symmetric_key, self.close_connection,
-                                                  self.notify_and_dissconnect)
+            self.server_listener = ServerListener(self.frame_reader, self.log,
+                                                  self.cipher, self.close_connection,
+                                                  self.notify_and_dissconnect, self.metrics,
+                                                  coalesced=self.record_size is not None)
             self.server_listener.start()
         except Exception as e:
-            self.print(f"Caught Connection Error: {e}")
+            self.log.error("Caught Connection Error: {}", e)
 
     def close_connection(self):
         self.client_socket.close()
@@ -151,47 +245,107 @@ class DiffieHellmanClient:
     def notify_and_dissconnect(self):
         if self.connected:
             self.send_message(utils.ServerMessages.END_SESSION) # notify server
+            self.flush_batch()
             time.sleep(0.1) # give server time to read the message
             self.close_connection()
-            self.print("Notififed server and disconnected")
+            self.log.info("Notififed server and disconnected")
         else:
-            self.print("Client disconnected...")
-
-
-
-
-    def send_message(self, message):
-        try:
-            self.print(f"Sending: {message}")
+            self.log.info("Client disconnected...")
 
-            iv = os.urandom(utils.AES_BLOCK_SIZE) # random 16B
 
-            ciphertext = utils.aes_cbc_encrypt(iv, message, self.symmetric_key)
-            message_size = struct.pack("!I", len(ciphertext))
 
-            mac = utils.calculate_hmac(ciphertext, self.symmetric_key) # 32B
-            final_message = message_size + iv + ciphertext + mac
 
-            self.print_if_verbose(f"[V] Sent text (length: {len(ciphertext)}): {ciphertext.hex()}")
-            self.print_if_verbose(f"[V] Sent IV: {iv.hex()}")
-            self.print_if_verbose(f"[V] Sent MAC: {mac.hex()}")
+    def send_message(self, message, kind=utils.MessageKind.TEXT):
+        """Send a message, or batch it into the next record when coalescing."""
+        if isinstance(message, bytes):
+            self.log.verbose("Sending {} bytes", len(message))
+        else:
+            self.log.info("Sending: {}", message)
+        if self.transfers:
+            message = utils.pack_kind(kind, message)
+        if not self.record_size:
+            self.send_frame(message)
+            return
+        with self.batch_lock:
+            if self.batch.add(message):
+                self.send_batch()
+            elif self.flush_deadline is None:
+                self.flush_deadline = time.monotonic() + self.coalesce_delay
+                self.batch_started.notify()
+
+    def flush_batch(self):
+        """Send the batched messages as one record."""
+        with self.batch_lock:
+            self.send_batch()
+
+    def send_batch(self):
+        """flush_batch() for a caller holding batch_lock."""
+        self.flush_deadline = None
+        messages = self.batch.take()
+        if messages and self.connected:
+            self.send_frame(utils.pack_record(messages))
+
+    def flush_when_due(self):
+        """Flusher thread: send each batch once its coalescing delay runs out."""
+        with self.batch_lock:
+            while not self.stopped:
+                if self.flush_deadline is None:
+                    self.batch_started.wait()
+                    continue
+                remaining = self.flush_deadline - time.monotonic()
+                if remaining > 0:
+                    self.batch_started.wait(remaining)
+                else:
+                    self.send_batch()
 
-            self.client_socket.sendall(final_message)
+    def send_frame(self, message):
+        try:
+            start = time.perf_counter()
+            with self.send_lock:
+                parts = self.frame_writer.parts(message)
+                if self.log.is_enabled(utils.LogLevel.VERBOSE):
+                    # the frame buffer is reused, the log formats it later
+                    self.log.verbose("Sent frame (length: {}): {!h}", sum(map(len, parts)),
+                                     b"".join(parts))
+                utils.send_buffers(self.client_socket, parts)
+            stats = self.metrics.shard()
+            stats.observe("send", time.perf_counter() - start)
+            stats.add("frames_out")
+            stats.add("bytes_out", sum(map(len, parts)))
 
         except ConnectionError:
-            self.print("Caught Error: lost connection to the server")
+            self.log.error("Caught Error: lost connection to the server")
             self.connected = False
         except Exception as e:
-            self.print(f"Caught Error while sending the message to server: {e}")
+            self.log.error("Caught Error while sending the message to server: {}", e)
             self.connected = False
             raise e
 
+    def send_file(self, path):
+        """Stream a file to the server chunk by chunk, so memory stays flat for any size."""
+        if not self.transfers:
+            self.print("The server does not support file transfers")
+            return
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        for kind, message in utils.file_messages(path):
+            if not self.connected:
+                self.print(f"Connection lost while sending {path}")
+                return
+            self.send_message(message, kind)
+        self.flush_batch()
+        elapsed = time.perf_counter() - start
+        self.print(f"Sent {path}: {size / 1e6:.1f} MB in {elapsed:.2f} s, "
+                   f"{size / 1e6 / max(elapsed, 1e-9):.1f} MB/s")
+
     def print_commands(self):
         self.print("Commands:")
         self.print("---------------------")
         self.print("help")
         self.print("connect")
         self.print("send <message content>")
+        self.print("sendfile <path>")
+        self.print("stats")
         self.print("end_connection")
         self.print("shutdown")
         self.print("---------------------")
@@ -215,6 +369,16 @@ class DiffieHellmanClient:
                     self.print("Send required message paramter! (send <message content>)")
                 else:
                     self.send_message(input_args[1].strip())
+            elif command == "sendfile":
+                if (not self.connected):
+                    self.print("Server not connected! Use 'connect' command")
+                elif len(input_args) < 2 or not os.path.isfile(input_args[1].strip()):
+                    self.print("Sendfile requires a path to a file! (sendfile <path>)")
+                else:
+                    self.send_file(input_args[1].strip())
+            elif command == "stats":
+                for line in self.metrics.format_stats():
+                    self.print(line)
             elif command == "end_connection":
                 if (not self.connected):
                     self.print("Server not connected!  Use 'connect' command")
@@ -228,7 +392,36 @@ class DiffieHellmanClient:
             else:
                 self.print(f"Command \"{command}\" not found")
 
+def run_bulk(args):
+    """Non-interactive mode: stream the lines of --bulk into one session."""
+    log = utils.start_logger(args.verbose, sys.stderr, prompt=None)
+    session = ClientSession(args.host, args.port, args.cipher_suites,
+                            utils.DH_GROUP_NAMES.get(args.dh_group), 23, 5, args.resumption,
+                            log, window=args.window, ack_every=args.ack_every,
+                            record_size=args.record_size,
+                            coalesce_delay_ms=args.coalesce_delay_ms)
+    source = sys.stdin if args.bulk == "-" else open(args.bulk)
+    start = time.perf_counter()
+    try:
+        sent = asyncio.run(send_lines(session, source, args.bulk_retries))
+        elapsed = time.perf_counter() - start
+        log.info("Sent {} lines in {:.2f} s ({:.1f} lines/s)", sent, elapsed, sent / elapsed)
+    except ConnectionError as e:
+        log.error("Bulk send failed: {}", e)
+        return 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        utils.stop_loggers(log)
+    return 0
+
 if __name__ == "__main__":
-    port, host, verbose = utils.process_args("client")
-    client = DiffieHellmanClient(host, port, verbose, 5, 23)
+    args = utils.process_args("client")
+    if args.bulk:
+        sys.exit(run_bulk(args))
+    client = DiffieHellmanClient(args.host, args.port, args.verbose, 5, 23,
+                                 args.cipher_suites, args.resumption,
+                                 dh_group=utils.DH_GROUP_NAMES.get(args.dh_group),
+                                 log_file=args.log_file, record_size=args.record_size,
+                                 coalesce_delay_ms=args.coalesce_delay_ms)
     client.start()
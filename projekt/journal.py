@@ -0,0 +1,279 @@
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Iterator, NamedTuple
+import argparse
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+import utils
+from metrics import Metrics
+
+RECORD_PREFIX = struct.Struct("!II") # payload size, crc32 of the rest of the record
+RECORD_BODY = struct.Struct("!qQH") # timestamp in ns, client id, channel; the payload follows
+INDEX_ENTRY = struct.Struct("!Q") # offset of a record in its segment
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+
+class JournalRecord(NamedTuple):
+    sequence: int
+    client_id: int
+    channel: int
+    timestamp_ns: int
+    payload: bytes
+
+
+def list_segments(directory):
+    """(first sequence, log path, index path) of every segment, oldest first."""
+    segments = []
+    for name in os.listdir(directory):
+        stem, suffix = os.path.splitext(name)
+        if suffix == LOG_SUFFIX and stem.isdigit():
+            segments.append((int(stem), os.path.join(directory, name),
+                             os.path.join(directory, stem + INDEX_SUFFIX)))
+    return sorted(segments)
+
+
+def sync_directory(directory):
+    """fsync a directory, so the files created in it are still there after a crash."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def scan_records(data, offset=0):
+    """Yield (offset, end) of the records in `data` from `offset` on, up to
+    the first one that is cut short or fails its checksum."""
+    while offset + RECORD_PREFIX.size + RECORD_BODY.size <= len(data):
+        size, crc = RECORD_PREFIX.unpack_from(data, offset)
+        end = offset + RECORD_PREFIX.size + RECORD_BODY.size + size
+        if end > len(data) or zlib.crc32(data[offset + RECORD_PREFIX.size:end]) != crc:
+            return
+        yield offset, end
+        offset = end
+
+
+class Journal(threading.Thread):
+    """Append-only journal of the messages clients send, on top of segment files.
+
+    append() writes the records of a connection through a buffer and returns
+    the Future of the next group commit. This thread is the only one that
+    syncs: at most every `commit_interval` seconds it flushes whatever all
+    connections appended, fsyncs it once and resolves that Future, so a
+    connection that waits for it before OK or ACK confirms only what is on
+    disk and a busy server pays one fsync for many messages. Appends made
+    during an fsync belong to the next commit. With sync=False append()
+    returns None and the commits only bound what a crash loses.
+
+    Segment NNN.log, NNN being the sequence number of its first record, is
+    followed by the next one after about `segment_size` bytes. NNN.idx
+    holds the offset of each of its records for JournalReader. Opening the
+    directory drops a record the last segment has only part of and
+    rebuilds that segment's index, which is synced only when it is full.
+    The directory is synced after a segment is created, before any commit
+    confirms records of it.
+    """
+
+    def __init__(self, directory, commit_interval=utils.DEFAULT_JOURNAL_COMMIT_MS / 1000,
+                 segment_size=utils.DEFAULT_JOURNAL_SEGMENT_SIZE, sync=True,
+                 log: utils.Logger = None, metrics: Metrics = None):
+        super().__init__(name="journal", daemon=True)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.segment_size = segment_size
+        self.sync = sync
+        self.log = log.child("Journal: ") if log else None
+        self.metrics = metrics or Metrics()
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+        self.stopping = False
+        self.commit = Future() # resolved with the next sequence number once it is durable
+        self.last_commit = 0.0
+        self.open_last_segment()
+        self.committed = self.next_sequence
+
+    def open_last_segment(self):
+        segments = list_segments(self.directory)
+        if not segments:
+            self.start_segment(0)
+            sync_directory(self.directory)
+            self.next_sequence = 0
+            return
+        first, log_path, index_path = segments[-1]
+        with open(log_path, "rb") as segment:
+            data = segment.read()
+        records = list(scan_records(data))
+        offsets = [offset for offset, _ in records]
+        valid = records[-1][1] if records else 0
+        if valid < len(data) and self.log:
+            self.log.error("Dropping {} bytes of a torn record at the end of {}",
+                           len(data) - valid, log_path)
+        os.truncate(log_path, valid)
+        with open(index_path, "wb") as index:
+            index.write(b"".join(INDEX_ENTRY.pack(offset) for offset in offsets))
+        self.segment = open(log_path, "ab")
+        self.index = open(index_path, "ab")
+        self.segment_offset = valid
+        self.next_sequence = first + len(offsets)
+
+    def start_segment(self, first):
+        stem = os.path.join(self.directory, f"{first:020d}")
+        self.segment = open(stem + LOG_SUFFIX, "ab")
+        self.index = open(stem + INDEX_SUFFIX, "ab")
+        self.segment_offset = 0
+
+    def append(self, client_id, messages) -> Future | None:
+        """Journal (channel, text) messages of a client, return the Future of
+        the commit that makes them durable, None without sync."""
+        timestamp = time.time_ns()
+        with self.lock:
+            for channel, message in messages:
+                body = RECORD_BODY.pack(timestamp, client_id, channel) + utils.to_bytes(message)
+                self.segment.write(RECORD_PREFIX.pack(len(body) - RECORD_BODY.size,
+                                                      zlib.crc32(body)))
+                self.segment.write(body)
+                self.index.write(INDEX_ENTRY.pack(self.segment_offset))
+                self.segment_offset += RECORD_PREFIX.size + len(body)
+                self.next_sequence += 1
+            self.appended.notify()
+            commit = self.commit
+        shard = self.metrics.shard()
+        shard.add("journal_records", len(messages))
+        return commit if self.sync else None
+
+    def run(self):
+        """Commit what was appended, at most every commit_interval seconds."""
+        while True:
+            with self.lock:
+                while self.next_sequence == self.committed and not self.stopping:
+                    self.appended.wait()
+                if self.next_sequence == self.committed:
+                    break
+                stopping = self.stopping
+            # the appends of everyone arriving meanwhile share this commit
+            delay = self.last_commit + self.commit_interval - time.monotonic()
+            if delay > 0 and not stopping:
+                time.sleep(delay)
+            try:
+                self.commit_appended()
+            except OSError as e:
+                if self.log:
+                    self.log.error("Commit failed: {}", e)
+                time.sleep(max(self.commit_interval, 0.1))
+        self.metrics.retire()
+
+    def commit_appended(self):
+        start = time.perf_counter()
+        with self.lock:
+            self.segment.flush()
+            self.index.flush()
+            commit, self.commit = self.commit, Future()
+            sequence = self.next_sequence
+            segment, index = self.segment, self.index
+            full = self.segment_offset >= self.segment_size
+            if full:
+                self.start_segment(sequence)
+        try:
+            os.fsync(segment.fileno())
+            if full:
+                os.fsync(index.fileno())
+                # the next segment's files, whose records the next commit confirms
+                sync_directory(self.directory)
+        except OSError as e:
+            commit.set_exception(e) # the connections waiting for it end
+            raise
+        finally:
+            if full:
+                segment.close()
+                index.close()
+        self.committed = sequence
+        self.last_commit = time.monotonic()
+        commit.set_result(sequence)
+        shard = self.metrics.shard()
+        shard.add("journal_commits")
+        shard.observe("commit", time.perf_counter() - start)
+
+    def close(self):
+        """Commit what is left and close the files."""
+        with self.lock:
+            self.stopping = True
+            self.appended.notify()
+        if self.is_alive():
+            self.join()
+        with self.lock:
+            self.segment.close()
+            self.index.close()
+
+
+class JournalReader:
+    """Replays a journal directory, also one a server is appending to.
+
+    Segments are mapped with mmap and the index of a segment gives the
+    offset of the record replay starts from, so it does not read the
+    records before it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def replay(self, start=0) -> Iterator[JournalRecord]:
+        """Records from sequence number `start` on, in order."""
+        segments = list_segments(self.directory)
+        for i, (first, log_path, index_path) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= start:
+                continue
+            yield from self.replay_segment(first, log_path, index_path, start)
+
+    def replay_segment(self, first, log_path, index_path, start):
+        with open(log_path, "rb") as segment:
+            if os.fstat(segment.fileno()).st_size == 0:
+                return
+            with mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                sequence, offset = first, 0
+                if start > first:
+                    sequence, offset = self.seek(first, index_path, start)
+                for offset, end in scan_records(data, offset):
+                    if sequence >= start:
+                        timestamp, client_id, channel = RECORD_BODY.unpack_from(
+                            data, offset + RECORD_PREFIX.size)
+                        payload = data[offset + RECORD_PREFIX.size + RECORD_BODY.size:end]
+                        yield JournalRecord(sequence, client_id, channel, timestamp, payload)
+                    sequence += 1
+
+    @staticmethod
+    def seek(first, index_path, start):
+        """(sequence, offset) of the record the index has nearest to `start`."""
+        try:
+            with open(index_path, "rb") as index:
+                entries = os.fstat(index.fileno()).st_size // INDEX_ENTRY.size
+                if entries == 0:
+                    return first, 0
+                position = min(start - first, entries - 1)
+                with mmap.mmap(index.fileno(), 0, access=mmap.ACCESS_READ) as offsets:
+                    return first + position, INDEX_ENTRY.unpack_from(
+                        offsets, position * INDEX_ENTRY.size)[0]
+        except FileNotFoundError:
+            return first, 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the records of a server journal")
+    parser.add_argument("directory", help="--journal directory of the server, or a worker's")
+    parser.add_argument("--from", dest="start", type=int, default=0,
+                        help="Sequence number of the first record (default: %(default)s)")
+    args = parser.parse_args()
+    for record in JournalReader(args.directory).replay(args.start):
+        timestamp = datetime.fromtimestamp(record.timestamp_ns / 1e9).isoformat(sep=" ")
+        text = record.payload.decode(errors="replace")
+        print(f"{record.sequence} {timestamp} client {record.client_id} "
+              f"channel {record.channel}: {text}")
+
+
+if __name__ == "__main__":
+    main()
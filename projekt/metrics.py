@@ -0,0 +1,200 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+import threading
+import time
+
+COUNTERS = ("connections_accepted", "handshakes", "handshakes_resumed", "handshake_errors",
+            "frames_in", "frames_out", "bytes_in", "bytes_out", "mac_failures",
+            "record_errors", "frames_refused", "throttled", "connections_reaped",
+            "handshakes_rejected_busy", "handshakes_rejected_ip", "handshakes_rejected_global",
+            "broadcasts_delivered", "broadcasts_dropped", "journal_records", "journal_commits")
+# handshake: ClientHello received -> ServerHello sent; recv: frame header -> whole frame;
+# reply: encrypting and sending the server's answer, send: the same for client messages;
+# broadcast: `broadcast` command -> a client's copy written to its socket;
+# commit: flushing and fsyncing a group commit of the journal
+HISTOGRAMS = ("handshake", "recv", "verify", "decrypt", "reply", "send", "broadcast", "commit")
+STAGES = HISTOGRAMS[1:]
+# upper bounds of the latency buckets in seconds, the last bucket is everything above
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PROMETHEUS_PREFIX = "projekt"
+
+
+class MetricsShard:
+    """Counters and histograms updated by a single thread, so without locks.
+
+    Every name exists from the start, so a reader copying the dicts from
+    another thread never sees them change size.
+    """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.buckets = {name: [0] * (len(BUCKETS) + 1) for name in HISTOGRAMS}
+        self.sums = dict.fromkeys(HISTOGRAMS, 0.0)
+
+    def add(self, counter, value=1):
+        self.counters[counter] += value
+
+    def observe(self, histogram, seconds):
+        self.buckets[histogram][bisect_left(BUCKETS, seconds)] += 1
+        self.sums[histogram] += seconds
+
+    def merge(self, other: "MetricsShard"):
+        for name, value in list(other.counters.items()):
+            self.counters[name] += value
+        for name, counts in list(other.buckets.items()):
+            totals = self.buckets[name]
+            for i, count in enumerate(list(counts)):
+                totals[i] += count
+            self.sums[name] += other.sums[name]
+
+    def count(self, histogram):
+        return sum(self.buckets[histogram])
+
+    def quantile(self, histogram, fraction):
+        """Upper bound of the bucket holding the `fraction` quantile, None if empty."""
+        counts = self.buckets[histogram]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = fraction * total
+        seen = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Server or client wide metrics, cheap enough to stay on in production.
+
+    Each thread updates its own MetricsShard, found through a thread local,
+    and only the snapshot for `stats` or a scrape sums the shards. A thread
+    per connection retires its shard when it ends, which folds it into the
+    totals so the list of shards does not grow with every client.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards: list[MetricsShard] = []
+        self.retired = MetricsShard()
+        self.started = time.monotonic()
+        self.last_stats = (self.started, 0)
+
+    def shard(self) -> MetricsShard:
+        """The calling thread's shard."""
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = MetricsShard()
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def retire(self):
+        """Fold the calling thread's shard into the totals, e.g. when a connection ends."""
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            return
+        del self.local.shard
+        with self.lock:
+            self.shards.remove(shard)
+            self.retired.merge(shard)
+
+    def snapshot(self) -> MetricsShard:
+        total = MetricsShard()
+        with self.lock:
+            total.merge(self.retired)
+            for shard in self.shards:
+                total.merge(shard)
+        return total
+
+    def format_stats(self, gauges: dict = None):
+        """Lines for the `stats` console command."""
+        now = time.monotonic()
+        snapshot = self.snapshot()
+        counters = snapshot.counters
+        uptime = now - self.started
+        since, handshakes_before = self.last_stats
+        self.last_stats = (now, counters["handshakes"])
+        lines = [f"uptime: {uptime:.1f} s"]
+        lines += [f"{name}: {value}" for name, value in (gauges or {}).items()]
+        lines += [f"{name}: {value}" for name, value in counters.items()]
+        lines.append(f"handshakes/s: {counters['handshakes'] / uptime:.2f} overall, "
+                     f"{(counters['handshakes'] - handshakes_before) / (now - since):.2f} "
+                     "since last stats")
+        lines.append("latency        count    mean ms   p50 ms   p99 ms")
+        for name in HISTOGRAMS:
+            count = snapshot.count(name)
+            if count == 0:
+                continue
+            mean = snapshot.sums[name] / count * 1000
+            p50, p99 = (snapshot.quantile(name, f) * 1000 for f in (0.5, 0.99))
+            lines.append(f"{name:<10} {count:>9} {mean:>10.3f} {p50:>8g} {p99:>8g}")
+        return lines
+
+    def format_prometheus(self, gauges: dict = None):
+        """Prometheus text exposition format of the current snapshot."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in (gauges or {}).items():
+            lines += [f"# TYPE {PROMETHEUS_PREFIX}_{name} gauge",
+                      f"{PROMETHEUS_PREFIX}_{name} {value}"]
+        for name, value in snapshot.counters.items():
+            lines += [f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter",
+                      f"{PROMETHEUS_PREFIX}_{name}_total {value}"]
+        histograms = [(f"{PROMETHEUS_PREFIX}_handshake_seconds", [], "handshake")]
+        histograms += [(f"{PROMETHEUS_PREFIX}_stage_seconds", [f'stage="{stage}"'], stage)
+                       for stage in STAGES]
+        previous = None
+        for metric, labels, name in histograms:
+            if metric != previous:
+                lines.append(f"# TYPE {metric} histogram")
+                previous = metric
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), snapshot.buckets[name]):
+                cumulative += count
+                bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{metric}_sum{suffix} {snapshot.sums[name]}")
+            lines.append(f"{metric}_count{suffix} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        endpoint: MetricsEndpoint = self.server.endpoint
+        body = endpoint.metrics.format_prometheus(endpoint.gauges()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes are not worth a log line each
+
+
+class MetricsEndpoint(threading.Thread):
+    """HTTP server on localhost answering GET /metrics in the Prometheus text format."""
+
+    def __init__(self, metrics: Metrics, port, gauges: Callable[[], dict] = dict,
+                 host="127.0.0.1"):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.gauges = gauges
+        self.http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.http_server.endpoint = self
+
+    def run(self):
+        self.http_server.serve_forever()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
@@ -1,258 +1,824 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Callable, Self
+import os
+import select
+import selectors
 import socket
 import threading
-import struct
 import utils
+from async_server import AsyncConnectionsHandler
+from journal import Journal
+from metrics import Metrics, MetricsEndpoint
+from workers import WorkerMetrics, WorkerPool
 import sys
-import os
 import time
 
+CONNECTIONS_PAGE_SIZE = 50 # connections listed per `ls` page
+
 class Connection(threading.Thread):
     def __init__(self, client_id, client_socket: socket.socket, addr,
                  remove_callback: Callable[[Self], None],
-                 printer: utils.ThreadPrinter, verbose):
-        super().__init__()
+                 log: utils.Logger, handshake_context: utils.HandshakeContext = None,
+                 metrics: Metrics = None, upload_dir=utils.DEFAULT_UPLOAD_DIR,
+                 limits: utils.ConnectionLimits = None,
+                 deadline_callback: Callable[[Self, str], None] = None,
+                 admission: utils.HandshakeAdmission = None, journal: Journal = None):
+        super().__init__(daemon=True) # a client that never answers must not keep the server alive
         self.client_id = client_id
         self.client_socket = client_socket
+        self.deadline_callback = deadline_callback or (lambda connection, reason: None)
+        self.admission = admission # admitted this connection's handshake, released after it
+        self.limits = limits or utils.ConnectionLimits()
+        self.budget = self.limits.budget()
+        # replies the client does not read block this thread, which then stops reading too
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                 self.limits.max_pending_output)
+        self.frame_reader = utils.FrameReader(client_socket,
+                                              max_frame_size=self.limits.max_frame_size)
+        # poll, not select: select() refuses descriptors from 1024 on
+        self.readable = select.poll()
+        self.readable.register(client_socket, select.POLLIN)
         self.addr = addr
         self.remove_callback = remove_callback
-        self.printer = printer
+        self.log = log.child(f"Client {client_id}: ")
         self.p = None
         self.g = None
         self.stop_event = threading.Event()
-        self.verbose = verbose
-
-    def print(self, *args):
-        self.printer.print(f"Client {self.client_id}: ", end="")
-        self.printer.print(*args)
-
-    def print_if_verbose(self, *args):
-        if self.verbose:
-            self.print(*args)
-
-    def execute_if_verbose(self, func, *args):
-        if self.verbose:
-            func(*args)
+        self.stop_lock = threading.Lock()
+        self.stopped = False # stop() ran, e.g. from the reaper while a failed send also stops
+        self.handshake_context = handshake_context
+        self.metrics = metrics or Metrics()
+        self.frames_in = self.frames_out = self.bytes_in = self.bytes_out = 0
+        self.acks: utils.Acknowledgements | None = None
+        self.record_size = None
+        self.frame_writer: utils.FrameWriter | None = None
+        self.send_lock = threading.Lock() # the console thread also sends, e.g. EndSession
+        self.channels = utils.Channels(upload_dir, self.log)
+        self.journal = journal
+        self.durable: Future | None = None # commit of the last messages journaled
 
     def run(self):
         """Handle the client logic."""
         try:
-            self.symmetric_key = self.perform_key_exchange()
+            try:
+                self.deadline_callback(self, "handshake")
+                self.cipher = self.perform_key_exchange()
+            except Exception:
+                self.metrics.shard().add("handshake_errors")
+                raise
+            finally:
+                if self.admission:
+                    self.admission.release()
             self.handle_client_message()
         except Exception as e:
-            self.print(f"Caught error with client {self.client_id}: {e}")
+            self.log.error("Caught error with client {}: {}", self.client_id, e)
+        finally:
+            self.channels.close()
+            # a client that vanished without EndSession never reached stop()
+            self.client_socket.close()
+            self.remove_callback(self)
+            self.metrics.retire()
 
     def stop(self, if_remove_from_connections=True):
-        """Close the connection and clean up."""
+        """Close the connection and clean up, only the first time it is called."""
+        with self.stop_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        try:
+            # unlike close() this also wakes the connection's thread blocked in recv or send
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass # already closed or never connected
         self.client_socket.close()
-        self.print(f"Connection with {self.addr} closed.")
+        self.log.info("Connection with {} closed.", self.addr)
         if if_remove_from_connections:
             self.remove_callback(self)
         self.stop_event.set()
 
-    def perform_key_exchange(self):
-        self.print("Waiting for ClientHello")
-        client_hello = utils.receive_data(self.client_socket, 23)
-        client_hello_msg, client_public_key, self.p, self.g = struct.unpack("!11sIII", client_hello)
-
-        self.print_if_verbose(f"[V] Received ClientHello with msg={client_hello_msg.decode()}")
-        self.print_if_verbose(f"[V] Received ClientHello with A={client_public_key} "
-                              f"p={self.p} g={self.g}")
+    @property
+    def channel_summary(self):
+        """(id, messages, bytes) of the open channels, for `ls`."""
+        return self.channels.summary()
 
-        server_private_key = utils.generate_private_key()
-        server_public_key = utils.calculate_public_key(self.g, server_private_key, self.p)
+    def expire(self, reason):
+        """Called by the reaper when the client took longer than the `reason` timeout."""
+        self.metrics.shard().add("connections_reaped")
+        self.log.info("{} exceeded the {} timeout, closing", self.addr, reason)
+        self.end_session(0) # only if it fits in the socket buffer, the reaper does not wait
+        self.stop() # wakes the connection's thread blocked in recv, a no-op if the send failed
 
-        self.print_if_verbose(f"[V] Sending ServerHello with B={server_public_key}")
-        hello_message = struct.pack("!11sI", b"ServerHello", server_public_key)
-        self.client_socket.sendall(hello_message)
+    def perform_key_exchange(self):
+        self.log.info("Waiting for ClientHello")
+        hello_type, body = utils.receive_client_hello(self.frame_reader.receive_data)
+        start = time.perf_counter()
+        handshake = utils.ServerHandshake(hello_type, body, self.handshake_context)
+        self.p, self.g = handshake.p, handshake.g
 
-        shared_key = utils.calculate_shared_secret(client_public_key, server_private_key, self.p)
-        symmetric_key = utils.derive_symmetric_key(shared_key)
+        self.log.verbose("Received ClientHello with msg={}", hello_type.decode())
+        self.log.verbose("Received ClientHello with A={!h} {}", handshake.client_public_key,
+                         handshake.describe_group())
 
-        self.print_if_verbose(f"[V] Shared key K computed: {shared_key}.")
-        self.print_if_verbose(f"[V] Symmetric key derived: {symmetric_key.hex()}.")
+        handshake.compute_keys()
 
-        return symmetric_key
+        if handshake.resumed:
+            self.log.verbose("Resuming session from ticket - key exchange skipped")
+            self.log.verbose("Sending ServerHello cipher suite={}", handshake.cipher_suite.name)
+        else:
+            self.log.verbose("Sending ServerHello with B={!h} cipher suite={}",
+                             handshake.public_key, handshake.cipher_suite.name)
+            self.log.verbose("Shared key K computed: {!h}.", handshake.shared_key)
+        self.log.verbose("Symmetric key derived: {!h}.", handshake.symmetric_key)
+        self.client_socket.sendall(handshake.server_hello())
+        if handshake.acknowledgements:
+            self.acks = utils.Acknowledgements(*handshake.acknowledgements)
+            self.log.verbose("Acknowledging every {} frames or after {} ms",
+                             *handshake.acknowledgements)
+        self.record_size = handshake.record_size
+        if handshake.channels:
+            self.channels.limit = handshake.channels
+            self.log.verbose("Multiplexing up to {} channels", handshake.channels)
+        self.channels.transfers = handshake.transfers
+        self.frame_writer = utils.FrameWriter(handshake.cipher)
+
+        stats = self.metrics.shard()
+        stats.observe("handshake", time.perf_counter() - start)
+        stats.add("handshakes")
+        if handshake.resumed:
+            stats.add("handshakes_resumed")
+        return handshake.cipher
+
+    def wait_for_frame(self):
+        """Block until the next frame starts, acknowledging pending frames when
+        their delay runs out first."""
+        if self.acks and self.acks.pending and self.frame_reader.available() < 4:
+            timeout = self.acks.deadline() - time.monotonic()
+            if timeout <= 0 or not self.readable.poll(timeout * 1000):
+                self.wait_until_durable()
+                self.send_message(self.acks.acknowledge())
+        self.frame_reader.fill(4)
 
     def handle_client_message(self):
-        self.print("Connection was established - waiting for messages from the client.")
+        self.log.info("Connection was established - waiting for messages from the client.")
+        stats = self.metrics.shard()
+        frame_overhead = 4 + self.cipher.iv_size + self.cipher.mac_size
+        if self.acks:
+            frame_overhead += 4 # sequence number
+        aad = b""
         while not self.stop_event.is_set():
-            message_size_data = utils.receive_data(self.client_socket, 4)
-            message_size = struct.unpack("!I", message_size_data)[0]
-            iv = utils.receive_data(self.client_socket, utils.AES_BLOCK_SIZE) # 16B
-            ciphertext = utils.receive_data(self.client_socket, message_size)
-            mac = utils.receive_data(self.client_socket, 32) # 32B
-
-            calculated_mac = utils.calculate_hmac(ciphertext, self.symmetric_key)
-            if mac != calculated_mac:
-                self.print("Authentication failed")
-                self.print("MAC received: ", mac, "\nMAC calculated: ", calculated_mac)
-
+            self.deadline_callback(self, "idle")
+            self.wait_for_frame() # idle until the next frame starts, not timed
+            self.deadline_callback(self, "frame")
+            started = time.perf_counter()
+            try:
+                if self.acks:
+                    sequence, iv, ciphertext, mac = self.frame_reader.read_sequenced_frame(
+                        self.cipher.iv_size, self.cipher.mac_size)
+                    aad = utils.sequence_aad(sequence)
+                else:
+                    iv, ciphertext, mac = self.frame_reader.read_frame(self.cipher.iv_size,
+                                                                       self.cipher.mac_size)
+            except utils.FrameTooLargeError as e:
+                stats.add("frames_refused")
+                self.log.error("Refused frame: {}", e)
                 self.send_message(utils.ServerMessages.FAIL)
                 self.stop()
-
                 return
+            message_size = len(ciphertext)
+            read = time.perf_counter()
+            stats.observe("recv", read - started)
+            stats.add("frames_in")
+            stats.add("bytes_in", frame_overhead + message_size)
+            self.frames_in += 1
+            self.bytes_in += frame_overhead + message_size
+
+            try:
+                self.cipher.verify(iv, ciphertext, mac, aad)
+                verified = time.perf_counter()
+                stats.observe("verify", verified - read)
+                plaintext = self.cipher.decrypt_verified_bytes(iv, ciphertext, mac, aad)
+                if self.record_size:
+                    messages = utils.unpack_record(plaintext)
+                else:
+                    messages = [plaintext]
+                stats.observe("decrypt", time.perf_counter() - verified)
+                if self.acks:
+                    self.acks.receive(sequence, len(messages))
+            except (utils.AuthenticationError, utils.SequenceError) as e:
+                stats.add("mac_failures")
+                self.log.error("Authentication failed: {}", e)
+                self.log.error("MAC received: {!h}", bytes(mac))
 
-            decrypted_message = utils.aes_cbc_decrypt(iv, ciphertext, self.symmetric_key)
+                self.send_message(utils.ServerMessages.FAIL)
+                self.stop()
 
-            self.print(f"Received text: {decrypted_message}")
-            self.print_if_verbose(f"[V] Received message size: {message_size}")
-            self.print_if_verbose(f"[V] Received IV: {iv.hex()}")
-            self.print_if_verbose(f"[V] Received ciphertext: {ciphertext.hex()}")
-            self.print_if_verbose(f"[V] Received MAC: {mac.hex()}")
+                return
+            except ValueError as e: # authentic, but its padding or records are malformed
+                stats.add("record_errors")
+                self.log.error("Malformed record: {}", e)
+                self.send_message(utils.ServerMessages.FAIL)
+                self.stop()
+                return
 
-            if decrypted_message == utils.ServerMessages.END_SESSION:
+            try:
+                texts, replies, ended = self.channels.receive(messages, confirm=not self.acks)
+            except (utils.TransferError, OSError, ValueError) as e:
+                self.log.error("Rejected file transfer: {}", e)
+                self.send_message(utils.ServerMessages.FAIL)
                 self.stop()
                 return
 
-            self.send_message(utils.ServerMessages.OK)
+            for channel, decrypted_message in texts:
+                if self.channels.multiplexed:
+                    self.log.info("Received text on channel {}: {!t}", channel, decrypted_message)
+                else:
+                    self.log.info("Received text: {!t}", decrypted_message)
+            if self.journal:
+                records = [(channel, text) for channel, text in texts
+                           if text not in utils.CONTROL_MESSAGES]
+                if records:
+                    self.durable = self.journal.append(self.client_id, records)
+            if self.log.is_enabled(utils.LogLevel.VERBOSE):
+                # the frame is a view of the reader's buffer, the log formats it later
+                self.log.verbose("Received message size: {}", message_size)
+                self.log.verbose("Received IV: {!h}", bytes(iv))
+                self.log.verbose("Received ciphertext: {!h}", bytes(ciphertext))
+                self.log.verbose("Received MAC: {!h}", bytes(mac))
+
+            if ended:
+                self.stop()
+                return
 
-    def send_message(self, message):
+            if self.acks and self.acks.due():
+                replies.append(self.acks.acknowledge())
+            if replies:
+                self.wait_until_durable()
+                self.send_messages(replies)
+
+            if self.budget:
+                delay = self.budget.charge(1, frame_overhead + message_size)
+                if delay:
+                    stats.add("throttled")
+                    self.stop_event.wait(delay) # the client's frames wait in the socket buffer
+
+    def wait_until_durable(self):
+        """Block until the journal committed what the client is about to get OK or ACK for."""
+        if self.durable:
+            self.durable.result()
+            self.durable = None
+
+    def send_message(self, message, timeout=None):
+        self.send_messages([message], timeout)
+
+    def send_messages(self, messages, timeout=None):
+        """Send messages, all in one record when the client negotiated coalescing.
+
+        With a timeout another thread gives up when the connection's thread
+        holds the socket or the client does not read for that long.
+        """
         try:
-            self.print(f"Sending: {message}")
-
-            iv = os.urandom(utils.AES_BLOCK_SIZE) # random 16B
-
-            ciphertext = utils.aes_cbc_encrypt(iv, message, self.symmetric_key)
-            message_size = struct.pack("!I", len(ciphertext))
-
-            mac = utils.calculate_hmac(ciphertext, self.symmetric_key) # 32B
-            final_message = message_size + iv + ciphertext + mac
-
-            self.print_if_verbose(f"[V] Sent text (length: {len(message)}): {message.value}")
-            self.print_if_verbose(f"[V] Sent ciphertext (length: {len(ciphertext)}): "
-                                  f"{ciphertext.hex()}")
-            self.print_if_verbose(f"[V] Sent IV: {iv.hex()}")
-            self.print_if_verbose(f"[V] Sent MAC: {mac.hex()}")
-
-            self.client_socket.sendall(final_message)
+            messages = self.channels.outgoing(messages)
+            for message in messages:
+                self.log.info("Sending: {}", message)
+                self.log.verbose("Sent text (length: {}): {}", len(message),
+                                 getattr(message, "value", message))
+
+            deadline = None if timeout is None else time.monotonic() + timeout
+            for plaintext in [utils.pack_record(messages)] if self.record_size else messages:
+                start = time.perf_counter()
+                wait = -1 if deadline is None else max(deadline - time.monotonic(), 0)
+                if not self.send_lock.acquire(timeout=wait):
+                    raise TimeoutError("the connection is busy sending")
+                try:
+                    parts = self.frame_writer.parts(plaintext)
+                    frame_size = sum(map(len, parts))
+                    if self.log.is_enabled(utils.LogLevel.VERBOSE):
+                        self.log.verbose("Sent frame (length: {}): {!h}", frame_size,
+                                         b"".join(parts))
+                    utils.send_buffers(self.client_socket, parts, deadline)
+                finally:
+                    self.send_lock.release()
+                stats = self.metrics.shard()
+                stats.observe("reply", time.perf_counter() - start)
+                stats.add("frames_out")
+                stats.add("bytes_out", frame_size)
+                self.frames_out += 1
+                self.bytes_out += frame_size
         except ConnectionError:
-            self.print("Lost connection to the client.")
+            self.log.error("Lost connection to the client.")
             self.stop()
         except Exception as e:
-            self.print(f"Caught Error while sending the message to client: {e}")
+            self.log.error("Caught Error while sending the message to client: {}", e)
             self.stop()
             raise e
 
+    def broadcast_frame(self, message):
+        """A frame of `message` in its own buffer, so a broadcast thread can encrypt it."""
+        messages = self.channels.outgoing([message])
+        plaintext = utils.pack_record(messages) if self.record_size else messages[0]
+        return b"".join(utils.FrameWriter(self.frame_writer.cipher, reuse=False).parts(plaintext))
+
+    def end_session(self, timeout):
+        """Send EndSession from another thread, waiting at most `timeout` seconds."""
+        if self.frame_writer is None:
+            return # the handshake is not finished, there is no key to send it with
+        try:
+            self.send_message(utils.ServerMessages.END_SESSION, timeout)
+        except OSError:
+            pass # stopped by send_messages, the client just sees the connection close
+
+class OutboundQueue:
+    """Broadcast frames waiting for one connection's socket."""
+
+    def __init__(self):
+        self.frames: deque[tuple[memoryview, utils.BroadcastReport]] = deque()
+        self.size = 0 # bytes queued
+        self.offset = 0 # bytes of frames[0] already sent
+        self.holding = False # the send_lock of the connection, kept while a frame is half sent
+
+
+class Broadcaster(threading.Thread):
+    """Writes broadcast frames to the clients' sockets without waiting for any of them.
+
+    Each connection gets its own OutboundQueue. This thread sends with
+    non-blocking writes to the sockets that have room and waits on the others
+    with a selector, so a client that does not read only delays its own copies. A
+    frame goes out between the connection's own frames under its send_lock;
+    a new broadcast is dropped for a client with more than `max_pending`
+    bytes already queued.
+    """
+
+    RETRY_BUSY = 0.005 # s before trying a connection whose thread is sending again
+
+    def __init__(self, log: utils.Logger, metrics: Metrics, max_pending):
+        super().__init__(name="broadcaster", daemon=True)
+        self.log = log
+        self.metrics = metrics
+        self.max_pending = max_pending
+        self.queues: dict[Connection, OutboundQueue] = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        # poll/epoll, unlike select() it takes descriptors past 1024
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        self.watched: dict[Connection, socket.socket] = {} # registered for EVENT_WRITE
+
+    def submit(self, connection: Connection, frame, report: utils.BroadcastReport):
+        """Queue a frame for the connection, called from the broadcast threads."""
+        with self.lock:
+            queue = self.queues.setdefault(connection, OutboundQueue())
+            if queue.size + len(frame) > self.max_pending:
+                dropped = True
+            else:
+                dropped = False
+                queue.frames.append((memoryview(frame), report))
+                queue.size += len(frame)
+        if dropped:
+            self.metrics.shard().add("broadcasts_dropped")
+            report.drop()
+            return
+        try:
+            self.wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass # the broadcaster has wake-ups waiting already
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                queues = list(self.queues.items())
+            blocked, busy = {}, False
+            for connection, queue in queues:
+                state = self.write(connection, queue)
+                if state == "blocked":
+                    blocked[connection] = queue
+                elif state == "busy":
+                    busy = True
+                else:
+                    with self.lock:
+                        if not queue.frames:
+                            self.queues.pop(connection, None)
+            self.watch(blocked)
+            self.selector.select(self.RETRY_BUSY if busy else None)
+            try:
+                while self.wakeup_reader.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+        self.selector.close()
+
+    def watch(self, blocked: dict[Connection, OutboundQueue]):
+        """Register the sockets of the blocked connections for writing, and only those."""
+        for connection in [c for c in self.watched if c not in blocked]:
+            self.selector.unregister(self.watched.pop(connection))
+        for connection, queue in blocked.items():
+            if connection in self.watched:
+                continue
+            try:
+                self.selector.register(connection.client_socket, selectors.EVENT_WRITE)
+            except (KeyError, ValueError, OSError) as e: # the socket was closed meanwhile
+                self.drop(connection, queue, e)
+                with self.lock:
+                    if not queue.frames:
+                        self.queues.pop(connection, None)
+                continue
+            self.watched[connection] = connection.client_socket
+
+    def write(self, connection: Connection, queue: OutboundQueue):
+        """Send what the socket takes: "done" once the queue is empty, "blocked" when the
+        socket is full and "busy" while the connection's thread holds its send_lock."""
+        stats = self.metrics.shard()
+        try:
+            while True:
+                with self.lock:
+                    if not queue.frames:
+                        return "done"
+                    frame, report = queue.frames[0]
+                if connection.stop_event.is_set():
+                    raise ConnectionError("connection closed")
+                if not queue.holding:
+                    if not connection.send_lock.acquire(blocking=False):
+                        return "busy"
+                    queue.holding = True
+                try:
+                    queue.offset += connection.client_socket.send(frame[queue.offset:],
+                                                                  socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    return "blocked"
+                if queue.offset < len(frame):
+                    return "blocked"
+                with self.lock:
+                    queue.frames.popleft()
+                    queue.size -= len(frame)
+                queue.offset = 0
+                queue.holding = False
+                connection.send_lock.release() # the connection's own replies may go first
+                stats.observe("broadcast", report.delivered())
+                stats.add("broadcasts_delivered")
+                stats.add("frames_out")
+                stats.add("bytes_out", len(frame))
+                connection.frames_out += 1
+                connection.bytes_out += len(frame)
+        except OSError as e:
+            self.drop(connection, queue, e)
+            return "done"
+        finally:
+            if queue.holding and queue.offset == 0:
+                queue.holding = False # nothing of the next frame is sent yet
+                connection.send_lock.release()
+
+    def drop(self, connection: Connection, queue: OutboundQueue, error):
+        """Give up the frames queued for a connection whose socket failed."""
+        with self.lock:
+            dropped = list(queue.frames)
+            queue.frames.clear()
+            queue.size = queue.offset = 0
+        if queue.holding: # half a frame was sent, the connection's own sends may go on
+            queue.holding = False
+            connection.send_lock.release()
+        if dropped:
+            self.log.error("Dropping {} broadcasts for client {}: {}", len(dropped),
+                           connection.client_id, error)
+        stats = self.metrics.shard()
+        for _, report in dropped:
+            stats.add("broadcasts_dropped")
+            report.drop()
+
+    def stop(self):
+        self.stop_event.set()
+        try:
+            self.wakeup_writer.send(b"\0")
+        except BlockingIOError:
+            pass
+
+
 class ConnectionsHandler(threading.Thread):
-    def __init__(self, server_socket: socket.socket, printer: utils.ThreadPrinter,
-                 verbose, timeout=1.0):
+    def __init__(self, server_socket: socket.socket, log: utils.Logger,
+                 timeout=1.0, handshake_context: utils.HandshakeContext = None,
+                 metrics: Metrics = None, upload_dir=utils.DEFAULT_UPLOAD_DIR,
+                 shutdown_timeout=utils.DEFAULT_SHUTDOWN_TIMEOUT, first_client_id=0,
+                 client_id_step=1, limits: utils.ConnectionLimits = None,
+                 broadcast_threads=utils.DEFAULT_BROADCAST_THREADS, journal: Journal = None):
         super().__init__()
         self.server_socket = server_socket
-        self.printer = printer
+        self.connection_log = log
+        self.log = log.child("ConnectionsHandler: ")
         self.timeout = timeout
         self.lock = threading.Lock()
         self.stop_event = threading.Event()
-        self.next_client_id = 0
-        self.verbose = verbose
-        self.connections: list[Connection] = []
-
-    def print(self, *args):
-        self.printer.print("ConnectionsHandler: ", end="")
-        self.printer.print(*args)
+        self.next_client_id = first_client_id
+        self.client_id_step = client_id_step # worker processes number their clients apart
+        self.handshake_context = handshake_context
+        self.metrics = metrics or Metrics()
+        self.upload_dir = upload_dir
+        self.shutdown_timeout = shutdown_timeout
+        self.limits = limits or utils.ConnectionLimits()
+        self.admission = self.limits.admission()
+        self.deadlines = utils.Deadlines()
+        self.reaper_wakeup = threading.Event()
+        self.broadcast_threads = broadcast_threads
+        self.broadcast_executor = ThreadPoolExecutor(broadcast_threads, "broadcast")
+        self.broadcaster = Broadcaster(self.log, self.metrics, self.limits.max_pending_output)
+        self.journal = journal
+        # by client id, iterate over snapshot() as connections come and go from other threads
+        self.connections: dict[int, Connection] = {}
 
     def run(self):
         """Accept connections in a loop until stopped."""
         self.server_socket.settimeout(self.timeout)
+        threading.Thread(target=self.reap, name="reaper", daemon=True).start()
+        self.broadcaster.start()
         try:
             while not self.stop_event.is_set():
                 try:
                     client_socket, addr = self.server_socket.accept()
-                    self.print(f"Connection {self.next_client_id} will be established with {addr}")
+                    self.metrics.shard().add("connections_accepted")
+                    refused = self.admission.admit(addr[0])
+                    if refused:
+                        self.metrics.shard().add(f"handshakes_rejected_{refused}")
+                        client_socket.close()
+                        continue
+                    self.log.info("Connection {} will be established with {}",
+                                  self.next_client_id, addr)
                     connection = Connection(self.next_client_id,
                                             client_socket,
                                             addr,
                                             self.remove_connection,
-                                            self.printer,
-                                            self.verbose)
-                    self.connections.append(connection)
-                    self.next_client_id += 1
+                                            self.connection_log,
+                                            self.handshake_context,
+                                            self.metrics,
+                                            self.upload_dir,
+                                            self.limits,
+                                            self.set_deadline,
+                                            self.admission,
+                                            self.journal)
+                    with self.lock:
+                        self.connections[connection.client_id] = connection
+                    self.next_client_id += self.client_id_step
                     connection.start()
                 except socket.timeout:
                     continue
+                except OSError:
+                    if self.stop_event.is_set():
+                        break # stop() shut the listening socket down to wake accept()
+                    raise
         except Exception as e:
-            self.print(f"Caught Error: {e}")
+            self.log.error("Caught Error: {}", e)
         finally:
-            self.print("Stopped")
+            self.log.info("Stopped")
+
+    def set_deadline(self, connection: Connection, reason):
+        """Close the connection unless it moves on within the `reason` timeout."""
+        if self.deadlines.set(connection, self.limits.timeouts[reason], reason):
+            self.reaper_wakeup.set()
+
+    def reap(self):
+        """Close the connections whose deadline passed, one thread for all of them."""
+        while not self.stop_event.is_set():
+            deadline = self.deadlines.next_deadline()
+            self.reaper_wakeup.wait(None if deadline is None else deadline - time.monotonic())
+            self.reaper_wakeup.clear()
+            for connection, reason in self.deadlines.expire():
+                connection.expire(reason)
+
+    def broadcast(self, text) -> utils.BroadcastReport:
+        """Send `text` to every client and return at once; the broadcast threads
+        encrypt the copies in parallel and the broadcaster writes them."""
+        message = utils.broadcast_message(text)
+        connections = [connection for connection in self.snapshot() if connection.frame_writer]
+        report = utils.BroadcastReport(len(connections))
+        for i in range(min(self.broadcast_threads, len(connections))):
+            self.broadcast_executor.submit(self.encrypt_broadcast,
+                                           connections[i::self.broadcast_threads], message,
+                                           report)
+        return report
+
+    def encrypt_broadcast(self, connections: list[Connection], message,
+                          report: utils.BroadcastReport):
+        """Job of a broadcast thread: the copies for some of the clients."""
+        for connection in connections:
+            try:
+                frame = connection.broadcast_frame(message)
+            except Exception as e:
+                self.log.error("Broadcast to client {} failed: {}", connection.client_id, e)
+                report.drop()
+                continue
+            self.broadcaster.submit(connection, frame, report)
 
     def stop(self):
-        """Stop accepting connections."""
+        """Stop accepting connections and close the remaining ones."""
         self.stop_event.set()
+        self.reaper_wakeup.set()
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR) # wakes accept() without its timeout
+        except OSError:
+            pass
         self.join()
         self.close_all_connections() # thread is stopped, this is executed from main thread
+        self.broadcast_executor.shutdown(cancel_futures=True)
+        self.broadcaster.stop()
+
+    def snapshot(self) -> list[Connection]:
+        """The current connections, safe to iterate while they are added and removed."""
+        with self.lock:
+            return list(self.connections.values())
 
     def remove_connection(self, connection):
-        """Remove a connection from the active list."""
-        if self.stop_event.is_set():
-            return
+        """Remove a connection from the registry."""
+        with self.lock:
+            self.connections.pop(connection.client_id, None)
+        self.deadlines.discard(connection)
+
+    def close_connections(self, connections: list[Connection]):
+        """End the sessions together within one shutdown_timeout: EndSession to every
+        client, one grace period for all of them to read it, then close and join."""
+        deadline = time.monotonic() + self.shutdown_timeout
+        for connection in connections:
+            connection.end_session(max(deadline - time.monotonic(), 0))
+        time.sleep(max(min(utils.END_SESSION_GRACE, deadline - time.monotonic()), 0))
+        for connection in connections:
+            connection.stop(False)
+        for connection in connections:
+            connection.join(max(deadline - time.monotonic(), 0))
         with self.lock:
-            if connection in self.connections:
-                self.connections.remove(connection)
+            for connection in connections:
+                self.connections.pop(connection.client_id, None)
+        lingering = sum(connection.is_alive() for connection in connections)
+        if lingering:
+            self.log.error("{} connections did not end within {} s", lingering,
+                           self.shutdown_timeout)
 
     def close_all_connections(self):
-        self.print("Closing all connections")
-        with self.lock:
-            for connection in self.connections:
-                connection.send_message(utils.ServerMessages.END_SESSION)
-                time.sleep(0.1) # give client time to read the message
-                connection.stop(False)
-                connection.join()
-            self.connections = []
+        connections = self.snapshot()
+        self.log.info("Closing all {} connections", len(connections))
+        self.close_connections(connections)
 
     def close_connection(self, id):
-        """Close a specific connection by id."""
+        """Close a specific connection by id, False if there is none."""
         with self.lock:
-            for connection in self.connections:
-                if connection.client_id == id:
-                    connection.send_message(utils.ServerMessages.END_SESSION)
-                    time.sleep(0.1) # give client time to read the message
-                    connection.stop(False)
-                    connection.join()
-                    self.connections.remove(connection)
-                    break
+            connection = self.connections.get(id)
+        if connection is None:
+            return False
+        self.close_connections([connection])
+        return True
 
 
 class DiffieHellmanServer:
-    def __init__(self, host, port, verbose):
+    def __init__(self, host, port, verbose, engine="threads",
+                 ticket_lifetime=utils.DEFAULT_TICKET_LIFETIME,
+                 keypair_pool_size=utils.DEFAULT_KEYPAIR_POOL_SIZE,
+                 handshake_workers=utils.DEFAULT_HANDSHAKE_WORKERS, log_file=None,
+                 metrics_port=None, upload_dir=utils.DEFAULT_UPLOAD_DIR,
+                 shutdown_timeout=utils.DEFAULT_SHUTDOWN_TIMEOUT, workers=0, worker_id=None,
+                 ticket_secret=None, limits: utils.ConnectionLimits = None,
+                 listen_backlog=utils.DEFAULT_LISTEN_BACKLOG,
+                 broadcast_threads=utils.DEFAULT_BROADCAST_THREADS, journal_dir=None,
+                 journal_commit_interval=utils.DEFAULT_JOURNAL_COMMIT_MS / 1000,
+                 journal_sync=True, journal_segment_size=utils.DEFAULT_JOURNAL_SEGMENT_SIZE):
         self.host = host
         self.port = port
         self.server_socket = None
         self.connection_handler = None
-        self.verbose = verbose
-        self.printer = utils.ThreadPrinter()
-        self.printer.start()
-
-    def print(self, *args, **kwargs):
-        self.printer.print(*args, **kwargs)
+        self.engine = engine
+        self.upload_dir = upload_dir
+        self.shutdown_timeout = shutdown_timeout
+        self.limits = limits or utils.ConnectionLimits()
+        self.listen_backlog = listen_backlog
+        self.broadcast_threads = broadcast_threads
+        self.workers = workers
+        self.worker_id = worker_id # set in a worker process of a --workers server
+        self.handshake_workers = handshake_workers
+        self.handshake_context = utils.HandshakeContext()
+        self.worker_pool = None
+        if worker_id is None:
+            self.console, self.log = utils.start_loggers(verbose, log_file)
+        else:
+            console, log = utils.start_loggers(verbose, log_file, prompt=None)
+            self.console = console.child(f"Worker {worker_id}: ")
+            self.log = log.child(f"Worker {worker_id}: ")
+
+        if workers and worker_id is None:
+            # the supervisor only runs the console, the workers do the handshakes
+            options = dict(host=host, port=port, verbose=verbose, engine=engine,
+                           ticket_lifetime=ticket_lifetime, keypair_pool_size=keypair_pool_size,
+                           handshake_workers=handshake_workers, log_file=log_file,
+                           upload_dir=upload_dir, shutdown_timeout=shutdown_timeout,
+                           ticket_secret=os.urandom(32), limits=self.limits,
+                           listen_backlog=listen_backlog, broadcast_threads=broadcast_threads,
+                           journal_dir=journal_dir, journal_commit_interval=journal_commit_interval,
+                           journal_sync=journal_sync, journal_segment_size=journal_segment_size)
+            self.worker_pool = WorkerPool(workers, options, self.log, shutdown_timeout)
+        else:
+            self.handshake_context.executor = utils.create_handshake_executor(handshake_workers)
+            if ticket_lifetime > 0:
+                self.handshake_context.ticket_store = utils.TicketKeyStore(
+                    ticket_lifetime, secret=ticket_secret)
+            if keypair_pool_size > 0:
+                self.handshake_context.keypair_pool = utils.KeypairPool(
+                    keypair_pool_size, executor=self.handshake_context.executor)
+        self.metrics = WorkerMetrics(self.worker_pool) if self.worker_pool else Metrics()
+        self.journal = None
+        if journal_dir and not self.worker_pool:
+            if worker_id is not None:
+                # one writer per directory, so each worker keeps its own journal
+                journal_dir = os.path.join(journal_dir, f"worker-{worker_id}")
+            self.journal = Journal(journal_dir, journal_commit_interval, journal_segment_size,
+                                   journal_sync, self.log, self.metrics)
+        self.metrics_endpoint = None
+        if metrics_port:
+            self.metrics_endpoint = MetricsEndpoint(self.metrics, metrics_port, self.gauges)
+
+    def gauges(self):
+        connections = self.connection_handler.connections if self.connection_handler else {}
+        return {"active_connections": len(connections)}
+
+    def print(self, message=""):
+        self.console.info(message)
 
     def start(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-
-        self.print(f"Server listening on {self.host}:{self.port}...")
-        self.connection_handler = ConnectionsHandler(self.server_socket, self.printer,
-                                                     self.verbose, timeout=10.0)
-        self.connection_handler.start()
-
+        self.serve()
         try:
             self.handle_input()
         except KeyboardInterrupt:
-            self.connection_handler.close_all_connections()
-            self.stop()
+            self.stop() # closes the connections too
             self.print("Shutting down server...")
             sys.exit(0)
         finally:
             self.print("Server shut down\n")
 
+    def serve(self):
+        """Start accepting connections, or the worker processes accepting them."""
+        if self.worker_pool:
+            self.connection_handler = self.worker_pool
+            self.connection_handler.start() # returns once every worker listens
+            self.print(f"Server listening on {self.host}:{self.port} "
+                       f"({self.workers} workers, {self.engine} engine)...")
+        else:
+            self.start_handler()
+            self.print(f"Server listening on {self.host}:{self.port} ({self.engine} engine)...")
+        if self.metrics_endpoint:
+            self.metrics_endpoint.start()
+            self.print(f"Metrics on http://127.0.0.1:"
+                       f"{self.metrics_endpoint.http_server.server_port}/metrics")
+
+    def start_handler(self):
+        if self.handshake_context.executor:
+            # start the worker processes now rather than during the first handshakes
+            list(self.handshake_context.executor.map(abs, range(self.handshake_workers)))
+        if self.handshake_context.keypair_pool:
+            self.handshake_context.keypair_pool.start()
+        if self.journal:
+            self.journal.start()
+
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.worker_id is not None:
+            # every worker listens on the port, the kernel spreads new connections between them
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(self.listen_backlog)
+
+        client_ids = (self.worker_id or 0, max(self.workers, 1)) # first id, step
+        if self.engine == "asyncio":
+            self.connection_handler = AsyncConnectionsHandler(self.server_socket, self.log,
+                                                              self.handshake_context,
+                                                              self.metrics,
+                                                              self.upload_dir,
+                                                              self.shutdown_timeout,
+                                                              *client_ids, self.limits,
+                                                              self.broadcast_threads,
+                                                              self.journal)
+        else:
+            self.connection_handler = ConnectionsHandler(self.server_socket, self.log,
+                                                         timeout=10.0,
+                                                         handshake_context=self.handshake_context,
+                                                         metrics=self.metrics,
+                                                         upload_dir=self.upload_dir,
+                                                         shutdown_timeout=self.shutdown_timeout,
+                                                         first_client_id=client_ids[0],
+                                                         client_id_step=client_ids[1],
+                                                         limits=self.limits,
+                                                         broadcast_threads=self.broadcast_threads,
+                                                         journal=self.journal)
+        self.connection_handler.start()
+
     def stop(self):
         """Stop the server and clean up."""
         if self.connection_handler:
             self.connection_handler.stop()
             self.connection_handler.join()
-        if self.printer:
-            self.printer.stop()
-            self.printer.join()
+        if self.journal:
+            self.journal.close() # after the connections, so it commits their last messages
+        if self.handshake_context.keypair_pool:
+            self.handshake_context.keypair_pool.stop()
+            self.handshake_context.keypair_pool.join()
+        if self.handshake_context.executor:
+            self.handshake_context.executor.shutdown(cancel_futures=True)
+        if self.metrics_endpoint:
+            self.metrics_endpoint.stop()
+        utils.stop_loggers(self.console, self.log)
         if self.server_socket:
             self.server_socket.close()
 
@@ -260,8 +826,10 @@ class DiffieHellmanServer:
         self.print("Commands:")
         self.print("---------------------")
         self.print("help")
-        self.print("ls")
+        self.print("ls [page]")
+        self.print("stats")
         self.print("end <connection id>")
+        self.print("broadcast <message>")
         self.print("shutdown")
         self.print("---------------------")
 
@@ -273,43 +841,94 @@ class DiffieHellmanServer:
             if command == "help":
                 self.print_commands()
             elif command == "ls":
-                self.print_connections()
+                if len(input_args) < 2:
+                    self.print_connections()
+                elif input_args[1].isdigit() and int(input_args[1]) > 0:
+                    self.print_connections(int(input_args[1]))
+                else:
+                    self.print("ls page must be a positive number")
+            elif command == "stats":
+                self.print_stats()
             elif command == "end":
                 if len(input_args) < 2:
                     self.print("end reqired id paramter!")
                 else:
                     self.end_connection(input_args[1])
+            elif command == "broadcast":
+                if len(input_args) < 2 or not input_args[1]:
+                    self.print("broadcast requires a message!")
+                else:
+                    self.broadcast(input_args[1])
             elif command == "shutdown":
                 self.print("Shutting down server. It will take a moment...")
-                self.connection_handler.close_all_connections()
-
-                self.stop()
+                self.stop() # closes the connections too
                 sys.exit(0)
             else:
                 self.print(f"Command '{command}' not found")
 
-    def print_connections(self):
+    def print_connections(self, page=1):
+        connections = self.connection_handler.snapshot()
+        pages = max(1, -(-len(connections) // CONNECTIONS_PAGE_SIZE))
+        page = min(page, pages)
+        start = (page - 1) * CONNECTIONS_PAGE_SIZE
         self.print()
         self.print("Connections:")
         self.print("---------------------")
-        if len(self.connection_handler.connections) > 0:
-            for connection in self.connection_handler.connections:
-                self.print(f"Connection: id:{connection.client_id}, address: {connection.addr}")
+        if len(connections) > 0:
+            for connection in connections[start:start + CONNECTIONS_PAGE_SIZE]:
+                self.print(f"Connection: id:{connection.client_id}, address: {connection.addr}, "
+                           f"frames in/out: {connection.frames_in}/{connection.frames_out}, "
+                           f"bytes in/out: {connection.bytes_in}/{connection.bytes_out}")
+                if connection.channel_summary:
+                    self.print("    channels: " + ", ".join(
+                        f"{channel} ({messages} msgs, {size} bytes)"
+                        for channel, messages, size in connection.channel_summary))
+            if pages > 1:
+                self.print(f"Page {page}/{pages} of {len(connections)} connections,"
+                           " 'ls <page>' shows another page")
         else:
             self.print("No active connection")
         self.print("---------------------")
 
+    def print_stats(self):
+        self.print()
+        self.print("Stats:")
+        self.print("---------------------")
+        for line in self.metrics.format_stats(self.gauges()):
+            self.print(line)
+        self.print("---------------------")
+
+    def broadcast(self, text):
+        report = self.connection_handler.broadcast(text).wait()
+        self.print(f"Broadcast to {report.summary()}")
+
     def end_connection(self, id):
-        if id not in [str(c.client_id) for c in self.connection_handler.connections]:
+        if not id.isdigit() or not self.connection_handler.close_connection(int(id)):
             self.print(f"Connection with \"{id}\" id not found.\n"
                        "Use 'ls' command to check existing connections")
             return
 
-        self.connection_handler.close_connection(int(id))
         self.print(f"Connection {id} closed")
 
 
 if __name__ == "__main__":
-    port, host, verbose = utils.process_args("server")
-    server = DiffieHellmanServer(host, port, verbose)
+    args = utils.process_args("server")
+    limits = utils.ConnectionLimits(args.max_frame_size, args.max_frames_per_second,
+                                    args.max_bytes_per_second, args.max_pending_output,
+                                    args.handshake_timeout, args.idle_timeout, args.frame_timeout,
+                                    handshake_rate=args.handshake_rate,
+                                    handshake_burst=args.handshake_burst,
+                                    ip_handshake_rate=args.ip_handshake_rate,
+                                    ip_handshake_burst=args.ip_handshake_burst,
+                                    max_pending_handshakes=args.max_pending_handshakes)
+    server = DiffieHellmanServer(args.host, args.port, args.verbose, args.engine,
+                                 args.ticket_lifetime, args.keypair_pool_size,
+                                 args.handshake_workers, args.log_file, args.metrics_port,
+                                 args.upload_dir, args.shutdown_timeout, args.workers,
+                                 limits=limits, listen_backlog=args.listen_backlog,
+                                 broadcast_threads=args.broadcast_threads,
+                                 journal_dir=args.journal,
+                                 journal_commit_interval=args.journal_commit_ms / 1000,
+                                 journal_sync=args.journal_sync,
+                                 journal_segment_size=args.journal_segment_mb * 1024 * 1024)
     server.start()
@@ -0,0 +1,402 @@
+from collections import deque
+from typing import AsyncIterator, Iterable
+import asyncio
+import struct
+import time
+import utils
+import async_server
+from metrics import Metrics
+
+
+async def receive_server_hello(reader: asyncio.StreamReader):
+    """Read a legacy or extended ServerHello, like utils.receive_server_hello."""
+    hello_type = await async_server.receive_data(reader, utils.HELLO_TYPE_SIZE)
+    if hello_type == utils.SERVER_HELLO_V2:
+        body_size = struct.unpack("!H", await async_server.receive_data(reader, 2))[0]
+    else:
+        body_size = 4 # B
+    return hello_type, await async_server.receive_data(reader, body_size)
+
+
+class ClientSession:
+    """Programmatic asyncio client, the library behind client.py's bulk mode.
+
+    connect() performs the handshake, send()/send_many() write frames
+    without waiting for the server and replies() yields the decrypted
+    answers read by a background task. Up to `window` messages stay in
+    `unacknowledged` until the server confirms them, with a cumulative
+    "ACK <n>" every `ack_every` frames when the server supports it or an OK
+    per message otherwise. With `coalesce_delay_ms` messages are packed into
+    records of up to `record_size` bytes, flushed when full or after the
+    delay. With `channels` the connection carries up to that many logical
+    channels, channel 0 included, opened with open_channel(). connect()
+    reopens the open channels, sends whatever a dropped connection left
+    unacknowledged again and offers the previous session's ticket.
+    """
+
+    def __init__(self, host, port, cipher_suites=utils.DEFAULT_CIPHER_SUITES,
+                 dh_group: utils.DHGroup | utils.X25519Group = utils.MODP_2048,
+                 p=None, g=None, resumption=True, log: utils.Logger = None,
+                 metrics: Metrics = None, window=utils.DEFAULT_SEND_WINDOW,
+                 ack_every=utils.DEFAULT_ACK_EVERY, ack_delay_ms=utils.DEFAULT_ACK_DELAY_MS,
+                 record_size=utils.DEFAULT_RECORD_SIZE,
+                 coalesce_delay_ms=utils.DEFAULT_COALESCE_DELAY_MS, channels=None):
+        self.host = host
+        self.port = port
+        self.cipher_suites = cipher_suites
+        self.dh_group = dh_group
+        self.p = p
+        self.g = g
+        self.resumption = resumption
+        self.log = log or utils.Logger(None, utils.LogLevel.SILENT)
+        self.metrics = metrics or Metrics()
+        self.session_ticket = None
+        self.resumption_secret = None
+        self.resumed = False
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.cipher = None
+        self.frame_writer: utils.FrameWriter | None = None
+        self.window = window
+        # ACK more often than the window fills, or the sender stalls for the delay
+        self.offered_acknowledgements = ((min(ack_every, window), ack_delay_ms)
+                                         if ack_every else None)
+        self.acknowledgements = None # (every, delay ms) the server agreed to
+        self.unacknowledged: deque[bytes | str] = deque()
+        self.first_unacknowledged = 0 # sequence number of unacknowledged[0]
+        self.next_sequence = 0
+        self.window_open = asyncio.Event()
+        self.offered_record_size = record_size if coalesce_delay_ms else None
+        self.coalesce_delay = coalesce_delay_ms / 1000
+        self.record_size = None # record size the server agreed to, None sends plain frames
+        self.batch = utils.RecordBuilder(record_size)
+        self.flush_timer: asyncio.TimerHandle | None = None
+        self.replies_queue: asyncio.Queue = asyncio.Queue()
+        # every message, and unacknowledged ones too, starts with its channel id
+        self.offered_channels = channels
+        self.max_channels = None # channels the server agreed to
+        self.transfers = False # messages start with their MessageKind, files can be sent
+        self.channels: dict[int, SessionChannel] = {}
+        self.listener: asyncio.Task | None = None
+        self.closing = False
+        self.generate_keys()
+
+    @property
+    def connected(self):
+        return self.listener is not None and not self.listener.done()
+
+    def generate_keys(self):
+        if self.dh_group:
+            self.private_key, self.public_key = self.dh_group.generate_keypair()
+        else:
+            self.private_key = utils.generate_private_key()
+            self.public_key = utils.calculate_public_key(self.g, self.private_key, self.p)
+
+    async def connect(self):
+        """Open the connection and perform the ClientHello/ServerHello exchange."""
+        self.log.info("Connecting to server at {}:{}...", self.host, self.port)
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        ticket = self.session_ticket if self.resumption else None
+        handshake = utils.ClientHandshake(self.private_key, self.public_key, self.cipher_suites,
+                                          self.dh_group, self.p, self.g,
+                                          ticket, self.resumption_secret,
+                                          self.offered_acknowledgements,
+                                          self.offered_record_size, self.offered_channels,
+                                          transfers=True)
+        start = time.perf_counter()
+        try:
+            self.writer.write(handshake.client_hello())
+            hello_type, body = await receive_server_hello(self.reader)
+            self.cipher = handshake.complete(hello_type, body)
+            if self.offered_channels and not handshake.channels:
+                raise ConnectionError("The server does not support channels")
+            # the transport may keep a frame it could not send at once, so no buffer reuse
+            self.frame_writer = utils.FrameWriter(self.cipher, reuse=False)
+        except Exception:
+            self.metrics.shard().add("handshake_errors")
+            self.writer.close()
+            raise
+        self.resumed = handshake.resumed
+        self.acknowledgements = handshake.acknowledgements
+        self.record_size = handshake.record_size
+        self.max_channels = handshake.channels
+        self.transfers = handshake.transfers
+        self.session_ticket = handshake.session_ticket
+        self.resumption_secret = handshake.resumption_secret
+        stats = self.metrics.shard()
+        stats.observe("handshake", time.perf_counter() - start)
+        stats.add("handshakes")
+        if self.resumed:
+            stats.add("handshakes_resumed")
+        self.log.info("Connected, cipher suite={}, resumed={}", handshake.cipher_suite.name,
+                      self.resumed)
+        self.replies_queue = asyncio.Queue()
+        self.closing = False
+        self.listener = asyncio.create_task(self.listen())
+
+        pending = list(self.unacknowledged)
+        self.unacknowledged.clear()
+        self.batch = utils.RecordBuilder(self.record_size or utils.DEFAULT_RECORD_SIZE)
+        self.first_unacknowledged = self.next_sequence = 0
+        for channel_id, channel in list(self.channels.items()):
+            channel.replies_queue = asyncio.Queue()
+            await self.send(utils.ServerMessages.CHANNEL_OPEN, channel_id)
+        for message in pending:
+            await self.send_addressed(message)
+
+    async def listen(self):
+        """Read and decrypt server frames until the connection ends."""
+        try:
+            while True:
+                iv, ciphertext, mac = await async_server.read_frame(
+                    self.reader, self.cipher.iv_size, self.cipher.mac_size)
+                self.cipher.verify(iv, ciphertext, mac)
+                plaintext = self.cipher.decrypt_verified_bytes(iv, ciphertext, mac)
+                if self.record_size:
+                    messages = utils.unpack_record(plaintext)
+                else:
+                    messages = [plaintext]
+                stats = self.metrics.shard()
+                stats.add("frames_in")
+                stats.add("bytes_in", 4 + len(iv) + len(ciphertext) + len(mac))
+                ended = False
+                for message in messages:
+                    channel_id = 0
+                    if self.max_channels:
+                        channel_id, message = utils.unpack_channel(message)
+                    message = bytes(message)
+                    self.confirm(message, channel_id)
+                    if channel_id == 0:
+                        self.replies_queue.put_nowait(message)
+                        ended = ended or message in (utils.ServerMessages.FAIL.encode(),
+                                                     utils.ServerMessages.END_SESSION.encode())
+                    elif channel_id in self.channels:
+                        self.channels[channel_id].receive(message)
+                if ended:
+                    break
+        except (ConnectionError, utils.AuthenticationError, ValueError) as e:
+            if not self.closing:
+                self.log.error("Connection to the server lost: {}", e)
+        finally:
+            if self.flush_timer:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.writer.close()
+            self.replies_queue.put_nowait(None)
+            for channel in self.channels.values():
+                channel.replies_queue.put_nowait(None)
+            self.window_open.set() # wake senders, they see the connection is gone
+
+    def confirm(self, message, channel_id=0):
+        """Drop the messages an OK or ACK confirms from `unacknowledged`; without
+        ACKs the FAIL that closes a channel answers a message too."""
+        acknowledged = utils.parse_ack(message)
+        if acknowledged is not None:
+            for _ in range(acknowledged + 1 - self.first_unacknowledged):
+                self.unacknowledged.popleft()
+            self.first_unacknowledged = acknowledged + 1
+        elif self.unacknowledged and (
+                message == utils.ServerMessages.OK.encode()
+                or (channel_id and message == utils.ServerMessages.FAIL.encode()
+                    and not self.acknowledgements)):
+            self.unacknowledged.popleft()
+            self.first_unacknowledged += 1
+        else:
+            return
+        self.window_open.set()
+
+    def write_frame(self, message: bytes | str, count=1):
+        """Encrypt a message, or a record of `count` messages, into the writer's buffer."""
+        if self.acknowledgements:
+            parts = self.frame_writer.parts(message, utils.sequence_aad(self.next_sequence))
+            self.next_sequence += count
+        else:
+            parts = self.frame_writer.parts(message)
+        self.writer.writelines(parts) # gathered with sendmsg where the transport supports it
+        stats = self.metrics.shard()
+        stats.add("frames_out")
+        stats.add("bytes_out", sum(map(len, parts)))
+
+    def flush(self):
+        """Write the messages waiting in the batch as one record."""
+        if self.flush_timer:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if self.batch and self.connected:
+            messages = self.batch.take()
+            self.write_frame(utils.pack_record(messages), len(messages))
+
+    def write_message(self, message: bytes | str):
+        """Write a message right away, or batch it when records are coalesced."""
+        if not self.record_size:
+            self.write_frame(message)
+        elif self.batch.add(message):
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(self.coalesce_delay,
+                                                                     self.flush)
+
+    async def wait_for_window(self):
+        """Wait until fewer than `window` messages are unacknowledged."""
+        while len(self.unacknowledged) >= self.window and self.connected:
+            self.window_open.clear()
+            await self.window_open.wait()
+
+    async def send(self, message: bytes | str, channel_id=0, kind=utils.MessageKind.TEXT):
+        """Send one message once the window has room; it stays unacknowledged
+        until the server confirms it."""
+        if self.transfers:
+            message = utils.pack_kind(kind, message)
+        if self.offered_channels:
+            message = utils.pack_channel(channel_id, message)
+        await self.send_addressed(message)
+
+    async def send_addressed(self, message: bytes | str):
+        """send() a message that already carries its channel id, if channels are used."""
+        await self.wait_for_window()
+        self.unacknowledged.append(message)
+        if not self.connected:
+            raise ConnectionError("Not connected to the server")
+        self.write_message(message)
+        await self.writer.drain()
+
+    async def send_many(self, messages: Iterable[bytes | str], channel_id=0):
+        """Send messages back to back, waiting only when the socket buffer is full."""
+        for message in messages:
+            await self.send(message, channel_id)
+
+    async def send_file(self, path, chunk_size=utils.DEFAULT_CHUNK_SIZE, channel_id=0):
+        """Stream a file as a FILE header and chunks; at most `window` chunks are
+        held until acknowledged, however large the file."""
+        if not self.transfers:
+            raise ConnectionError("The server does not support file transfers")
+        for kind, message in utils.file_messages(path, chunk_size):
+            await self.send(message, channel_id, kind)
+        self.flush()
+
+    async def open_channel(self) -> "SessionChannel":
+        """Open a logical channel: one ChannelOpen message instead of a handshake."""
+        if not self.max_channels:
+            raise ConnectionError("No channels negotiated with the server")
+        if len(self.channels) + 1 >= self.max_channels:
+            raise ConnectionError(f"All {self.max_channels} channels are open")
+        channel_id = next(channel_id for channel_id in range(1, 1 << 16)
+                          if channel_id not in self.channels)
+        channel = self.channels[channel_id] = SessionChannel(self, channel_id)
+        await self.send(utils.ServerMessages.CHANNEL_OPEN, channel_id)
+        return channel
+
+    async def replies(self) -> AsyncIterator[bytes]:
+        """Yield server replies until the connection ends."""
+        while (reply := await self.replies_queue.get()) is not None:
+            yield reply
+
+    async def drain_acknowledgements(self):
+        """Wait until every sent message is confirmed or the connection ended."""
+        self.flush()
+        while self.unacknowledged and self.connected:
+            self.window_open.clear()
+            await self.window_open.wait()
+
+    async def close(self):
+        """Send EndSession and close the connection."""
+        if not self.connected:
+            return
+        self.closing = True
+        try:
+            message = utils.ServerMessages.END_SESSION
+            if self.transfers:
+                message = utils.pack_kind(utils.MessageKind.TEXT, message)
+            self.write_message(utils.pack_channel(0, message) if self.max_channels else message)
+            self.flush()
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+        await asyncio.gather(self.listener, return_exceptions=True)
+        self.log.info("Notified server and disconnected")
+
+
+class SessionChannel:
+    """A logical channel of a ClientSession, from open_channel().
+
+    Its messages keep their order and are confirmed like the session's,
+    replies() yields the server's answers on this channel only. A FAIL
+    closes the channel, not the session.
+    """
+
+    def __init__(self, session: ClientSession, channel_id):
+        self.session = session
+        self.channel_id = channel_id
+        self.replies_queue: asyncio.Queue = asyncio.Queue()
+
+    @property
+    def open(self):
+        return self.session.channels.get(self.channel_id) is self
+
+    def receive(self, reply):
+        """Called by the session's listener with a reply on this channel."""
+        self.replies_queue.put_nowait(reply)
+        if reply == utils.ServerMessages.FAIL.encode():
+            self.session.channels.pop(self.channel_id, None)
+            self.replies_queue.put_nowait(None)
+
+    async def send(self, message: bytes | str, kind=utils.MessageKind.TEXT):
+        if not self.open:
+            raise ConnectionError(f"Channel {self.channel_id} is closed")
+        await self.session.send(message, self.channel_id, kind)
+
+    async def send_many(self, messages: Iterable[bytes | str]):
+        for message in messages:
+            await self.send(message)
+
+    async def send_file(self, path, chunk_size=utils.DEFAULT_CHUNK_SIZE):
+        await self.session.send_file(path, chunk_size, self.channel_id)
+
+    async def replies(self) -> AsyncIterator[bytes]:
+        """Yield the replies on this channel until it or the connection ends."""
+        while (reply := await self.replies_queue.get()) is not None:
+            yield reply
+
+    async def close(self):
+        """Send EndSession on the channel; the connection and its other channels go on."""
+        if not self.open:
+            return
+        await self.send(utils.ServerMessages.END_SESSION)
+        self.session.flush()
+        del self.session.channels[self.channel_id]
+        self.replies_queue.put_nowait(None)
+
+
+async def send_lines(session: ClientSession, lines: Iterable[str], retries=5,
+                     max_backoff=5.0):
+    """Stream lines into the session, reconnecting with exponential backoff.
+
+    Lines not acknowledged before a drop are sent again after reconnecting,
+    so each line reaches the server at least once. Returns the number of
+    lines sent.
+    """
+    lines = iter(lines)
+    sent = 0
+    failures = 0
+    while True:
+        try:
+            if not session.connected:
+                await session.connect()
+            failures = 0
+            for line in lines:
+                sent += 1 # a failed send stays unacknowledged and goes out after reconnecting
+                await session.send(line.rstrip("\n"))
+            if session.unacknowledged:
+                await session.drain_acknowledgements()
+            if not session.unacknowledged:
+                await session.close()
+                return sent
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        failures += 1
+        if failures > retries:
+            raise ConnectionError(f"Gave up after {retries} reconnects")
+        backoff = min(max_backoff, 0.1 * 2 ** (failures - 1))
+        session.log.error("Connection lost, reconnecting in {:.1f} s", backoff)
+        await asyncio.sleep(backoff)
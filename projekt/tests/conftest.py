@@ -0,0 +1,22 @@
+import os
+import resource
+import sys
+import pytest
+
+# the modules of projekt/ import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+IDLE_CONNECTIONS = 1100 # pushes the next connection's descriptor past select()'s 1024
+
+
+@pytest.fixture
+def many_descriptors():
+    """Raise the open files limit, which the server inherits, for the idle
+    connections the test opens first; yields how many to open."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 3 * IDLE_CONNECTIONS # the server's sockets, the test's, and spare
+    if hard != resource.RLIM_INFINITY and hard < wanted:
+        pytest.skip(f"needs {wanted} open files, the hard limit is {hard}")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, wanted), hard))
+    yield IDLE_CONNECTIONS
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
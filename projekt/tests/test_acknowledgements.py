@@ -0,0 +1,27 @@
+import asyncio
+import socket
+import benchmark
+import session
+import utils
+
+
+async def send_and_drain(port):
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, resumption=False)
+    await client.connect()
+    # fewer messages than --ack-every, so only the late ACK confirms them
+    await client.send_many(f"message {i}" for i in range(5))
+    await asyncio.wait_for(client.drain_acknowledgements(), 10)
+    acknowledged = client.connected and not client.unacknowledged
+    await client.close()
+    return acknowledged
+
+
+def test_late_ack_on_a_descriptor_above_1024(many_descriptors):
+    with benchmark.running_server("--engine", "threads", "--handshake-timeout", "0",
+                                  "--max-pending-handshakes", "0") as (_, port):
+        idle = [socket.create_connection(("127.0.0.1", port)) for _ in range(many_descriptors)]
+        try:
+            assert asyncio.run(send_and_drain(port))
+        finally:
+            for connection in idle:
+                connection.close()
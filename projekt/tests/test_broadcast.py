@@ -0,0 +1,60 @@
+import asyncio
+import socket
+import benchmark
+import session
+import utils
+
+PAYLOAD = "x" * 16 * 1024
+MAX_BROADCASTS = 2000 # far more than the socket buffers of one client hold
+MAX_CPU_WHILE_BLOCKED = 0.3 # s of server CPU in a second spent waiting for the client
+
+
+async def broadcast_to_a_blocked_client(process, port, metrics_port):
+    """Fill the socket of a client that stopped reading with broadcasts, then
+    let it read; return the server CPU time used meanwhile and whether a
+    broadcast sent after that still reaches the client."""
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, resumption=False)
+    await client.connect()
+    client.writer.transport.pause_reading()
+    for i in range(MAX_BROADCASTS):
+        process.stdin.write(f"broadcast {i} {PAYLOAD}\n".encode())
+        process.stdin.flush()
+        if i % 50 == 49:
+            await asyncio.sleep(0.05)
+            counters = await asyncio.to_thread(benchmark.server_counters, metrics_port)
+            if counters["broadcasts_dropped"]: # its queue is full, the socket long before
+                break
+    cpu = benchmark.cpu_seconds(process.pid)
+    await asyncio.sleep(1)
+    cpu = benchmark.cpu_seconds(process.pid) - cpu
+    client.writer.transport.resume_reading()
+    replies = client.replies()
+
+    async def received(tag):
+        async for reply in replies:
+            text = utils.parse_broadcast(reply)
+            if text is not None and text.startswith(tag):
+                return True
+        return False
+    await asyncio.sleep(1) # the queued copies go out, the ones of the last round too
+    process.stdin.write(b"broadcast last\n")
+    process.stdin.flush()
+    delivered = await asyncio.wait_for(received(b"last"), 20)
+    await client.close()
+    return cpu, delivered
+
+
+def test_broadcast_to_a_blocked_descriptor_above_1024(many_descriptors):
+    metrics_port = benchmark.free_port()
+    with benchmark.running_server("--engine", "threads", "--handshake-timeout", "0",
+                                  "--max-pending-handshakes", "0",
+                                  "--metrics-port", str(metrics_port)) as (process, port):
+        idle = [socket.create_connection(("127.0.0.1", port)) for _ in range(many_descriptors)]
+        try:
+            cpu, delivered = asyncio.run(broadcast_to_a_blocked_client(process, port,
+                                                                      metrics_port))
+        finally:
+            for connection in idle:
+                connection.close()
+    assert delivered
+    assert cpu < MAX_CPU_WHILE_BLOCKED
@@ -0,0 +1,65 @@
+import asyncio
+import subprocess
+import benchmark
+import pytest
+import session
+import utils
+
+OPEN, END = utils.ServerMessages.CHANNEL_OPEN, utils.ServerMessages.END_SESSION
+
+
+def test_channels_open_count_and_close(tmp_path):
+    channels = utils.Channels(str(tmp_path), utils.Logger(None, utils.LogLevel.SILENT))
+    assert channels.summary() == [] # not multiplexed, nothing to list
+    channels.limit = 3
+    messages = [utils.pack_channel(channel, message) for channel, message in
+                [(1, OPEN), (2, OPEN), (1, "hello"), (1, "again"), (2, END)]]
+    texts, replies, ended = channels.receive(messages)
+    assert not ended and len(replies) == len(messages)
+    assert channels.summary() == [(0, 0, 0), (1, 2, 10)]
+    # over the limit, and a message on a channel that is not open
+    _, replies, _ = channels.receive([utils.pack_channel(3, OPEN), utils.pack_channel(4, OPEN),
+                                      utils.pack_channel(5, "hello")])
+    assert [utils.unpack_channel(reply) for reply in replies] == [
+        (3, utils.ServerMessages.OK.encode()), (4, utils.ServerMessages.FAIL.encode()),
+        (5, utils.ServerMessages.FAIL.encode())]
+    assert [channel for channel, *_ in channels.summary()] == [0, 1, 3]
+    _, _, ended = channels.receive([utils.pack_channel(0, END)])
+    assert ended
+
+
+async def use_channels(port):
+    """Open two channels, send on the first and close the second; return the
+    id of the first."""
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, resumption=False,
+                                   ack_every=0, channels=4)
+    await client.connect()
+    kept, closed = await client.open_channel(), await client.open_channel()
+    await kept.send_many(["one", "two", "three"])
+    await closed.close()
+    await asyncio.wait_for(client.drain_acknowledgements(), 10)
+    return client, kept.channel_id
+
+
+def listed_channels(process):
+    """Type `ls` and return the channels line it prints."""
+    process.stdin.write(b"ls\n")
+    process.stdin.flush()
+    while line := process.stdout.readline().decode():
+        if "channels:" in line:
+            return line.split("channels:", 1)[1].strip()
+    raise AssertionError("ls printed no channels")
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_ls_lists_the_open_channels(engine):
+    with benchmark.running_server("--engine", engine, stdout=subprocess.PIPE) as (process, port):
+        loop = asyncio.new_event_loop()
+        try:
+            client, kept = loop.run_until_complete(use_channels(port))
+            listed = listed_channels(process)
+            loop.run_until_complete(client.close())
+        finally:
+            loop.close()
+    # ChannelOpen is not counted, each text has a MessageKind byte, the closed channel is gone
+    assert listed == f"0 (0 msgs, 0 bytes), {kept} (3 msgs, {4 + 4 + 6} bytes)"
@@ -0,0 +1,66 @@
+import asyncio
+import benchmark
+import pytest
+import session
+import utils
+
+CBC, CHACHA, GCM = (utils.CipherSuite.CBC_HMAC_SHA256, utils.CipherSuite.CHACHA20_POLY1305,
+                    utils.CipherSuite.AES_GCM)
+
+
+def test_server_takes_the_first_offered_suite_it_supports():
+    assert utils.choose_cipher_suite(bytes([GCM, CBC])) == GCM
+    assert utils.choose_cipher_suite(bytes([99, CHACHA])) == CHACHA
+    with pytest.raises(ValueError):
+        utils.choose_cipher_suite(bytes([99]))
+
+
+async def negotiate(port, suites):
+    """Connect offering `suites`, send a message; return the suite and the reply."""
+    client = session.ClientSession("127.0.0.1", port, cipher_suites=suites,
+                                   dh_group=utils.X25519, resumption=False, ack_every=0)
+    await client.connect()
+    await client.send("hello")
+    client.flush()
+    reply = await asyncio.wait_for(anext(client.replies()), 10)
+    await client.close()
+    return client.cipher.suite, reply
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_every_suite_is_negotiated_in_the_client_order(engine):
+    with benchmark.running_server("--engine", engine) as (_, port):
+        for suites, chosen in [((CBC,), CBC), ((CHACHA,), CHACHA), ((GCM,), GCM),
+                               ((GCM, CBC), GCM), (utils.DEFAULT_CIPHER_SUITES, CBC)]:
+            assert asyncio.run(negotiate(port, suites)) == (chosen,
+                                                            utils.ServerMessages.OK.encode())
+
+
+async def offer_unknown_suite(port):
+    client = session.ClientSession("127.0.0.1", port, cipher_suites=(99,),
+                                   dh_group=utils.X25519, resumption=False)
+    with pytest.raises((ConnectionError, asyncio.IncompleteReadError)):
+        await asyncio.wait_for(client.connect(), 10)
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_no_common_suite_fails_only_that_handshake(engine):
+    with benchmark.running_server("--engine", engine) as (_, port):
+        asyncio.run(offer_unknown_suite(port))
+        assert asyncio.run(negotiate(port, (CBC,))) == (CBC, utils.ServerMessages.OK.encode())
+
+
+async def legacy_round_trip(port):
+    """Send a message after a legacy ClientHello, which has no suite list."""
+    reader, writer, key = await benchmark.open_session("127.0.0.1", port)
+    await benchmark.send_frame(writer, key, "legacy")
+    reply = await asyncio.wait_for(benchmark.read_frame(reader, key), 10)
+    writer.close()
+    return reply
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_legacy_client_hello_falls_back_to_cbc_hmac(engine):
+    with benchmark.running_server("--engine", engine) as (_, port):
+        # benchmark.read_frame checks the HMAC and decrypts with AES-CBC
+        assert asyncio.run(legacy_round_trip(port)) == utils.ServerMessages.OK
@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import time
+import benchmark
+import pytest
+import utils
+
+DEADLINE = 1.0
+STALLED = 600 # a third of them of each kind
+MAX_LATENESS = 1.0 # the reaper and a busy single CPU, not another timeout
+
+
+class FakeConnection:
+    def __init__(self, client_id):
+        self.client_id = client_id
+
+
+def test_deadlines_expire_in_order_and_follow_the_latest_set():
+    deadlines = utils.Deadlines()
+    first, second, third = FakeConnection(1), FakeConnection(2), FakeConnection(3)
+    assert deadlines.set(second, 0.02, "idle")
+    assert deadlines.set(first, 0.01, "handshake") # earlier, the reaper must wake up
+    assert not deadlines.set(third, 0.03, "frame")
+    assert deadlines.expire() == []
+    deadlines.set(third, 10, "idle") # it moved on, the pending entry must not expire it
+    time.sleep(0.05)
+    assert deadlines.expire() == [(first, "handshake"), (second, "idle")]
+    assert deadlines.expire() == []
+    assert len(deadlines) == 1
+    deadlines.discard(third)
+    assert len(deadlines) == 0
+
+
+def test_deadline_of_zero_never_expires():
+    deadlines = utils.Deadlines()
+    connection = FakeConnection(1)
+    deadlines.set(connection, 0.01, "idle")
+    assert not deadlines.set(connection, 0, "idle")
+    time.sleep(0.02)
+    assert deadlines.expire() == []
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_stalled_connections_are_reaped_on_schedule(engine):
+    args = argparse.Namespace(steady=4, stalled=STALLED, kinds=["silent", "idle", "partial"],
+                              concurrency=50, timeout=10.0, deadline=DEADLINE,
+                              wait=10 * DEADLINE, idle=0.5)
+    metrics_port = benchmark.free_port()
+    timeouts = [arg for name in ("handshake", "idle", "frame")
+                for arg in (f"--{name}-timeout", str(DEADLINE))]
+    with benchmark.running_server("--engine", engine, "--metrics-port", str(metrics_port),
+                                  *timeouts) as (_, port):
+        # a steady session that fails a ping makes this raise
+        lateness, idle, during = asyncio.run(benchmark.measure_reaper(port, args))
+        reaped = benchmark.server_counters(metrics_port)["connections_reaped"]
+    closed = [late for values in lateness.values() for late in values]
+    assert len(closed) == STALLED
+    assert reaped == STALLED
+    assert -0.25 < min(closed) and max(closed) < MAX_LATENESS
+    assert idle and during
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import struct
+import benchmark
+import pytest
+import utils
+
+
+class ChunkedSocket:
+    """Serves each of `chunks` from its own recv_into call, like separate TCP reads."""
+
+    def __init__(self, chunks):
+        self.chunks = [memoryview(chunk) for chunk in chunks]
+        self.reads = 0
+
+    def recv_into(self, view):
+        self.reads += 1
+        if not self.chunks:
+            return 0
+        chunk = self.chunks[0]
+        size = min(len(view), len(chunk))
+        view[:size] = chunk[:size]
+        if size < len(chunk):
+            self.chunks[0] = chunk[size:]
+        else:
+            self.chunks.pop(0)
+        return size
+
+
+def encrypted_frame(cipher, message):
+    return bytes(utils.FrameWriter(cipher).frame(message))
+
+
+def read_messages(reader, cipher, count):
+    messages = []
+    for _ in range(count):
+        iv, ciphertext, mac = reader.read_frame(cipher.iv_size, cipher.mac_size)
+        cipher.verify(iv, ciphertext, mac)
+        messages.append(bytes(cipher.decrypt_verified_bytes(iv, ciphertext, mac)))
+    return messages
+
+
+def test_frames_of_one_read_are_parsed_without_another_recv():
+    cipher = utils.CbcHmacCipher(os.urandom(16), os.urandom(32))
+    messages = [b"first", b"second" * 100, b""]
+    socket = ChunkedSocket([b"".join(encrypted_frame(cipher, m) for m in messages)])
+    reader = utils.FrameReader(socket)
+    assert read_messages(reader, cipher, len(messages)) == messages
+    assert socket.reads == 1
+    assert reader.available() == 0
+
+
+def test_frame_split_across_reads_is_reassembled():
+    cipher = utils.CbcHmacCipher(os.urandom(16), os.urandom(32))
+    small, large = b"split", os.urandom(40_000) # larger than the reader's buffer
+    data = encrypted_frame(cipher, small) + encrypted_frame(cipher, large)
+    # inside the size of the first frame, its ciphertext and the second frame
+    cuts = [0, 2, 30, 50, 60, 20_000, len(data)]
+    socket = ChunkedSocket([data[start:end] for start, end in zip(cuts, cuts[1:])])
+    reader = utils.FrameReader(socket, buffer_size=1024)
+    assert read_messages(reader, cipher, 2) == [small, large]
+    assert not socket.chunks and reader.available() == 0
+
+
+def legacy_frame(key, text):
+    iv = os.urandom(utils.AES_BLOCK_SIZE)
+    ciphertext = utils.aes_cbc_encrypt(iv, text, key)
+    return struct.pack("!I", len(ciphertext)) + iv + ciphertext + utils.calculate_hmac(
+        ciphertext, key)
+
+
+async def send_pipelined_and_split(port):
+    """Send three frames in one write, then one frame a few bytes at a time;
+    return the replies."""
+    reader, writer, key = await benchmark.open_session("127.0.0.1", port)
+    writer.write(b"".join(legacy_frame(key, f"pipelined {i}") for i in range(3)))
+    await writer.drain()
+    frame = legacy_frame(key, "split")
+    for start in range(0, len(frame), 7):
+        writer.write(frame[start:start + 7])
+        await writer.drain()
+        await asyncio.sleep(0.01) # each piece arrives on its own
+    replies = [await asyncio.wait_for(benchmark.read_frame(reader, key), 10) for _ in range(4)]
+    writer.close()
+    return replies
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_server_reads_pipelined_and_split_frames(engine):
+    with benchmark.running_server("--engine", engine) as (_, port):
+        replies = asyncio.run(send_pipelined_and_split(port))
+    assert replies == [utils.ServerMessages.OK] * 4
@@ -0,0 +1,18 @@
+import argparse
+import asyncio
+import benchmark
+import utils
+
+
+def test_steady_sessions_stay_fast_during_a_handshake_storm():
+    """With --handshake-workers the MODP math of a burst of new clients runs in
+    other processes, so pings of connected sessions barely slow down."""
+    args = argparse.Namespace(steady=4, handshakes=100, concurrency=8, idle=1.0, timeout=30.0)
+    with benchmark.running_server("--handshake-workers", "2",
+                                  "--keypair-pool-size", "0") as (_, port):
+        idle, during, _, failed = asyncio.run(
+            benchmark.measure_storm(port, args, utils.MODP_3072))
+    assert failed == 0
+    idle_p50 = benchmark.percentile(idle, 0.5)
+    # without workers the storm's p50 is about 10 times the idle one
+    assert benchmark.percentile(during, 0.5) < max(4 * idle_p50, 0.005)
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import stat
+import benchmark
+import journal
+import pytest
+import session
+import utils
+
+
+def test_new_segment_is_in_a_synced_directory_before_its_commit(tmp_path, monkeypatch):
+    events = []
+    fsync = os.fsync
+
+    def recording_fsync(fd):
+        events.append("directory" if stat.S_ISDIR(os.fstat(fd).st_mode) else "file")
+        fsync(fd)
+    monkeypatch.setattr(os, "fsync", recording_fsync)
+
+    log = journal.Journal(str(tmp_path), commit_interval=0, segment_size=64)
+    assert events == ["directory"] # the first segment
+    log.start()
+    try:
+        # the first commit fills the segment and starts the next one
+        commit = log.append(1, [(0, "x" * 64)])
+        synced = []
+        commit.add_done_callback(lambda _: synced.append(events.count("directory") == 2))
+        commit.result(10)
+        log.append(1, [(0, "in the second segment")]).result(10)
+    finally:
+        log.close()
+    assert synced == [True]
+    assert len(journal.list_segments(str(tmp_path))) == 2
+    records = list(journal.JournalReader(str(tmp_path)).replay())
+    assert [record.payload for record in records] == [b"x" * 64, b"in the second segment"]
+
+
+async def send_on_a_channel(port):
+    """Open a channel, send a text on it and close it, then send a text on channel 0."""
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, resumption=False,
+                                   ack_every=0, channels=4)
+    await client.connect()
+    channel = await client.open_channel()
+    await channel.send("on the channel")
+    await channel.close()
+    await client.send("on channel 0")
+    # OK comes after the commit, of the channel's messages too
+    await asyncio.wait_for(client.drain_acknowledgements(), 10)
+    await client.close()
+    return channel.channel_id
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_control_messages_are_not_journaled(engine, tmp_path):
+    with benchmark.running_server("--engine", engine, "--journal", str(tmp_path)) as (_, port):
+        channel_id = asyncio.run(send_on_a_channel(port))
+    records = list(journal.JournalReader(str(tmp_path)).replay())
+    assert [(record.channel, record.payload) for record in records] == [
+        (channel_id, b"on the channel"), (0, b"on channel 0")]
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import struct
+import time
+from Crypto.Cipher import AES
+import benchmark
+import pytest
+import utils
+
+MAX_FRAME_SIZE = 64 * 1024
+FLOOD_SESSIONS = 8
+FLOOD_SECONDS = 2
+MAX_RSS_GROWTH_MB = 64 # the claimed frames alone would be FLOOD_SESSIONS GB
+FRAMES_PER_SECOND = 50
+
+
+def test_receive_budget_delays_a_sender_over_its_rate():
+    budget = utils.ReceiveBudget(frames_per_second=10, bytes_per_second=1000)
+    assert all(budget.charge(1, 10) == 0 for _ in range(10)) # a second's burst is free
+    assert budget.charge(1, 10) == pytest.approx(0.1, abs=0.01)
+    budget = utils.ReceiveBudget(bytes_per_second=1000)
+    assert budget.charge(1, 1500) == pytest.approx(0.5, abs=0.01)
+    assert utils.ReceiveBudget().charge(1000, 10 ** 9) == 0 # no rate, no limit
+
+
+async def announce_oversized(port, size):
+    """Announce a frame of `size` bytes; return the reply and whether the
+    server closed the connection afterwards."""
+    reader, writer, key = await benchmark.open_session("127.0.0.1", port)
+    writer.write(struct.pack("!I", size))
+    await writer.drain()
+    reply = await asyncio.wait_for(benchmark.read_frame(reader, key), 10)
+    closed = await asyncio.wait_for(reader.read(1), 10) == b""
+    writer.close()
+    return reply, closed
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_frame_over_the_limit_is_refused(engine):
+    metrics_port = benchmark.free_port()
+    with benchmark.running_server("--engine", engine, "--metrics-port", str(metrics_port),
+                                  "--max-frame-size", str(MAX_FRAME_SIZE)) as (_, port):
+        reply, closed = asyncio.run(announce_oversized(port, MAX_FRAME_SIZE + 1))
+        assert reply == utils.ServerMessages.FAIL and closed
+        assert benchmark.server_counters(metrics_port)["frames_refused"] == 1
+
+
+async def send_bad_frame(port, forged_mac):
+    """Send a frame whose MAC is forged, or whose MAC is right but whose padding is
+    malformed; return the reply and whether the server closed the connection."""
+    reader, writer, key = await benchmark.open_session("127.0.0.1", port)
+    iv = os.urandom(utils.AES_BLOCK_SIZE)
+    # a block ending in a 0 byte, which is no valid padding
+    ciphertext = AES.new(key, AES.MODE_CBC, iv).encrypt(bytes(utils.AES_BLOCK_SIZE))
+    mac = bytes(32) if forged_mac else utils.calculate_hmac(ciphertext, key)
+    writer.write(struct.pack("!I", len(ciphertext)) + iv + ciphertext + mac)
+    await writer.drain()
+    reply = await asyncio.wait_for(benchmark.read_frame(reader, key), 10)
+    closed = await asyncio.wait_for(reader.read(1), 10) == b""
+    writer.close()
+    return reply, closed
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_malformed_record_is_not_an_authentication_failure(engine):
+    metrics_port = benchmark.free_port()
+    with benchmark.running_server("--engine", engine,
+                                  "--metrics-port", str(metrics_port)) as (_, port):
+        for forged_mac in (False, True):
+            reply, closed = asyncio.run(send_bad_frame(port, forged_mac))
+            assert reply == utils.ServerMessages.FAIL and closed
+        counters = benchmark.server_counters(metrics_port)
+    assert counters["record_errors"] == 1
+    assert counters["mac_failures"] == 1
+
+
+async def flood(port, flooder, *args):
+    return sum(await asyncio.gather(*(flooder(port, *args) for _ in range(FLOOD_SESSIONS))))
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_oversized_flood_keeps_memory_bounded(engine):
+    metrics_port = benchmark.free_port()
+    with benchmark.running_server("--engine", engine,
+                                  "--metrics-port", str(metrics_port)) as (process, port):
+        baseline = benchmark.process_stats(process.pid)["VmRSS"]
+        asyncio.run(flood(port, benchmark.flood_oversized, 2 ** 30, FLOOD_SECONDS))
+        assert process.poll() is None
+        assert benchmark.process_stats(process.pid)["VmHWM"] < baseline + MAX_RSS_GROWTH_MB
+        assert benchmark.server_counters(metrics_port)["frames_refused"] == FLOOD_SESSIONS
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_frame_budget_cuts_off_a_pipelining_sender(engine):
+    metrics_port = benchmark.free_port()
+    with benchmark.running_server("--engine", engine, "--metrics-port", str(metrics_port),
+                                  "--max-frames-per-second", str(FRAMES_PER_SECOND)) as (
+            process, port):
+        baseline = benchmark.process_stats(process.pid)["VmRSS"]
+        start = time.monotonic()
+        sent = asyncio.run(flood(port, benchmark.flood_frames, 100, FLOOD_SECONDS))
+        elapsed = time.monotonic() - start
+        counters = benchmark.server_counters(metrics_port)
+        assert process.poll() is None
+        assert benchmark.process_stats(process.pid)["VmHWM"] < baseline + MAX_RSS_GROWTH_MB
+    # a second's burst, then FRAMES_PER_SECOND, while the flooders sent far more
+    allowed = FLOOD_SESSIONS * FRAMES_PER_SECOND * (elapsed + 1)
+    assert counters["throttled"] > 0
+    assert counters["frames_in"] <= allowed
+    assert sent > 10 * allowed * 100 # bytes, each frame holds over 100 of them
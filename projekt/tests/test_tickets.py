@@ -0,0 +1,85 @@
+import asyncio
+import time
+import benchmark
+import pytest
+import session
+import utils
+
+SECRET = b"r" * 32
+
+
+class Clock:
+    """Stands in for time.time, moved forward by the test."""
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "time", clock)
+    return clock
+
+
+def test_ticket_opens_until_its_lifetime_ends(clock):
+    store = utils.TicketKeyStore(lifetime=60)
+    ticket = store.issue(SECRET)
+    assert store.open(ticket) == SECRET
+    assert store.open(ticket[:-1] + bytes([ticket[-1] ^ 1])) is None # tampered
+    clock.now += 61
+    assert store.open(ticket) is None
+
+
+def test_rotated_key_opens_older_tickets_until_it_is_evicted(clock):
+    store = utils.TicketKeyStore(lifetime=40, max_keys=2) # a new key every 10 s
+    first = store.issue(SECRET)
+    clock.now += 11
+    second = store.issue(SECRET)
+    assert first[:4] != second[:4] # sealed with different keys
+    assert store.open(first) == SECRET
+    clock.now += 11
+    store.issue(SECRET) # a third key evicts the first one
+    assert store.open(first) is None
+    assert store.open(second) == SECRET
+
+
+def test_workers_sharing_a_secret_open_each_others_tickets(clock):
+    issuer = utils.TicketKeyStore(lifetime=40, secret=b"shared")
+    ticket = issuer.issue(SECRET)
+    clock.now += 11 # the other worker derives the current key, then finds the older one
+    assert utils.TicketKeyStore(lifetime=40, secret=b"shared").open(ticket) == SECRET
+    assert utils.TicketKeyStore(lifetime=40, secret=b"other").open(ticket) is None
+
+
+async def reconnect(port, wait):
+    """Connect, disconnect, wait `wait` seconds and connect again with the ticket;
+    return whether the second session was resumed and its reply."""
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, ack_every=0)
+    await client.connect()
+    assert not client.resumed and client.session_ticket
+    await client.close()
+    await asyncio.sleep(wait)
+    await client.connect()
+    await client.send("after a reconnect")
+    client.flush()
+    reply = await asyncio.wait_for(anext(client.replies()), 10)
+    await client.close()
+    return client.resumed, reply
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_reconnect_resumes_with_the_ticket(engine):
+    with benchmark.running_server("--engine", engine) as (_, port):
+        resumed, reply = asyncio.run(reconnect(port, 0))
+    assert resumed and reply == utils.ServerMessages.OK.encode()
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_expired_ticket_falls_back_to_a_full_handshake(engine):
+    with benchmark.running_server("--engine", engine, "--ticket-lifetime", "1") as (_, port):
+        resumed, reply = asyncio.run(reconnect(port, 1.5))
+    assert not resumed and reply == utils.ServerMessages.OK.encode()
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import benchmark
+import pytest
+import session
+import utils
+
+HEADER, CHUNK = utils.MessageKind.FILE_HEADER, utils.MessageKind.FILE_CHUNK
+
+
+async def failed_channel(port, messages):
+    """Send (kind, message) pairs on a channel of a multiplexed session; return whether
+    the channel got FAIL and whether channel 0 still gets its OK afterwards."""
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, resumption=False,
+                                   ack_every=0, channels=4)
+    await client.connect()
+    channel = await client.open_channel()
+    for kind, message in messages:
+        await channel.send(message, kind)
+    client.flush()
+
+    async def channel_replies():
+        return [reply async for reply in channel.replies()]
+    replies = await asyncio.wait_for(channel_replies(), 10)
+    await client.send("still here")
+    await asyncio.wait_for(client.drain_acknowledgements(), 10)
+    alive = client.connected and not client.unacknowledged
+    await client.close()
+    return replies[-1] == utils.ServerMessages.FAIL.encode(), alive
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_short_chunk_fails_only_its_channel(engine, tmp_path):
+    with benchmark.running_server("--engine", engine, "--upload-dir", str(tmp_path)) as (_, port):
+        failed, alive = asyncio.run(failed_channel(port, [(HEADER, "10 a.bin"),
+                                                          (CHUNK, b"abc")]))
+    assert failed and alive
+    assert not os.listdir(tmp_path) # the partial file is removed
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_upload_does_not_overwrite_an_existing_file(engine, tmp_path):
+    (tmp_path / "a.bin").write_bytes(b"someone else's")
+    with benchmark.running_server("--engine", engine, "--upload-dir", str(tmp_path)) as (_, port):
+        failed, alive = asyncio.run(failed_channel(port, [(HEADER, "3 a.bin"),
+                                                          (CHUNK, bytes(8) + b"new")]))
+    assert failed and alive
+    assert (tmp_path / "a.bin").read_bytes() == b"someone else's"
+
+
+async def send_texts(port, texts):
+    """Send `texts` on a session with an OK per message; return the replies."""
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, resumption=False,
+                                   ack_every=0)
+    await client.connect()
+    await client.send_many(texts)
+    await asyncio.wait_for(client.drain_acknowledgements(), 10)
+    await client.close()
+    return [reply async for reply in client.replies()]
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_text_that_looks_like_a_file_header_stays_text(engine, tmp_path):
+    texts = ["FILE of the year award", "FILE 5 notes.txt", "hello world"]
+    with benchmark.running_server("--engine", engine, "--upload-dir", str(tmp_path)) as (_, port):
+        replies = asyncio.run(send_texts(port, texts))
+    assert replies == [utils.ServerMessages.OK.encode()] * len(texts)
+    assert not os.listdir(tmp_path)
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_message_that_is_not_utf8_is_accepted(engine):
+    messages = [b"\xff\xfe\x00binary", "still here"]
+    with benchmark.running_server("--engine", engine) as (_, port):
+        replies = asyncio.run(send_texts(port, messages))
+    assert replies == [utils.ServerMessages.OK.encode()] * len(messages)
+
+
+async def upload(port, path, chunk_size):
+    client = session.ClientSession("127.0.0.1", port, dh_group=utils.X25519, resumption=False)
+    await client.connect()
+    await client.send_file(path, chunk_size)
+    await asyncio.wait_for(client.drain_acknowledgements(), 10)
+    uploaded = client.connected and not client.unacknowledged
+    await client.close()
+    return uploaded
+
+
+@pytest.mark.parametrize("engine", utils.SERVER_ENGINES)
+def test_file_arrives_whole(engine, tmp_path):
+    source = tmp_path / "source" / "data.bin"
+    source.parent.mkdir()
+    source.write_bytes(os.urandom(100_000))
+    uploads = tmp_path / "uploads"
+    with benchmark.running_server("--engine", engine, "--upload-dir", str(uploads)) as (_, port):
+        assert asyncio.run(upload(port, str(source), 4096))
+    assert (uploads / "data.bin").read_bytes() == source.read_bytes()
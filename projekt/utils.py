@@ -1,18 +1,107 @@
+import os
 import random
+import secrets
+import select
+import socket
+import string
 import struct
+import sys
 import argparse
+import heapq
 import threading
 import time
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
+from Crypto.Cipher import AES, ChaCha20_Poly1305
+from Crypto.Util.Padding import pad
 from Crypto.Hash import HMAC, SHA256
+from Crypto.PublicKey import ECC
+from Crypto.Protocol.DH import key_agreement, import_x25519_public_key
+from Crypto.Protocol.KDF import HKDF
 import hashlib
-from enum import Enum
+import hmac
+from enum import Enum, IntEnum
+from collections import OrderedDict, deque
+from queue import Empty, SimpleQueue
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+import multiprocessing
 
 DEFAULT_SERVER_PORT = 12345
 AES_BLOCK_SIZE = 16
+MAC_SIZE = 32
 DEFAULT_HOST_SERVER = "0.0.0.0"
 DEFAULT_HOST_CLIENT = "127.0.0.1"
+SERVER_ENGINES = ("threads", "asyncio")
+
+CLIENT_HELLO = b"ClientHello"
+SERVER_HELLO = b"ServerHello"
+# extended Hello messages carrying a list of extensions, e.g. the cipher suite
+CLIENT_HELLO_V2 = b"ClientHelv2"
+SERVER_HELLO_V2 = b"ServerHelv2"
+HELLO_TYPE_SIZE = 11
+
+
+class CipherSuite(IntEnum):
+    CBC_HMAC_SHA256 = 1
+    AES_GCM = 2
+    CHACHA20_POLY1305 = 3
+
+CIPHER_SUITE_NAMES = {
+    "cbc-hmac": CipherSuite.CBC_HMAC_SHA256,
+    "chacha20-poly1305": CipherSuite.CHACHA20_POLY1305,
+    "aes-gcm": CipherSuite.AES_GCM,
+}
+
+class HelloExtension(IntEnum):
+    CIPHER_SUITES = 1
+    KEY_SHARE = 2
+    SESSION_TICKET = 3
+    RANDOM = 4 # client and server random of a resumed session
+    DH_GROUP = 5 # named group id, KEY_SHARE then carries only the public key
+    ACKNOWLEDGEMENTS = 6 # sequenced client frames acknowledged cumulatively
+    COALESCING = 7 # frames carry records of length prefixed messages, up to a size
+    CHANNELS = 8 # every message starts with a channel id, up to a number of open channels
+    TRANSFERS = 9 # every client message starts with a MessageKind, so files can be sent
+
+class MessageKind(IntEnum):
+    """First byte of a client message once TRANSFERS is negotiated, after the channel id."""
+    TEXT = 0
+    FILE_HEADER = 1 # "<size> <name>" of a file whose chunks follow
+    FILE_CHUNK = 2 # 8B offset + data
+
+RANDOM_SIZE = 16
+DEFAULT_TICKET_LIFETIME = 3600
+DEFAULT_ACK_EVERY = 16
+DEFAULT_ACK_DELAY_MS = 5
+MAX_ACK_EVERY = 1024
+MAX_ACK_DELAY_MS = 1000
+DEFAULT_SEND_WINDOW = 64
+DEFAULT_RECORD_SIZE = 16 * 1024
+MAX_RECORD_SIZE = 1024 * 1024
+DEFAULT_COALESCE_DELAY_MS = 1
+MAX_CHANNELS = 1024 # open channels of a connection, channel 0 included
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_UPLOAD_DIR = "uploads"
+# the whole shutdown, not each connection, must fit in the timeout
+DEFAULT_SHUTDOWN_TIMEOUT = 5.0
+END_SESSION_GRACE = 0.1 # time clients get to read EndSession before the sockets close
+# ciphertext bytes of one client frame: a full record or file chunk fits many times over
+DEFAULT_MAX_FRAME_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_PENDING_OUTPUT = 64 * 1024
+# seconds a client may take for ClientHello, stay silent between frames and send one frame
+DEFAULT_HANDSHAKE_TIMEOUT = 10.0
+DEFAULT_IDLE_TIMEOUT = 300.0
+DEFAULT_FRAME_TIMEOUT = 30.0
+DEFAULT_MAX_PENDING_HANDSHAKES = 256
+MAX_ADMISSION_ADDRESSES = 65536 # per-address handshake buckets kept, least recently used go
+DEFAULT_LISTEN_BACKLOG = 128
+DEFAULT_BROADCAST_THREADS = min(8, os.cpu_count() or 1)
+BROADCAST_TIMEOUT = 1.0 # s the console waits for the copies of a broadcast to be written
+DEFAULT_JOURNAL_COMMIT_MS = 5
+DEFAULT_JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024
+# smaller messages are sent faster as a new ciphertext gathered by sendmsg than encrypted in
+# place through pycryptodome's output= argument; from here on both match and in place allocates
+# no payload-sized buffer
+ENCRYPT_IN_PLACE_SIZE = 128 * 1024
 
 
 def generate_private_key(bits=16):
@@ -29,27 +118,1423 @@ def calculate_shared_secret(public_key, private_key, p):
     return pow(public_key, private_key, p)
 
 def derive_symmetric_key(shared_secret):
-    """Derive a symmetric key from the shared secret K."""
-    return hashlib.sha256(str(shared_secret).encode()).digest()[:16]
+    """Derive a symmetric key from the shared secret K (an integer or X25519 bytes)."""
+    if not isinstance(shared_secret, bytes):
+        shared_secret = str(shared_secret).encode()
+    return hashlib.sha256(shared_secret).digest()[:16]
+
+def derive_session_key(shared_secret):
+    """Session key of an extended handshake: HKDF-SHA256 over the whole shared secret K."""
+    if not isinstance(shared_secret, bytes):
+        shared_secret = shared_secret.to_bytes((shared_secret.bit_length() + 7) // 8, "big")
+    return HKDF(shared_secret, 32, b"", SHA256, context=b"session key")
+
+def derive_traffic_keys(session_key, key_size=16):
+    """Separate (encryption, MAC) keys of a session, expanded from its key with HKDF-SHA256."""
+    return HKDF(session_key, key_size, b"", SHA256, num_keys=2, context=b"traffic keys")
+
+def validate_public_key(public_key, p):
+    """Reject public keys that would force a trivial shared secret."""
+    if not 1 < public_key < p - 1:
+        raise ValueError("Invalid Diffie-Hellman public key")
+
+def encode_ints(*values):
+    """Encode non-negative integers as 2B length + big-endian bytes each."""
+    encoded = b""
+    for value in values:
+        data = value.to_bytes(max(1, (value.bit_length() + 7) // 8), "big")
+        encoded += struct.pack("!H", len(data)) + data
+    return encoded
+
+def decode_ints(data):
+    """Decode a list of integers encoded by encode_ints."""
+    values = []
+    offset = 0
+    while offset < len(data):
+        size = struct.unpack_from("!H", data, offset)[0]
+        offset += 2
+        if offset + size > len(data):
+            raise ValueError("Truncated integer")
+        values.append(int.from_bytes(data[offset:offset + size], "big"))
+        offset += size
+    return values
+
+class DHGroup:
+    """Named finite field group with the private exponent size it calls for."""
+    # pow() on 2048+ bit numbers holds the GIL for milliseconds, worth a worker process
+    offload = True
+
+    def __init__(self, group_id, name, p, g, exponent_bits):
+        self.group_id = group_id
+        self.name = name
+        self.p = p
+        self.g = g
+        self.exponent_bits = exponent_bits
+
+    def generate_keypair(self):
+        """Return a fresh (private key, public key) pair."""
+        private_key = secrets.randbits(self.exponent_bits) | 1 << (self.exponent_bits - 1)
+        return private_key, calculate_public_key(self.g, private_key, self.p)
+
+    def encode_public_key(self, public_key):
+        return encode_ints(public_key)
+
+    def decode_public_key(self, data):
+        public_key = decode_ints(data)[0]
+        validate_public_key(public_key, self.p)
+        return public_key
+
+    def shared_secret(self, private_key, public_key):
+        return calculate_shared_secret(public_key, private_key, self.p)
+
+
+class X25519Group:
+    """Elliptic curve Diffie-Hellman over Curve25519 (RFC 7748).
+
+    Same interface as DHGroup, public keys travel as raw 32 B strings.
+    """
+    group_id = 29 # x25519 in the TLS NamedGroup registry
+    name = "x25519"
+    # cheaper than a round trip to a worker process, and ECC keys cannot be pickled
+    offload = False
+
+    def generate_keypair(self):
+        private_key = ECC.generate(curve="Curve25519")
+        return private_key, private_key.public_key().export_key(format="raw")
+
+    def encode_public_key(self, public_key):
+        return public_key
+
+    def decode_public_key(self, data):
+        import_x25519_public_key(data) # raises ValueError for an invalid point
+        return data
+
+    def shared_secret(self, private_key, public_key):
+        return key_agreement(static_priv=private_key,
+                             static_pub=import_x25519_public_key(public_key),
+                             kdf=lambda secret: secret)
+
+# RFC 3526 MODP groups, ids as in the RFC
+MODP_2048 = DHGroup(14, "modp2048", int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1"
+    "29024E088A67CC74020BBEA63B139B22514A08798E3404DD"
+    "EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245"
+    "E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3D"
+    "C2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F"
+    "83655D23DCA3AD961C62F356208552BB9ED529077096966D"
+    "670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9"
+    "DE2BCBF6955817183995497CEA956AE515D2261898FA0510"
+    "15728E5A8AACAA68FFFFFFFFFFFFFFFF", 16), 2, 256)
+MODP_3072 = DHGroup(15, "modp3072", int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1"
+    "29024E088A67CC74020BBEA63B139B22514A08798E3404DD"
+    "EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245"
+    "E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3D"
+    "C2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F"
+    "83655D23DCA3AD961C62F356208552BB9ED529077096966D"
+    "670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9"
+    "DE2BCBF6955817183995497CEA956AE515D2261898FA0510"
+    "15728E5A8AAAC42DAD33170D04507A33A85521ABDF1CBA64"
+    "ECFB850458DBEF0A8AEA71575D060C7DB3970F85A6E1E4C7"
+    "ABF5AE8CDB0933D71E8C94E04A25619DCEE3D2261AD2EE6B"
+    "F12FFA06D98A0864D87602733EC86A64521F2B18177B200C"
+    "BBE117577A615D6C770988C0BAD946E208E24FA074E5AB31"
+    "43DB5BFCE0FD108E4B82D120A93AD2CAFFFFFFFFFFFFFFFF", 16), 2, 320)
+X25519 = X25519Group()
+DH_GROUPS = {group.group_id: group for group in (MODP_2048, MODP_3072, X25519)}
+DH_GROUP_NAMES = {group.name: group for group in DH_GROUPS.values()}
+# custom groups sent in ClientHello are only accepted up to this size
+MAX_CUSTOM_GROUP_BITS = 4096
+DEFAULT_KEYPAIR_POOL_SIZE = 16
+DEFAULT_HANDSHAKE_WORKERS = 0
+
+def server_key_exchange(group_id, p, g, client_public_key, keypair=None):
+    """Return the server's (public key, shared secret K) for a ClientHello.
+
+    Without a ready keypair one is generated, for the named group or for p
+    and g. Module level with picklable arguments, so it can run in a worker
+    process of a ProcessPoolExecutor.
+    """
+    if group_id is None:
+        private_key = generate_private_key()
+        public_key = calculate_public_key(g, private_key, p)
+        return public_key, calculate_shared_secret(client_public_key, private_key, p)
+    group = DH_GROUPS[group_id]
+    private_key, public_key = keypair or group.generate_keypair()
+    return public_key, group.shared_secret(private_key, client_public_key)
+
+def create_handshake_executor(workers):
+    """Process pool for the Diffie-Hellman math of handshakes, None for 0 workers."""
+    if workers <= 0:
+        return None
+    # spawn: forking a process that already runs threads is unsafe
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+
+class KeypairPool(threading.Thread):
+    """Precomputed (private, public) keypairs for every named group, including x25519.
+
+    The handshake takes a ready keypair instead of running pow() on the
+    accept path. Once a pool drops to half of `size` this thread refills it
+    in one batch, so the refill mostly runs between bursts of handshakes
+    rather than competing with each of them. With an executor, MODP keypairs
+    of the batch are computed in its worker processes. take() returns None
+    for an empty pool and the handshake computes its own keypair.
+    """
+
+    def __init__(self, size=DEFAULT_KEYPAIR_POOL_SIZE, groups=tuple(DH_GROUPS.values()),
+                 executor: Executor = None):
+        super().__init__(daemon=True)
+        self.size = size
+        self.executor = executor
+        self.low_water_mark = size // 2
+        self.groups = {group.group_id: group for group in groups}
+        self.pools = {group_id: deque() for group_id in self.groups}
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.misses = 0
+
+    def take(self, group: DHGroup | X25519Group):
+        with self.condition:
+            pool = self.pools.get(group.group_id)
+            if pool:
+                keypair = pool.popleft()
+                if len(pool) <= self.low_water_mark:
+                    self.condition.notify()
+                return keypair
+            self.misses += 1
+        return None
+
+    def generate_keypair(self, group: DHGroup | X25519Group):
+        if self.executor and group.offload:
+            return self.executor.submit(group.generate_keypair).result()
+        return group.generate_keypair()
+
+    def pool_to_refill(self):
+        for group_id, pool in self.pools.items():
+            if len(pool) <= self.low_water_mark:
+                return group_id
+        return None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.condition:
+                self.condition.wait_for(lambda: self.stop_event.is_set()
+                                        or self.pool_to_refill() is not None)
+                group_id = self.pool_to_refill()
+            while group_id is not None and not self.stop_event.is_set():
+                keypair = self.generate_keypair(self.groups[group_id])
+                with self.condition:
+                    self.pools[group_id].append(keypair)
+                    if len(self.pools[group_id]) >= self.size:
+                        group_id = None
+
+    def stop(self):
+        with self.condition:
+            self.stop_event.set()
+            self.condition.notify()
+
+def to_bytes(plaintext):
+    return plaintext.encode() if isinstance(plaintext, str) else plaintext
 
 def aes_cbc_encrypt(iv, plaintext, key):
     """Encrypt plaintext using AES in CBC mode."""
-    padded_data = pad(plaintext.encode(), AES_BLOCK_SIZE)
+    padded_data = pad(to_bytes(plaintext), AES_BLOCK_SIZE)
     encryptor = AES.new(key, AES.MODE_CBC, iv)
     ciphertext = encryptor.encrypt(padded_data)
     return ciphertext
 
+def aes_cbc_encrypt_into(output, iv, plaintext, key):
+    """Encrypt bytes-like plaintext with AES-CBC and PKCS#7 padding into `output`.
+
+    Whole blocks are encrypted straight from the plaintext, only the last
+    partial block is padded in a separate small buffer, so the plaintext is
+    never copied.
+    """
+    plaintext = memoryview(to_bytes(plaintext))
+    output = memoryview(output)
+    whole = len(plaintext) - len(plaintext) % AES_BLOCK_SIZE
+    padding = AES_BLOCK_SIZE - len(plaintext) % AES_BLOCK_SIZE
+    encryptor = AES.new(key, AES.MODE_CBC, iv)
+    if whole:
+        encryptor.encrypt(plaintext[:whole], output=output[:whole])
+    encryptor.encrypt(bytes(plaintext[whole:]) + bytes([padding]) * padding,
+                      output=output[whole:whole + AES_BLOCK_SIZE])
+
+def aes_cbc_decrypt_bytes(iv, ciphertext, key):
+    """Decrypt ciphertext using AES in CBC mode, removing the padding in place."""
+    plaintext = bytearray(len(ciphertext))
+    AES.new(key, AES.MODE_CBC, iv).decrypt(ciphertext, output=plaintext)
+    padding = plaintext[-1] if plaintext else 0
+    if not 1 <= padding <= AES_BLOCK_SIZE or plaintext[-padding:] != bytes([padding]) * padding:
+        raise ValueError("Padding is incorrect.")
+    del plaintext[-padding:]
+    return plaintext
+
 def aes_cbc_decrypt(iv, ciphertext, key):
-    """Decrypt ciphertext using AES in CBC mode."""
-    decryptor = AES.new(key, AES.MODE_CBC, iv)
-    decrypted_data = unpad(decryptor.decrypt(ciphertext), AES_BLOCK_SIZE)
-    return decrypted_data.decode()
-
-def calculate_hmac(message, key):
-    """Calculate HMAC-SHA-256 for the message using the given key."""
-    hmac_obj = HMAC.new(key, message, SHA256)
+    return aes_cbc_decrypt_bytes(iv, ciphertext, key).decode()
+
+def calculate_hmac(message, key, aad=b""):
+    """Calculate HMAC-SHA-256 of `aad` followed by the message using the given key."""
+    hmac_obj = hmac.new(key, aad, hashlib.sha256)
+    hmac_obj.update(message)
     return hmac_obj.digest()
 
+class AuthenticationError(Exception):
+    pass
+
+class CbcHmacCipher:
+    """AES-CBC followed by HMAC-SHA-256 of the ciphertext (Encrypt-then-MAC).
+
+    One instance serves a whole session. The HMAC state after absorbing the
+    key pads is computed once and copied for every frame, instead of keying
+    a new HMAC each time. pycryptodome offers no way to reuse an expanded
+    AES key with a new IV, so that part stays per frame.
+    """
+    suite = CipherSuite.CBC_HMAC_SHA256
+    key_size = 16
+    iv_size = AES_BLOCK_SIZE
+    mac_size = MAC_SIZE
+
+    def __init__(self, key, mac_key=None):
+        self.key = key
+        self.hmac = hmac.new(mac_key or key, digestmod=hashlib.sha256)
+
+    def calculate_mac(self, ciphertext, aad=b""):
+        mac = self.hmac.copy()
+        if aad:
+            mac.update(aad)
+        mac.update(ciphertext)
+        return mac.digest()
+
+    def ciphertext_size(self, plaintext_size):
+        return plaintext_size - plaintext_size % AES_BLOCK_SIZE + AES_BLOCK_SIZE
+
+    def encrypt(self, plaintext, aad=b""):
+        """Return (iv, ciphertext, mac) of a message; the MAC also covers `aad`."""
+        iv = os.urandom(self.iv_size)
+        ciphertext = aes_cbc_encrypt(iv, plaintext, self.key)
+        return iv, ciphertext, self.calculate_mac(ciphertext, aad)
+
+    def encrypt_into(self, output, plaintext, aad=b""):
+        """Write iv|ciphertext|mac of bytes-like plaintext into the memoryview `output`."""
+        iv = os.urandom(self.iv_size)
+        output[:self.iv_size] = iv
+        end = self.iv_size + self.ciphertext_size(len(plaintext))
+        ciphertext = output[self.iv_size:end]
+        aes_cbc_encrypt_into(ciphertext, iv, plaintext, self.key)
+        output[end:end + self.mac_size] = self.calculate_mac(ciphertext, aad)
+
+    def verify(self, iv, ciphertext, mac, aad=b""):
+        """Raise AuthenticationError unless the MAC matches, before decrypting."""
+        if not hmac.compare_digest(mac, self.calculate_mac(ciphertext, aad)):
+            raise AuthenticationError("MAC verification failed")
+
+    def decrypt_verified_bytes(self, iv, ciphertext, mac, aad=b""):
+        """Decrypt a message that already passed verify() into a bytearray."""
+        return aes_cbc_decrypt_bytes(iv, ciphertext, self.key)
+
+    def decrypt_verified(self, iv, ciphertext, mac, aad=b""):
+        return self.decrypt_verified_bytes(iv, ciphertext, mac, aad).decode()
+
+    def decrypt(self, iv, ciphertext, mac, aad=b""):
+        self.verify(iv, ciphertext, mac, aad)
+        return self.decrypt_verified(iv, ciphertext, mac, aad)
+
+class AesGcmCipher:
+    """AES-GCM: encryption and authentication in a single pass, no padding."""
+    suite = CipherSuite.AES_GCM
+    key_size = 16
+    iv_size = 12
+    mac_size = 16
+
+    def __init__(self, key, mac_key=None):
+        self.key = key # GCM authenticates with the encryption key, mac_key is not needed
+
+    def new(self, nonce):
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=self.mac_size)
+
+    def ciphertext_size(self, plaintext_size):
+        return plaintext_size
+
+    def encrypt(self, plaintext, aad=b""):
+        """Return (nonce, ciphertext, tag) of a message; the tag also covers `aad`."""
+        nonce = os.urandom(self.iv_size)
+        encryptor = self.new(nonce)
+        if aad:
+            encryptor.update(aad)
+        ciphertext, tag = encryptor.encrypt_and_digest(to_bytes(plaintext))
+        return nonce, ciphertext, tag
+
+    def encrypt_into(self, output, plaintext, aad=b""):
+        """Write nonce|ciphertext|tag of bytes-like plaintext into the memoryview `output`."""
+        nonce = os.urandom(self.iv_size)
+        output[:self.iv_size] = nonce
+        encryptor = self.new(nonce)
+        if aad:
+            encryptor.update(aad)
+        end = self.iv_size + len(plaintext)
+        if plaintext:
+            encryptor.encrypt(plaintext, output=output[self.iv_size:end])
+        output[end:end + self.mac_size] = encryptor.digest()
+
+    def verify(self, nonce, ciphertext, tag, aad=b""):
+        """Nothing to do up front: GCM checks the tag in the same pass as decrypting."""
+
+    def decrypt_verified_bytes(self, nonce, ciphertext, tag, aad=b""):
+        decryptor = self.new(nonce)
+        if aad:
+            decryptor.update(aad)
+        try:
+            return decryptor.decrypt_and_verify(ciphertext, tag)
+        except ValueError:
+            raise AuthenticationError("MAC verification failed")
+
+    def decrypt_verified(self, nonce, ciphertext, tag, aad=b""):
+        return self.decrypt_verified_bytes(nonce, ciphertext, tag, aad).decode()
+
+    def decrypt(self, nonce, ciphertext, tag, aad=b""):
+        return self.decrypt_verified(nonce, ciphertext, tag, aad)
+
+class ChaCha20Poly1305Cipher(AesGcmCipher):
+    """ChaCha20-Poly1305: one pass like AES-GCM, but its per-frame setup is
+    cheaper than GCM's, which pycryptodome redoes for every nonce."""
+    suite = CipherSuite.CHACHA20_POLY1305
+    key_size = 32
+
+    def new(self, nonce):
+        return ChaCha20_Poly1305.new(key=self.key, nonce=nonce)
+
+CIPHERS = {cipher.suite: cipher
+           for cipher in (CbcHmacCipher, AesGcmCipher, ChaCha20Poly1305Cipher)}
+
+def create_cipher(suite, session_key, extended=True):
+    """Cipher of a session, keyed with HKDF traffic keys; the legacy Hello keeps
+    using its single key for both encryption and the MAC."""
+    if not extended:
+        return CIPHERS[suite](session_key)
+    cipher = CIPHERS[suite]
+    return cipher(*derive_traffic_keys(session_key, cipher.key_size))
+# CBC+HMAC first: the cheapest per frame for chat-sized messages, see `benchmark.py suites`
+DEFAULT_CIPHER_SUITES = (CipherSuite.CBC_HMAC_SHA256, CipherSuite.CHACHA20_POLY1305,
+                         CipherSuite.AES_GCM)
+
+def pack_extensions(extensions):
+    """Pack {HelloExtension: bytes} as a length prefixed type-length-value list."""
+    body = b"".join(struct.pack("!BH", extension_type, len(value)) + value
+                    for extension_type, value in extensions.items())
+    return struct.pack("!H", len(body)) + body
+
+def unpack_extensions(body):
+    """Unpack extensions packed by pack_extensions (without the length prefix)."""
+    extensions = {}
+    offset = 0
+    while offset < len(body):
+        extension_type, size = struct.unpack_from("!BH", body, offset)
+        offset += 3
+        extensions[extension_type] = body[offset:offset + size]
+        offset += size
+    return extensions
+
+def choose_cipher_suite(offered, supported=DEFAULT_CIPHER_SUITES):
+    """Pick the first suite offered by the client that the server supports."""
+    for suite in offered:
+        if suite in supported:
+            return CipherSuite(suite)
+    raise ValueError("No common cipher suite")
+
+def choose_acknowledgements(offered):
+    """Clamp the (every, delay ms) acknowledgement policy a client asked for."""
+    every, delay_ms = struct.unpack("!HH", offered)
+    return max(1, min(every, MAX_ACK_EVERY)), min(delay_ms, MAX_ACK_DELAY_MS)
+
+class SequenceError(Exception):
+    pass
+
+class Acknowledgements:
+    """Receiver side of sequenced frames with cumulative acknowledgements.
+
+    Frames must arrive numbered 0, 1, 2, ...; an "ACK <n>" reply covers every
+    frame up to n and is due once `every` frames wait for it or `delay`
+    seconds after the oldest of them arrived, whichever comes first. A
+    coalesced record is numbered after its first message and counts as one
+    frame per message.
+    """
+
+    def __init__(self, every=DEFAULT_ACK_EVERY, delay_ms=DEFAULT_ACK_DELAY_MS):
+        self.every = every
+        self.delay = delay_ms / 1000
+        self.expected = 0 # sequence number of the next frame
+        self.acknowledged = 0 # frames covered by the last ACK
+        self.oldest = None # arrival of the oldest unacknowledged frame
+
+    @property
+    def pending(self):
+        return self.expected - self.acknowledged
+
+    def receive(self, sequence, count=1):
+        """Record a frame numbered `sequence` carrying `count` messages."""
+        if sequence != self.expected:
+            raise SequenceError(f"Expected frame {self.expected}, got {sequence}")
+        self.expected += count
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+    def deadline(self):
+        """Monotonic time the pending frames must be acknowledged by, None if none."""
+        return self.oldest + self.delay if self.pending else None
+
+    def due(self):
+        return self.pending >= self.every or (self.pending > 0
+                                              and time.monotonic() >= self.deadline())
+
+    def acknowledge(self):
+        """Return the ACK message covering every received frame."""
+        self.acknowledged = self.expected
+        self.oldest = None
+        return f"{ServerMessages.ACK.value} {self.expected - 1}"
+
+def parse_ack(message):
+    """Sequence number acknowledged by an "ACK <n>" message (bytes), None for other messages."""
+    prefix = ServerMessages.ACK.encode() + b" "
+    if message.startswith(prefix):
+        return int(message[len(prefix):])
+    return None
+
+def broadcast_message(text):
+    return f"{ServerMessages.BROADCAST.value} {text}"
+
+def parse_broadcast(message):
+    """Text (bytes) of a "Broadcast <text>" message, None for other messages."""
+    prefix = ServerMessages.BROADCAST.encode() + b" "
+    if message.startswith(prefix):
+        return bytes(message[len(prefix):])
+    return None
+
+def pack_record(messages):
+    """Plaintext of a coalesced record: every message as 4B length + bytes."""
+    record = bytearray()
+    for message in map(to_bytes, messages):
+        record += struct.pack("!I", len(message))
+        record += message
+    return record
+
+def unpack_record(plaintext):
+    """Messages of a record packed by pack_record, as memoryviews of the plaintext."""
+    messages = []
+    offset = 0
+    plaintext = memoryview(plaintext)
+    while offset < len(plaintext):
+        size = struct.unpack_from("!I", plaintext, offset)[0]
+        offset += 4
+        if offset + size > len(plaintext):
+            raise ValueError("Truncated message in record")
+        message = plaintext[offset:offset + size]
+        messages.append(message)
+        offset += size
+    return messages
+
+class RecordBuilder:
+    """Messages waiting to be sent together as one coalesced record.
+
+    The sender flushes when add() reports the record full or when its own
+    max-delay timer fires, whichever comes first.
+    """
+
+    def __init__(self, record_size=DEFAULT_RECORD_SIZE):
+        self.record_size = record_size
+        self.messages = []
+        self.size = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message):
+        """Queue a message, return True once the record reached its size."""
+        message = to_bytes(message)
+        self.messages.append(message)
+        self.size += 4 + len(message)
+        return self.size >= self.record_size
+
+    def take(self):
+        messages = self.messages
+        self.messages = []
+        self.size = 0
+        return messages
+
+def pack_channel(channel, message):
+    """A message addressed to a channel: 2B channel id + message."""
+    return struct.pack("!H", channel) + to_bytes(message)
+
+def unpack_channel(message):
+    """(channel id, rest of the message) of a message packed by pack_channel."""
+    if len(message) < 2:
+        raise ValueError("Message without a channel id")
+    return struct.unpack_from("!H", message)[0], message[2:]
+
+class TransferError(Exception):
+    pass
+
+class FrameTooLargeError(Exception):
+    pass
+
+def pack_kind(kind: MessageKind, message):
+    """A client message of a connection with TRANSFERS: 1B kind + message."""
+    return bytes([kind]) + to_bytes(message)
+
+def file_messages(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """(kind, message) pairs streaming a file: a "<size> <name>" header, then chunks
+    of 8B offset + data, read one at a time so memory does not grow with the file."""
+    size = os.path.getsize(path)
+    yield MessageKind.FILE_HEADER, f"{size} {os.path.basename(path)}"
+    with open(path, "rb") as file:
+        offset = 0
+        while chunk := file.read(chunk_size):
+            yield MessageKind.FILE_CHUNK, struct.pack("!Q", offset) + chunk
+            offset += len(chunk)
+
+class FileSink:
+    """Receiving end of one streamed file, written to disk chunk by chunk.
+
+    Every chunk is authenticated by its frame; its offset has to continue
+    where the previous chunk ended, so dropped, repeated or reordered chunks
+    are rejected. All clients share the directory, so a file that already
+    exists there is refused rather than overwritten.
+    """
+
+    def __init__(self, directory, name, size):
+        os.makedirs(directory, exist_ok=True)
+        self.name = os.path.basename(name) or "unnamed"
+        self.path = os.path.join(directory, self.name)
+        self.size = size
+        self.received = 0
+        self.started = time.perf_counter()
+        try:
+            self.file = open(self.path, "xb")
+        except FileExistsError:
+            raise TransferError(f"{self.name} already exists in {directory}") from None
+
+    @property
+    def done(self):
+        return self.received == self.size
+
+    def write(self, chunk: bytes):
+        if len(chunk) < 8:
+            raise TransferError(f"Chunk of {len(chunk)} bytes, shorter than its offset")
+        offset = struct.unpack_from("!Q", chunk)[0]
+        if offset != self.received:
+            raise TransferError(f"Chunk at offset {offset}, expected {self.received}")
+        if self.received + len(chunk) - 8 > self.size:
+            raise TransferError(f"More than the announced {self.size} bytes of {self.name}")
+        self.file.write(memoryview(chunk)[8:])
+        self.received += len(chunk) - 8
+
+    def close(self):
+        """Close the file and return the seconds the transfer took."""
+        self.file.close()
+        return time.perf_counter() - self.started
+
+class IncomingFiles:
+    """Picks the messages of file transfers out of a connection's messages.
+
+    Only a connection that negotiated TRANSFERS sends files, and each of
+    its messages starts with a MessageKind: a FILE_HEADER opens a FileSink
+    in `directory` and FILE_CHUNK messages fill it until the announced size
+    arrived. Without the extension every message is text, whatever it
+    starts with.
+    """
+
+    def __init__(self, directory, log: "Logger"):
+        self.directory = directory
+        self.log = log
+        self.sink: FileSink | None = None
+
+    def receive(self, messages, typed):
+        """Return the text messages among `messages` (bytes-like) as bytes, storing
+        file chunks; `typed` when they start with their MessageKind."""
+        if not typed:
+            return [bytes(message) for message in messages]
+        texts = []
+        for message in messages:
+            if not message:
+                raise TransferError("Message without a kind")
+            kind, body = message[0], memoryview(message)[1:]
+            if kind == MessageKind.TEXT:
+                texts.append(bytes(body))
+            elif kind == MessageKind.FILE_HEADER:
+                self.open(body)
+            elif kind == MessageKind.FILE_CHUNK:
+                if not self.sink:
+                    raise TransferError("File chunk without a file header")
+                self.sink.write(body)
+                if self.sink.done:
+                    self.finish()
+            else:
+                raise TransferError(f"Unknown message kind {kind}")
+        return texts
+
+    def open(self, header):
+        if self.sink:
+            raise TransferError(f"New file before the end of {self.sink.name}")
+        try:
+            size, name = str(header, "utf-8").split(" ", 1)
+            size = int(size)
+        except ValueError:
+            raise TransferError("Malformed file header") from None
+        if size < 0:
+            raise TransferError(f"File of {size} bytes")
+        self.sink = FileSink(self.directory, name, size)
+        self.log.info("Receiving file {} ({} bytes) into {}", self.sink.name, size,
+                      self.sink.path)
+        if self.sink.done:
+            self.finish()
+
+    def finish(self):
+        elapsed = self.sink.close()
+        self.log.info("Received file {}: {:.1f} MB in {:.2f} s, {:.1f} MB/s", self.sink.name,
+                      self.sink.size / 1e6, elapsed, self.sink.size / 1e6 / max(elapsed, 1e-9))
+        self.sink = None
+
+    def close(self):
+        """Close an unfinished transfer, e.g. when the connection drops, and remove
+        the partial file so the client can send it again."""
+        if self.sink:
+            self.sink.close()
+            try:
+                os.remove(self.sink.path)
+            except OSError:
+                pass
+            self.log.error("Transfer of {} interrupted after {} of {} bytes", self.sink.name,
+                           self.sink.received, self.sink.size)
+            self.sink = None
+
+class Channel:
+    """One logical channel of a connection, with its own file transfers."""
+
+    def __init__(self, channel_id, files: IncomingFiles):
+        self.channel_id = channel_id
+        self.files = files
+        self.messages_in = 0
+        self.bytes_in = 0
+
+class Channels:
+    """The logical channels a server connection carries.
+
+    Without the CHANNELS extension there is only channel 0, the connection
+    itself. With it every message starts with its channel id (pack_channel)
+    and up to `limit` channels are open at once: a ChannelOpen message opens
+    one, EndSession on it closes it, and both are confirmed like any other
+    message. Channel 0 is open from the start and EndSession or a failed
+    transfer on it ends the session as before; on any other channel they
+    only close that channel, with FAIL for a failure. Every reply goes to
+    the channel of the message it answers.
+    """
+
+    def __init__(self, directory, log: "Logger"):
+        self.directory = directory
+        self.log = log
+        self.limit = None # channels negotiated, None without the extension
+        self.transfers = False # messages start with a MessageKind
+        self.open = {0: Channel(0, IncomingFiles(directory, log))}
+
+    @property
+    def multiplexed(self):
+        return self.limit is not None
+
+    def outgoing(self, messages):
+        """Messages ready to send: str messages, e.g. ACK or EndSession, go on channel 0,
+        bytes are replies already addressed by receive()."""
+        if not self.multiplexed:
+            return messages
+        return [message if isinstance(message, bytes) else pack_channel(0, message)
+                for message in messages]
+
+    def receive(self, messages, confirm=True):
+        """Handle the messages of one frame; return (texts, replies, ended).
+
+        texts are (channel id, text bytes) of the text messages, replies what to
+        send back: an OK per message when `confirm` and FAIL for a channel
+        that failed. ended is True after EndSession on channel 0. A failed
+        transfer on channel 0 raises TransferError.
+        """
+        if not self.multiplexed:
+            texts = self.open[0].files.receive(messages, self.transfers)
+            ended = ServerMessages.END_SESSION.encode() in texts
+            return ([(0, text) for text in texts],
+                    [ServerMessages.OK] * len(messages) if confirm and not ended else [], ended)
+        texts, replies = [], []
+        for message in messages:
+            channel_id, body = unpack_channel(message)
+            reply = ServerMessages.OK
+            try:
+                if not self.receive_on(channel_id, body, texts):
+                    return texts, replies, True
+            except (TransferError, OSError, ValueError) as e:
+                if channel_id == 0:
+                    raise
+                self.log.error("Closing channel {}: {}", channel_id, e)
+                self.close_channel(channel_id)
+                reply = ServerMessages.FAIL
+            if confirm or reply is ServerMessages.FAIL:
+                replies.append(pack_channel(channel_id, reply))
+        return texts, replies, False
+
+    def receive_on(self, channel_id, body, texts):
+        """Handle one message of a multiplexed connection, False if it ended the session."""
+        channel = self.open.get(channel_id)
+        if channel is None:
+            channel_open = ServerMessages.CHANNEL_OPEN.encode()
+            if bytes(body) != (pack_kind(MessageKind.TEXT, channel_open) if self.transfers
+                               else channel_open):
+                raise TransferError(f"Message on channel {channel_id}, which is not open")
+            if len(self.open) >= self.limit:
+                raise TransferError(f"More than {self.limit} channels")
+            self.open[channel_id] = Channel(channel_id, IncomingFiles(self.directory, self.log))
+            texts.append((channel_id, channel_open))
+            return True
+        channel.messages_in += 1
+        channel.bytes_in += len(body)
+        for text in channel.files.receive([body], self.transfers):
+            texts.append((channel_id, text))
+            if text == ServerMessages.END_SESSION.encode():
+                if channel_id == 0:
+                    return False
+                self.close_channel(channel_id)
+            # ChannelOpen on an open channel, e.g. again after a reconnect, changes nothing
+        return True
+
+    def close_channel(self, channel_id):
+        channel = self.open.pop(channel_id, None)
+        if channel:
+            channel.files.close()
+
+    def close(self):
+        """Close the unfinished transfers of every channel, e.g. when the connection drops."""
+        for channel in self.open.values():
+            channel.files.close()
+
+    def summary(self):
+        """(id, messages, bytes) of each open channel, empty without the extension."""
+        if not self.multiplexed:
+            return []
+        return [(channel.channel_id, channel.messages_in, channel.bytes_in)
+                for channel in self.open.values()]
+
+def sequence_aad(sequence):
+    """Bytes of a sequence number as sent in the frame header and authenticated."""
+    return struct.pack("!I", sequence)
+
+class TicketKeyStore:
+    """Keys protecting session tickets.
+
+    A new key is generated every quarter of the ticket lifetime and at most
+    `max_keys` are kept - tickets sealed with an evicted key, or older than
+    `lifetime`, are rejected and the client falls back to a full handshake.
+    With a `secret` the key of each quarter is derived from it instead of
+    random, so worker processes sharing the secret open each other's tickets.
+    """
+
+    def __init__(self, lifetime=DEFAULT_TICKET_LIFETIME, max_keys=8, secret: bytes = None):
+        self.lifetime = lifetime
+        self.rotation_interval = lifetime / 4
+        self.max_keys = max_keys
+        self.secret = secret
+        self.keys = OrderedDict() # key id -> (creation time, key)
+        self.next_key_id = random.getrandbits(32)
+        self.lock = threading.Lock()
+
+    def derived_key_id(self, now):
+        return int(now // self.rotation_interval) % 2**32
+
+    def derive_key(self, key_id):
+        return HMAC.new(self.secret, b"ticket key" + struct.pack("!I", key_id),
+                        SHA256).digest()
+
+    def current_key(self):
+        now = time.time()
+        with self.lock:
+            if self.secret:
+                key_id = self.derived_key_id(now)
+                if key_id not in self.keys:
+                    self.add_key(key_id, now, self.derive_key(key_id))
+                return key_id, self.keys[key_id][1]
+            if self.keys:
+                key_id, (created, key) = next(reversed(self.keys.items()))
+                if now - created < self.rotation_interval:
+                    return key_id, key
+            key_id, key = self.next_key_id, os.urandom(32)
+            self.next_key_id = (self.next_key_id + 1) % 2**32
+            self.add_key(key_id, now, key)
+            return key_id, key
+
+    def add_key(self, key_id, now, key):
+        self.keys[key_id] = (now, key)
+        while len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+
+    def find_key(self, key_id):
+        """The key a ticket was sealed with, None if it is unknown or evicted."""
+        with self.lock:
+            entry = self.keys.get(key_id)
+        if entry is not None:
+            return entry[1]
+        if self.secret:
+            # sealed by another worker, possibly before this one issued a ticket
+            age = (self.derived_key_id(time.time()) - key_id) % 2**32
+            if age < self.max_keys:
+                return self.derive_key(key_id)
+        return None
+
+    def issue(self, resumption_secret):
+        """Seal a resumption secret into a ticket only this server can open."""
+        key_id, key = self.current_key()
+        header = struct.pack("!I", key_id) + os.urandom(12)
+        encryptor = AES.new(key, AES.MODE_GCM, nonce=header[4:])
+        encryptor.update(header)
+        ciphertext, tag = encryptor.encrypt_and_digest(struct.pack("!d", time.time())
+                                                       + resumption_secret)
+        return header + ciphertext + tag
+
+    def open(self, ticket):
+        """Return the resumption secret of a valid ticket, None otherwise."""
+        if len(ticket) < 16 + 8 + 16:
+            return None
+        key = self.find_key(struct.unpack_from("!I", ticket)[0])
+        if key is None:
+            return None
+        decryptor = AES.new(key, AES.MODE_GCM, nonce=ticket[4:16])
+        decryptor.update(ticket[:16])
+        try:
+            plaintext = decryptor.decrypt_and_verify(ticket[16:-16], ticket[-16:])
+        except ValueError:
+            return None
+        issued = struct.unpack_from("!d", plaintext)[0]
+        if not 0 <= time.time() - issued <= self.lifetime:
+            return None
+        return plaintext[8:]
+
+def derive_resumption_secret(symmetric_key):
+    """Secret kept by the client and sealed in the ticket for the next session."""
+    return HMAC.new(symmetric_key, b"resumption", SHA256).digest()
+
+def derive_resumed_key(resumption_secret, client_random, server_random):
+    """Fresh symmetric key of a resumed session."""
+    return HMAC.new(resumption_secret, client_random + server_random, SHA256).digest()[:16]
+
+class HandshakeContext:
+    """Server-wide state shared by the handshakes of all connections."""
+
+    def __init__(self, ticket_store: TicketKeyStore = None, keypair_pool: KeypairPool = None,
+                 executor: Executor = None):
+        self.ticket_store = ticket_store
+        self.keypair_pool = keypair_pool
+        self.executor = executor
+
+class ReceiveBudget:
+    """Token buckets for the frames and bytes a connection may receive per second.
+
+    charge() takes the cost of a received frame and returns how many seconds
+    the connection should wait before reading the next one; a rate of 0 is
+    not limited. Up to one second of unused budget is saved for bursts.
+    """
+
+    def __init__(self, frames_per_second=0, bytes_per_second=0):
+        self.rates = (frames_per_second, bytes_per_second)
+        self.tokens = [float(frames_per_second), float(bytes_per_second)]
+        self.updated = time.monotonic()
+
+    def charge(self, frames, size):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        delay = 0.0
+        for i, (rate, cost) in enumerate(zip(self.rates, (frames, size))):
+            if rate:
+                self.tokens[i] = min(rate, self.tokens[i] + elapsed * rate) - cost
+                if self.tokens[i] < 0:
+                    delay = max(delay, -self.tokens[i] / rate)
+        return delay
+
+class TokenBucket:
+    """`rate` tokens a second, of which up to `burst` are saved."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst or max(rate, 1) # a second's worth by default
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Take a token, False when there is none left."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class HandshakeAdmission:
+    """Decides, right after accept, whether a connection may start a handshake.
+
+    A connection is refused while `max_pending` handshakes are in progress,
+    or when its address or the server as a whole is out of handshake tokens
+    (rates of 0 are unlimited). The address is checked first, so one flooding
+    address does not use up the tokens of everyone else. Refusing only
+    closes the socket: no thread, task or Diffie-Hellman work is spent on it.
+    Thread-safe.
+    """
+
+    def __init__(self, rate=0, burst=0, ip_rate=0, ip_burst=0,
+                 max_pending=DEFAULT_MAX_PENDING_HANDSHAKES):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.ip_buckets: OrderedDict[str, TokenBucket] = OrderedDict() # least recent first
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def admit(self, ip):
+        """None when the handshake may start, release() must follow once it ends;
+        otherwise why it may not: "busy", "ip" or "global"."""
+        now = time.monotonic()
+        with self.lock:
+            if self.max_pending and self.pending >= self.max_pending:
+                return "busy"
+            if self.ip_rate:
+                bucket = self.ip_buckets.pop(ip, None) or TokenBucket(self.ip_rate, self.ip_burst)
+                self.ip_buckets[ip] = bucket
+                if len(self.ip_buckets) > MAX_ADMISSION_ADDRESSES:
+                    self.ip_buckets.popitem(last=False)
+                if not bucket.take(now):
+                    return "ip"
+            if self.bucket and not self.bucket.take(now):
+                return "global"
+            self.pending += 1
+            return None
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+
+class ConnectionLimits:
+    """What a single client can make the server hold in memory or process.
+
+    A frame announcing more than `max_frame_size` ciphertext bytes is refused
+    from its header, before anything is allocated for it. A connection over
+    `frames_per_second` or `bytes_per_second` (0 is unlimited) is not read
+    until it is back within budget, and neither is one with more than
+    `max_pending_output` bytes of replies the client does not read; TCP then
+    holds the client back. A connection is closed when the handshake, the
+    silence before a frame or the rest of a started frame takes longer than
+    its timeout (0 disables it). New connections go through the handshake
+    admission of their server, see HandshakeAdmission.
+    """
+
+    def __init__(self, max_frame_size=DEFAULT_MAX_FRAME_SIZE, frames_per_second=0,
+                 bytes_per_second=0, max_pending_output=DEFAULT_MAX_PENDING_OUTPUT,
+                 handshake_timeout=DEFAULT_HANDSHAKE_TIMEOUT, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 frame_timeout=DEFAULT_FRAME_TIMEOUT, handshake_rate=0, handshake_burst=0,
+                 ip_handshake_rate=0, ip_handshake_burst=0,
+                 max_pending_handshakes=DEFAULT_MAX_PENDING_HANDSHAKES):
+        self.max_frame_size = max_frame_size
+        self.frames_per_second = frames_per_second
+        self.bytes_per_second = bytes_per_second
+        self.max_pending_output = max_pending_output
+        self.timeouts = {"handshake": handshake_timeout, "idle": idle_timeout,
+                         "frame": frame_timeout}
+        self.handshake_rates = (handshake_rate, handshake_burst, ip_handshake_rate,
+                                ip_handshake_burst)
+        self.max_pending_handshakes = max_pending_handshakes
+
+    def budget(self) -> ReceiveBudget | None:
+        if self.frames_per_second or self.bytes_per_second:
+            return ReceiveBudget(self.frames_per_second, self.bytes_per_second)
+        return None
+
+    def admission(self) -> HandshakeAdmission:
+        """A server's handshake admission, shared by all of its connections."""
+        return HandshakeAdmission(*self.handshake_rates, self.max_pending_handshakes)
+
+class Deadlines:
+    """The deadlines of all connections of a server in one heap, expired by a
+    single reaper instead of a timer per connection.
+
+    A connection's deadline moves with every frame, mostly later, so set()
+    only pushes a heap entry when the new deadline is earlier than the one
+    the connection already has in the heap; expire() moves an entry that
+    comes due to the connection's current deadline. Entries hold client ids,
+    so a closed connection is freed at once, and the heap is rebuilt when
+    such stale entries outnumber the live ones. Thread-safe.
+    """
+
+    def __init__(self):
+        self.heap = [] # (time, client id)
+        self.deadlines = {} # client id -> (deadline, what it waits for, connection)
+        self.scheduled = {} # client id -> time of its earliest heap entry
+        self.lock = threading.Lock()
+
+    def set(self, connection, timeout, reason):
+        """Expire the connection `timeout` seconds from now, or never for 0; returns
+        True when this is the earliest deadline, so the reaper must wake up."""
+        if not timeout:
+            self.discard(connection)
+            return False
+        deadline = time.monotonic() + timeout
+        key = connection.client_id
+        with self.lock:
+            self.deadlines[key] = (deadline, reason, connection)
+            if deadline >= self.scheduled.get(key, float("inf")):
+                return False
+            self.scheduled[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+            if len(self.heap) > 2 * len(self.scheduled) + 64:
+                self.heap = [(scheduled, key) for key, scheduled in self.scheduled.items()]
+                heapq.heapify(self.heap)
+            return self.heap[0] == (deadline, key)
+
+    def discard(self, connection):
+        with self.lock:
+            self.deadlines.pop(connection.client_id, None)
+            self.scheduled.pop(connection.client_id, None)
+
+    def next_deadline(self):
+        """When expire() may next have something to return, None for never."""
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def expire(self):
+        """Remove and return (connection, reason) of every deadline that passed."""
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                scheduled, key = heapq.heappop(self.heap)
+                if self.scheduled.get(key) != scheduled:
+                    continue # discarded, or pushed again for an earlier deadline
+                deadline, reason, connection = self.deadlines[key]
+                if deadline <= now:
+                    del self.deadlines[key], self.scheduled[key]
+                    expired.append((connection, reason))
+                else:
+                    self.scheduled[key] = deadline
+                    heapq.heappush(self.heap, (deadline, key))
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
+
+class BroadcastReport:
+    """Outcome of one broadcast: how long each client's copy took from the
+    command until it was written to the client's socket, and how many copies
+    were dropped because the client was gone or too far behind. Thread-safe.
+    """
+
+    def __init__(self, recipients=0):
+        self.started = time.perf_counter()
+        self.recipients = recipients
+        self.latencies = [] # s
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def delivered(self):
+        """Called when a copy was written; returns its latency in seconds."""
+        latency = time.perf_counter() - self.started
+        with self.lock:
+            self.latencies.append(latency)
+            self.check_finished()
+        return latency
+
+    def drop(self):
+        with self.lock:
+            self.dropped += 1
+            self.check_finished()
+
+    def add_recipients(self, count):
+        with self.lock:
+            self.recipients += count
+            self.check_finished()
+
+    def check_finished(self):
+        if len(self.latencies) + self.dropped >= self.recipients:
+            self.finished.set()
+
+    def wait(self, timeout=BROADCAST_TIMEOUT):
+        """Wait until every copy was written or dropped, at most `timeout` seconds."""
+        self.finished.wait(timeout)
+        return self
+
+    def totals(self):
+        """(recipients, latencies, dropped), e.g. to send to another process."""
+        with self.lock:
+            return self.recipients, list(self.latencies), self.dropped
+
+    def merge(self, totals):
+        recipients, latencies, dropped = totals
+        with self.lock:
+            self.recipients += recipients
+            self.latencies += latencies
+            self.dropped += dropped
+            self.check_finished()
+
+    def summary(self):
+        """One line for the console, with the delivery latency percentiles."""
+        recipients, latencies, dropped = self.totals()
+        line = (f"{recipients} clients: {len(latencies)} delivered, {dropped} dropped, "
+                f"{recipients - len(latencies) - dropped} still queued")
+        if latencies:
+            latencies.sort()
+            p50, p99 = (latencies[min(int(f * len(latencies)), len(latencies) - 1)] * 1000
+                        for f in (0.5, 0.99))
+            line += (f"; delivery ms p50 {p50:.2f}, p99 {p99:.2f},"
+                     f" max {latencies[-1] * 1000:.2f}")
+        return line
+
+def check_frame_size(message_size, max_frame_size):
+    if max_frame_size is not None and message_size > max_frame_size:
+        raise FrameTooLargeError(f"frame of {message_size} bytes, at most {max_frame_size} "
+                                 "accepted")
+
+class ServerHandshake:
+    """Server side of the ClientHello/ServerHello exchange, shared by the engines.
+
+    The legacy ClientHello (A, p, g) always gets CBC+HMAC and a legacy
+    ServerHello; an extended ClientHello negotiates the cipher suite and the
+    group, and may resume an earlier session from its ticket, skipping
+    Diffie-Hellman. The Diffie-Hellman math of MODP and custom groups runs
+    in the context's executor when the server has one.
+    """
+
+    def __init__(self, hello_type, body, context: HandshakeContext = None):
+        context = context or HandshakeContext()
+        self.extended = hello_type == CLIENT_HELLO_V2
+        self.ticket_store = context.ticket_store if self.extended else None
+        self.keypair_pool = context.keypair_pool
+        self.context_executor = context.executor
+        self.resumption_secret = None
+        self.group = None
+        self.acknowledgements = None
+        self.record_size = None
+        self.channels = None
+        self.transfers = False
+        if hello_type == CLIENT_HELLO:
+            self.client_public_key, self.p, self.g = struct.unpack("!III", body)
+            self.cipher_suite = CipherSuite.CBC_HMAC_SHA256
+        elif self.extended:
+            extensions = unpack_extensions(body)
+            if HelloExtension.DH_GROUP in extensions:
+                group_id = struct.unpack("!H", extensions[HelloExtension.DH_GROUP])[0]
+                if group_id not in DH_GROUPS:
+                    raise ValueError(f"Unsupported group: {group_id}")
+                self.group = DH_GROUPS[group_id]
+                self.client_public_key = self.group.decode_public_key(
+                    extensions[HelloExtension.KEY_SHARE])
+                self.p = self.g = None
+            else:
+                self.client_public_key, self.p, self.g = decode_ints(
+                    extensions[HelloExtension.KEY_SHARE])
+                if self.p.bit_length() > MAX_CUSTOM_GROUP_BITS:
+                    raise ValueError(f"Group larger than {MAX_CUSTOM_GROUP_BITS} bits")
+            self.cipher_suite = choose_cipher_suite(extensions[HelloExtension.CIPHER_SUITES])
+            # a ticket without the client's random cannot key a resumption: full handshake
+            if (self.ticket_store and HelloExtension.SESSION_TICKET in extensions
+                    and HelloExtension.RANDOM in extensions):
+                self.resumption_secret = self.ticket_store.open(
+                    extensions[HelloExtension.SESSION_TICKET])
+                self.client_random = extensions[HelloExtension.RANDOM]
+            if HelloExtension.ACKNOWLEDGEMENTS in extensions:
+                self.acknowledgements = choose_acknowledgements(
+                    extensions[HelloExtension.ACKNOWLEDGEMENTS])
+            if HelloExtension.COALESCING in extensions:
+                record_size = struct.unpack("!I", extensions[HelloExtension.COALESCING])[0]
+                self.record_size = min(record_size, MAX_RECORD_SIZE)
+            if HelloExtension.CHANNELS in extensions:
+                channels = struct.unpack("!H", extensions[HelloExtension.CHANNELS])[0]
+                self.channels = max(1, min(channels, MAX_CHANNELS))
+            self.transfers = HelloExtension.TRANSFERS in extensions
+        else:
+            raise ValueError(f"Unexpected hello message: {hello_type}")
+        self.resumed = self.resumption_secret is not None
+
+    def describe_group(self):
+        return f"group={self.group.name}" if self.group else f"p={self.p} g={self.g}"
+
+    @property
+    def executor(self):
+        """Executor for key_exchange_job(), None to run it in the caller."""
+        if self.group and not self.group.offload:
+            return None
+        return self.context_executor
+
+    def key_exchange_job(self):
+        """The Diffie-Hellman part of compute_keys as a call without arguments."""
+        keypair = self.keypair_pool.take(self.group) if self.group and self.keypair_pool else None
+        return partial(server_key_exchange, self.group.group_id if self.group else None,
+                       self.p, self.g, self.client_public_key, keypair)
+
+    def compute_keys(self, key_exchange_result=None):
+        """Derive the session key: from the ticket or with Diffie-Hellman.
+
+        The asyncio engine runs key_exchange_job() itself, without blocking
+        the loop, and passes its result in.
+        """
+        if self.resumed:
+            self.server_random = os.urandom(RANDOM_SIZE)
+            self.symmetric_key = derive_resumed_key(self.resumption_secret,
+                                                    self.client_random, self.server_random)
+        else:
+            if key_exchange_result is None:
+                job = self.key_exchange_job()
+                key_exchange_result = (self.executor.submit(job).result() if self.executor
+                                       else job())
+            self.public_key, self.shared_key = key_exchange_result
+            self.symmetric_key = (derive_session_key(self.shared_key) if self.extended
+                                  else derive_symmetric_key(self.shared_key))
+        self.cipher = create_cipher(self.cipher_suite, self.symmetric_key, self.extended)
+
+    def server_hello(self):
+        if not self.extended:
+            return struct.pack("!11sI", SERVER_HELLO, self.public_key)
+        extensions = {HelloExtension.CIPHER_SUITES: bytes([self.cipher_suite])}
+        if self.resumed:
+            extensions[HelloExtension.RANDOM] = self.server_random
+        else:
+            extensions[HelloExtension.KEY_SHARE] = (self.group.encode_public_key(self.public_key)
+                                                    if self.group else encode_ints(self.public_key))
+        if self.ticket_store:
+            extensions[HelloExtension.SESSION_TICKET] = self.ticket_store.issue(
+                derive_resumption_secret(self.symmetric_key))
+        if self.acknowledgements:
+            extensions[HelloExtension.ACKNOWLEDGEMENTS] = struct.pack("!HH",
+                                                                      *self.acknowledgements)
+        if self.record_size:
+            extensions[HelloExtension.COALESCING] = struct.pack("!I", self.record_size)
+        if self.channels:
+            extensions[HelloExtension.CHANNELS] = struct.pack("!H", self.channels)
+        if self.transfers:
+            extensions[HelloExtension.TRANSFERS] = b""
+        return SERVER_HELLO_V2 + pack_extensions(extensions)
+
+class ClientHandshake:
+    """Client side of the ClientHello/ServerHello exchange.
+
+    Used by client.py and by the load generator in benchmark.py; the caller
+    sends client_hello() and passes the ServerHello it read to complete().
+    A session ticket from an earlier handshake is offered for resumption;
+    with `acknowledgements` = (every, delay ms) the client asks for sequenced
+    frames and cumulative ACKs instead of an OK per message, with
+    `record_size` for coalesced records of up to that many bytes, with
+    `channels` for up to that many logical channels and with `transfers`
+    for messages marked with their MessageKind, which file transfers need.
+    """
+
+    def __init__(self, private_key, public_key, cipher_suites=DEFAULT_CIPHER_SUITES,
+                 group: DHGroup | X25519Group = None, p=None, g=None,
+                 session_ticket=None, resumption_secret=None, acknowledgements=None,
+                 record_size=None, channels=None, transfers=False):
+        self.private_key = private_key
+        self.public_key = public_key
+        self.cipher_suites = cipher_suites
+        self.group = group
+        self.p = p
+        self.g = g
+        self.session_ticket = session_ticket
+        self.resumption_secret = resumption_secret
+        self.client_random = os.urandom(RANDOM_SIZE) if session_ticket else None
+        self.acknowledgements = acknowledgements
+        self.record_size = record_size
+        self.channels = channels
+        self.transfers = transfers
+        self.resumed = False
+        self.server_public_key = self.shared_key = None
+
+    def describe_group(self):
+        return self.group.name if self.group else f"p={self.p}, g={self.g}"
+
+    def client_hello(self):
+        extensions = {HelloExtension.CIPHER_SUITES: bytes(self.cipher_suites)}
+        if self.group:
+            extensions[HelloExtension.DH_GROUP] = struct.pack("!H", self.group.group_id)
+            extensions[HelloExtension.KEY_SHARE] = self.group.encode_public_key(self.public_key)
+        else:
+            extensions[HelloExtension.KEY_SHARE] = encode_ints(self.public_key, self.p, self.g)
+        if self.session_ticket:
+            extensions[HelloExtension.SESSION_TICKET] = self.session_ticket
+            extensions[HelloExtension.RANDOM] = self.client_random
+        if self.acknowledgements:
+            extensions[HelloExtension.ACKNOWLEDGEMENTS] = struct.pack("!HH",
+                                                                      *self.acknowledgements)
+        if self.record_size:
+            extensions[HelloExtension.COALESCING] = struct.pack("!I", self.record_size)
+        if self.channels:
+            extensions[HelloExtension.CHANNELS] = struct.pack("!H", self.channels)
+        if self.transfers:
+            extensions[HelloExtension.TRANSFERS] = b""
+        return CLIENT_HELLO_V2 + pack_extensions(extensions)
+
+    def complete(self, hello_type, body):
+        """Derive the session key from the ServerHello and return the cipher."""
+        if hello_type == SERVER_HELLO_V2:
+            extensions = unpack_extensions(body)
+            self.cipher_suite = CipherSuite(extensions[HelloExtension.CIPHER_SUITES][0])
+        else: # server without cipher suite negotiation
+            self.cipher_suite = CipherSuite.CBC_HMAC_SHA256
+            extensions = {HelloExtension.KEY_SHARE: encode_ints(struct.unpack("!I", body)[0])}
+
+        self.resumed = HelloExtension.RANDOM in extensions
+        if self.resumed:
+            self.symmetric_key = derive_resumed_key(self.resumption_secret, self.client_random,
+                                                    extensions[HelloExtension.RANDOM])
+        else:
+            key_share = extensions[HelloExtension.KEY_SHARE]
+            if self.group:
+                self.server_public_key = self.group.decode_public_key(key_share)
+                self.shared_key = self.group.shared_secret(self.private_key,
+                                                           self.server_public_key)
+            else:
+                self.server_public_key = decode_ints(key_share)[0]
+                self.shared_key = calculate_shared_secret(self.server_public_key,
+                                                          self.private_key, self.p)
+            self.symmetric_key = (derive_session_key(self.shared_key)
+                                  if hello_type == SERVER_HELLO_V2
+                                  else derive_symmetric_key(self.shared_key))
+
+        # None when the server sends an OK per message instead
+        self.acknowledgements = (struct.unpack("!HH", extensions[HelloExtension.ACKNOWLEDGEMENTS])
+                                 if HelloExtension.ACKNOWLEDGEMENTS in extensions else None)
+        self.record_size = (struct.unpack("!I", extensions[HelloExtension.COALESCING])[0]
+                            if HelloExtension.COALESCING in extensions else None)
+        self.channels = (struct.unpack("!H", extensions[HelloExtension.CHANNELS])[0]
+                         if HelloExtension.CHANNELS in extensions else None)
+        self.transfers = HelloExtension.TRANSFERS in extensions
+        self.session_ticket = extensions.get(HelloExtension.SESSION_TICKET)
+        self.resumption_secret = (derive_resumption_secret(self.symmetric_key)
+                                  if self.session_ticket else None)
+        return create_cipher(self.cipher_suite, self.symmetric_key,
+                             hello_type == SERVER_HELLO_V2)
+
+def receive_client_hello(receive_data):
+    """Read a legacy or extended ClientHello with a receive_data(size) callable."""
+    hello_type = receive_data(HELLO_TYPE_SIZE)
+    if hello_type == CLIENT_HELLO_V2:
+        body_size = struct.unpack("!H", receive_data(2))[0]
+    else:
+        body_size = 12 # A, p, g
+    return hello_type, receive_data(body_size)
+
+def receive_server_hello(receive_data):
+    """Read a legacy or extended ServerHello with a receive_data(size) callable."""
+    hello_type = receive_data(HELLO_TYPE_SIZE)
+    if hello_type == SERVER_HELLO_V2:
+        body_size = struct.unpack("!H", receive_data(2))[0]
+    else:
+        body_size = 4 # B
+    return hello_type, receive_data(body_size)
+
 def send_string(socket, text):
     """Send a string message to a socket."""
     encoded_text = text.encode()
@@ -67,12 +1552,184 @@ def receive_data(socket, size):
         data += packet
     return data
 
+class FrameReader:
+    """Buffered reader of size|iv|ciphertext|mac frames from one socket.
+
+    Data is received with recv_into straight into a preallocated buffer, as
+    much as the kernel has at once, and complete frames are sliced out of it,
+    so several frames that arrived together are served without another recv.
+    read_frame returns memoryviews of that buffer rather than copies, valid
+    until the next read; copy what has to outlive the frame. Frames above
+    `max_frame_size` raise FrameTooLargeError before the buffer grows for
+    them, and a buffer grown for a large frame shrinks back once it is read.
+    """
+
+    def __init__(self, socket, buffer_size=16 * 1024, max_frame_size=None):
+        self.socket = socket
+        self.buffer_size = buffer_size
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0 # first unread byte
+        self.end = 0 # end of received data
+
+    def available(self):
+        return self.end - self.start
+
+    def fill(self, size):
+        """Receive until at least `size` unread bytes are buffered."""
+        if self.end == 0 and len(self.buffer) > self.buffer_size >= size:
+            self.view.release()
+            self.buffer = bytearray(self.buffer_size)
+            self.view = memoryview(self.buffer)
+        if self.start + size > len(self.buffer):
+            if size > len(self.buffer):
+                self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+                self.buffer[:self.available()] = self.view[self.start:self.end]
+                self.view.release()
+                self.view = memoryview(self.buffer)
+            else:
+                self.buffer[:self.available()] = self.buffer[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        while self.available() < size:
+            received = self.socket.recv_into(self.view[self.end:])
+            if not received:
+                raise ConnectionError("Socket connection lost")
+            self.end += received
+
+    def take(self, size):
+        data = self.view[self.start:self.start + size]
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return data
+
+    def receive_data(self, size):
+        """Receive a fixed amount of data, e.g. a Hello message."""
+        self.fill(size)
+        return bytes(self.take(size))
+
+    def read_frame(self, iv_size=AES_BLOCK_SIZE, mac_size=MAC_SIZE):
+        """Return (iv, ciphertext, mac) of the next complete frame."""
+        self.fill(4)
+        message_size = struct.unpack_from("!I", self.buffer, self.start)[0]
+        check_frame_size(message_size, self.max_frame_size)
+        self.fill(4 + iv_size + message_size + mac_size)
+        self.start += 4
+        iv = self.take(iv_size)
+        ciphertext = self.take(message_size)
+        mac = self.take(mac_size)
+        return iv, ciphertext, mac
+
+    def read_sequenced_frame(self, iv_size=AES_BLOCK_SIZE, mac_size=MAC_SIZE):
+        """Return (sequence, iv, ciphertext, mac) of a size|sequence|iv|ciphertext|mac frame."""
+        self.fill(8)
+        message_size, sequence = struct.unpack_from("!II", self.buffer, self.start)
+        check_frame_size(message_size, self.max_frame_size)
+        self.fill(8 + iv_size + message_size + mac_size)
+        self.start += 8
+        iv = self.take(iv_size)
+        ciphertext = self.take(message_size)
+        mac = self.take(mac_size)
+        return sequence, iv, ciphertext, mac
+
+class FrameWriter:
+    """Builder of size|aad|iv|ciphertext|mac frames, the counterpart of FrameReader.
+
+    parts() returns a frame as buffers for a gathering write (send_buffers,
+    StreamWriter.writelines), so the ciphertext is never copied just to add
+    the header and MAC. Large messages are instead encrypted in place into a
+    buffer sized for the whole frame. With `reuse` that buffer is kept
+    between frames and a frame is only valid until the next one, which suits
+    a blocking send; asyncio transports may hold on to written data, so
+    they get a new buffer per frame.
+    """
+
+    def __init__(self, cipher, buffer_size=16 * 1024, reuse=True):
+        self.cipher = cipher
+        self.reuse = reuse
+        self.buffer = bytearray(buffer_size if reuse else 0)
+        self.view = memoryview(self.buffer)
+
+    def frame(self, plaintext, aad=b""):
+        """Encrypt a message (str or bytes-like) and return a memoryview of its frame."""
+        plaintext = to_bytes(plaintext)
+        ciphertext_size = self.cipher.ciphertext_size(len(plaintext))
+        header_size = 4 + len(aad)
+        size = header_size + self.cipher.iv_size + ciphertext_size + self.cipher.mac_size
+        if not self.reuse or size > len(self.buffer):
+            # frames handed out earlier keep the old buffer alive through their views
+            self.buffer = bytearray(size if not self.reuse else max(size, 2 * len(self.buffer)))
+            self.view = memoryview(self.buffer)
+        struct.pack_into("!I", self.buffer, 0, ciphertext_size)
+        self.view[4:header_size] = aad
+        if len(plaintext) >= ENCRYPT_IN_PLACE_SIZE:
+            self.cipher.encrypt_into(self.view[header_size:size], plaintext, aad)
+        else:
+            iv, ciphertext, mac = self.cipher.encrypt(plaintext, aad)
+            end = header_size + len(iv) + len(ciphertext)
+            self.view[header_size:header_size + len(iv)] = iv
+            self.view[header_size + len(iv):end] = ciphertext
+            self.view[end:size] = mac
+        return self.view[:size]
+
+    def parts(self, plaintext, aad=b""):
+        """Encrypt a message and return its frame as a list of bytes-like buffers."""
+        plaintext = to_bytes(plaintext)
+        if len(plaintext) >= ENCRYPT_IN_PLACE_SIZE:
+            return [self.frame(plaintext, aad)]
+        iv, ciphertext, mac = self.cipher.encrypt(plaintext, aad)
+        return [struct.pack("!I", len(ciphertext)) + aad, iv, ciphertext, mac]
+
+def send_buffers(sock, buffers, deadline=None):
+    """Send buffers back to back like sendall, gathered by sendmsg instead of joined.
+
+    A partial write drops the buffers it completed and slices the one it
+    stopped in, then sendmsg is called again with the rest. With a
+    time.monotonic() `deadline` the socket, which another thread may be
+    blocked on, keeps its own timeout: writes do not block and TimeoutError
+    is raised when the client has not made room for the rest by then.
+    """
+    if not hasattr(sock, "sendmsg"): # e.g. Windows
+        sock.sendall(b"".join(buffers))
+        return
+    buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    flags = 0 if deadline is None else socket.MSG_DONTWAIT
+    writable = None
+    while buffers:
+        try:
+            sent = sock.sendmsg(buffers, [], flags)
+        except BlockingIOError:
+            if writable is None:
+                writable = select.poll()
+                writable.register(sock, select.POLLOUT)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not writable.poll(remaining * 1000):
+                raise TimeoutError("the client does not read")
+            continue
+        while sent and sent >= len(buffers[0]):
+            sent -= len(buffers.pop(0))
+        if sent:
+            buffers[0] = buffers[0][sent:]
+
 def send_hello_message(socket, message_type, public_key, p, g):
     """Send a formatted Hello message."""
     hello_message = struct.pack("!11s16s16s16s", message_type.encode(),
                                 str(public_key).encode(), str(p).encode(), str(g).encode())
     socket.sendall(hello_message)
 
+def parse_cipher_suites(value):
+    try:
+        return tuple(CIPHER_SUITE_NAMES[name.strip()] for name in value.split(","))
+    except KeyError as e:
+        raise argparse.ArgumentTypeError(f"unknown cipher suite {e}")
+
+def format_cipher_suites(suites):
+    """Inverse of parse_cipher_suites, for help texts."""
+    names = {suite: name for name, suite in CIPHER_SUITE_NAMES.items()}
+    return ",".join(names[suite] for suite in suites)
+
 def process_args(connection_type: str):
     if connection_type not in ("server", "client"):
         raise ValueError("Invalid connection type: must be 'server' or 'client'")
@@ -90,42 +1747,265 @@ def process_args(connection_type: str):
                         default=default_host)
     parser.add_argument("--verbose", action="store_true",
                         help="Enable verbose mode. Default is False.")
-    args = parser.parse_args()
+    parser.add_argument("--log-file", type=str, default=None,
+                        help=("Write the log to this file instead of the console,"
+                              " which then only shows command output"))
+    if connection_type == "client":
+        parser.add_argument("--cipher-suites", type=parse_cipher_suites,
+                            default=DEFAULT_CIPHER_SUITES,
+                            help=("Comma separated cipher suites offered in ClientHello, in order"
+                                  f" of preference: {', '.join(CIPHER_SUITE_NAMES)}"
+                                  f" (default: {format_cipher_suites(DEFAULT_CIPHER_SUITES)})"))
+        parser.add_argument("--no-resumption", dest="resumption", action="store_false",
+                            help="Always perform a full key exchange when reconnecting.")
+        parser.add_argument("--dh-group", choices=[*DH_GROUP_NAMES, "custom"],
+                            default=MODP_2048.name,
+                            help=("Key exchange group: RFC 3526 MODP group, x25519 or the small"
+                                  " custom p and g sent in ClientHello (default: %(default)s)"))
+        parser.add_argument("--bulk", metavar="PATH", default=None,
+                            help=("Send every line of PATH (- for stdin) as a message without the"
+                                  " console, reconnecting if the server drops the connection"))
+        parser.add_argument("--bulk-retries", type=int, default=5,
+                            help=("Reconnect attempts in a row before --bulk gives up"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--window", type=int, default=DEFAULT_SEND_WINDOW,
+                            help=("Messages --bulk sends before waiting for the server to"
+                                  " confirm them (default: %(default)s)"))
+        parser.add_argument("--ack-every", type=int, default=DEFAULT_ACK_EVERY,
+                            help=("Frames per cumulative ACK asked for in --bulk, 0 for an OK"
+                                  " per message (default: %(default)s)"))
+        parser.add_argument("--coalesce-delay-ms", type=int, default=DEFAULT_COALESCE_DELAY_MS,
+                            help=("Pack messages sent within this many ms into one encrypted"
+                                  " record, 0 sends a frame per message (default: %(default)s)"))
+        parser.add_argument("--record-size", type=int, default=DEFAULT_RECORD_SIZE,
+                            help=("Bytes of messages that make a coalesced record full and"
+                                  " send it before the delay (default: %(default)s)"))
+    if connection_type == "server":
+        parser.add_argument("--engine", choices=SERVER_ENGINES, default=SERVER_ENGINES[0],
+                            help=("threads: one thread per connection, asyncio: all connections"
+                                  " on a single event loop (default: %(default)s)"))
+        parser.add_argument("--ticket-lifetime", type=int, default=DEFAULT_TICKET_LIFETIME,
+                            help=("Seconds a session resumption ticket stays valid,"
+                                  " 0 disables tickets (default: %(default)s)"))
+        parser.add_argument("--keypair-pool-size", type=int, default=DEFAULT_KEYPAIR_POOL_SIZE,
+                            help=("Precomputed keypairs kept per MODP group,"
+                                  " 0 disables the pool (default: %(default)s)"))
+        parser.add_argument("--metrics-port", type=int, default=None,
+                            help=("Serve Prometheus metrics on http://127.0.0.1:<port>/metrics"
+                                  " (default: disabled)"))
+        parser.add_argument("--handshake-workers", type=int, default=DEFAULT_HANDSHAKE_WORKERS,
+                            help=("Worker processes computing the Diffie-Hellman math of"
+                                  " handshakes, 0 computes it in the server process"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--upload-dir", default=DEFAULT_UPLOAD_DIR,
+                            help=("Directory files sent with `sendfile` are written to"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--workers", type=int, default=0,
+                            help=("Worker processes sharing the port with SO_REUSEPORT, each"
+                                  " with its own engine; 0 serves every connection in this"
+                                  " process (default: %(default)s)"))
+        parser.add_argument("--max-frame-size", type=int, default=DEFAULT_MAX_FRAME_SIZE,
+                            help=("Largest client frame in ciphertext bytes, larger ones end"
+                                  " the session with FAIL (default: %(default)s)"))
+        parser.add_argument("--max-frames-per-second", type=int, default=0,
+                            help=("Frames a connection may send per second, the server stops"
+                                  " reading it above that; 0 is unlimited (default: %(default)s)"))
+        parser.add_argument("--max-bytes-per-second", type=int, default=0,
+                            help=("Bytes a connection may send per second, 0 is unlimited"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--max-pending-output", type=int, default=DEFAULT_MAX_PENDING_OUTPUT,
+                            help=("Bytes of unsent replies per connection before the server"
+                                  " stops reading it (default: %(default)s)"))
+        parser.add_argument("--handshake-timeout", type=float, default=DEFAULT_HANDSHAKE_TIMEOUT,
+                            help=("Seconds from accepting a connection until its handshake is"
+                                  " done, 0 waits forever (default: %(default)s)"))
+        parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                            help=("Seconds a session may go without sending a frame, 0 waits"
+                                  " forever (default: %(default)s)"))
+        parser.add_argument("--frame-timeout", type=float, default=DEFAULT_FRAME_TIMEOUT,
+                            help=("Seconds to receive the rest of a frame once its header"
+                                  " arrived, 0 waits forever (default: %(default)s)"))
+        parser.add_argument("--max-pending-handshakes", type=int,
+                            default=DEFAULT_MAX_PENDING_HANDSHAKES,
+                            help=("Handshakes in progress at once, more connections are closed"
+                                  " right after accept; 0 is unlimited (default: %(default)s)"))
+        parser.add_argument("--handshake-rate", type=float, default=0,
+                            help=("New handshakes per second for the whole server, 0 is"
+                                  " unlimited (default: %(default)s)"))
+        parser.add_argument("--handshake-burst", type=int, default=0,
+                            help=("Handshakes above --handshake-rate allowed at once, 0 is"
+                                  " one second's worth (default: %(default)s)"))
+        parser.add_argument("--ip-handshake-rate", type=float, default=0,
+                            help=("New handshakes per second from one address, 0 is unlimited"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--ip-handshake-burst", type=int, default=0,
+                            help=("Handshakes above --ip-handshake-rate allowed at once, 0 is"
+                                  " one second's worth (default: %(default)s)"))
+        parser.add_argument("--listen-backlog", type=int, default=DEFAULT_LISTEN_BACKLOG,
+                            help=("Connections the kernel queues until they are accepted"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--broadcast-threads", type=int, default=DEFAULT_BROADCAST_THREADS,
+                            help=("Threads encrypting the copies of a `broadcast`"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--journal", metavar="DIR", default=None,
+                            help=("Append the messages clients send to a journal in DIR, OK"
+                                  " and ACK only once they are on disk (default: off)"))
+        parser.add_argument("--journal-commit-ms", type=float,
+                            default=DEFAULT_JOURNAL_COMMIT_MS,
+                            help=("Milliseconds between fsyncs of the journal, each one commits"
+                                  " the messages of every connection since the last; 0 syncs"
+                                  " as often as the disk allows (default: %(default)s)"))
+        parser.add_argument("--journal-no-sync", dest="journal_sync", action="store_false",
+                            help=("Answer without waiting for the journal's fsync, a crash may"
+                                  " lose the last --journal-commit-ms of messages"))
+        parser.add_argument("--journal-segment-mb", type=int,
+                            default=DEFAULT_JOURNAL_SEGMENT_SIZE // (1024 * 1024),
+                            help=("Size at which the journal starts a new segment file"
+                                  " (default: %(default)s)"))
+        parser.add_argument("--shutdown-timeout", type=float, default=DEFAULT_SHUTDOWN_TIMEOUT,
+                            help=("Seconds `shutdown` waits for all connections to end"
+                                  " (default: %(default)s)"))
 
-    return args.port, args.host, args.verbose
+    return parser.parse_args()
 
 class ServerMessages(str, Enum):
     END_SESSION = "EndSession"
     OK = "OK"
     FAIL = "FAIL"
+    ACK = "ACK" # followed by the last sequence number received
+    CHANNEL_OPEN = "ChannelOpen" # sent by the client on a channel it opens
+    BROADCAST = "Broadcast" # followed by text the server sends to every client
+
+# open and end sessions and channels, they are not journaled as texts
+CONTROL_MESSAGES = frozenset(message.encode() for message in (ServerMessages.END_SESSION,
+                                                              ServerMessages.CHANNEL_OPEN))
+
+class LogLevel(IntEnum):
+    VERBOSE = 10
+    INFO = 20
+    ERROR = 40
+    SILENT = 100
+
+CONSOLE_PROMPT = "\nCommand: "
+
+class LogFormatter(string.Formatter):
+    """str.format with extra conversions for bytes: !h prints them as hex, e.g. keys,
+    and !t as UTF-8 text with undecodable bytes replaced, e.g. received messages."""
+
+    def convert_field(self, value, conversion):
+        if conversion == "h":
+            return value.hex() if isinstance(value, (bytes, bytearray, memoryview)) else str(value)
+        if conversion == "t":
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                return str(value, "utf-8", errors="replace")
+            return str(value)
+        return super().convert_field(value, conversion)
+
+class LogWriter(threading.Thread):
+    """Consumer of the log queue, writing records to a stream in batches.
+
+    The thread blocks on the queue until a record arrives, then takes every
+    record already queued, formats them and writes them with one write() and
+    one flush(). After each batch the console prompt, if any, is printed
+    again below the output.
+    """
 
-class ThreadPrinter(threading.Thread):
-    def __init__(self, print_callback=lambda: print("\nCommand: ", flush=True, end="")):
+    def __init__(self, stream=sys.stdout, prompt=CONSOLE_PROMPT):
         super().__init__(daemon=True)
-        self.mes_que = []
-        self.lock = threading.Lock()
-        self.stop_event = threading.Event()
-        self.print_callback = print_callback
+        self.stream = stream
+        self.prompt = prompt
+        self.queue = SimpleQueue()
+        self.formatter = LogFormatter()
 
-    def print(self, *args, **kwargs):
-        with self.lock:
-            self.mes_que.append([args, kwargs])
+    def submit(self, record):
+        self.queue.put(record)
+
+    def stop(self):
+        """Write the records queued so far and stop the thread."""
+        self.queue.put(None)
+        if self.is_alive():
+            self.join()
+
+    def format(self, record):
+        level, prefix, message, args = record
+        if args:
+            try:
+                message = self.formatter.vformat(message, args, {})
+            except (IndexError, KeyError, ValueError, AttributeError):
+                message = f"{message} {args}"
+        return f"{prefix}[V] {message}" if level == LogLevel.VERBOSE else prefix + message
 
     def run(self):
-        while not self.stop_event.is_set():
-            if len(self.mes_que) > 0:
-                time.sleep(0.1)
-                self.print_all()
-            time.sleep(0.1)
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            lines = []
+            for record in batch:
+                if record is None:
+                    running = False
+                else:
+                    lines.append(self.format(record))
+            if lines:
+                if self.prompt:
+                    self.stream.write("\n" + "\n".join(lines) + "\n" + self.prompt)
+                else:
+                    self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
 
-    def stop(self):
-        self.stop_event.set()
-        self.print_all()
+class Logger:
+    """Leveled front end of a LogWriter.
+
+    A call below the logger's level returns after one comparison. Otherwise
+    the message and its arguments are queued as they are and str.format runs
+    in the writer thread, so call sites pass arguments instead of f-strings:
+    log.verbose("Received IV: {!h}", iv).
+    """
+
+    def __init__(self, writer: LogWriter, level=LogLevel.INFO, prefix=""):
+        self.writer = writer
+        self.level = level
+        self.prefix = prefix
+
+    def child(self, prefix):
+        """Logger writing to the same writer with `prefix` before every message."""
+        return Logger(self.writer, self.level, self.prefix + prefix)
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def verbose(self, message, *args):
+        if LogLevel.VERBOSE >= self.level:
+            self.writer.submit((LogLevel.VERBOSE, self.prefix, message, args))
+
+    def info(self, message, *args):
+        if LogLevel.INFO >= self.level:
+            self.writer.submit((LogLevel.INFO, self.prefix, message, args))
+
+    def error(self, message, *args):
+        if LogLevel.ERROR >= self.level:
+            self.writer.submit((LogLevel.ERROR, self.prefix, message, args))
+
+def start_logger(verbose=False, stream=sys.stdout, prompt=CONSOLE_PROMPT):
+    """Start a LogWriter on `stream` and return a Logger for it."""
+    writer = LogWriter(stream, prompt)
+    writer.start()
+    return Logger(writer, LogLevel.VERBOSE if verbose else LogLevel.INFO)
 
-    def print_all(self):
-        print("\n")
-        for args, kwargs in self.mes_que:
-            print(*args, **kwargs)
-        self.mes_que.clear()
+def start_loggers(verbose=False, log_file=None, prompt=CONSOLE_PROMPT):
+    """Return (console, log) loggers; the log is the console unless log_file is given."""
+    if not log_file:
+        console = start_logger(verbose, prompt=prompt)
+        return console, console
+    return start_logger(prompt=prompt), start_logger(verbose, open(log_file, "a"), prompt=None)
 
-        self.print_callback()
+def stop_loggers(*loggers: Logger):
+    """Flush and stop the writers of the loggers, closing log files."""
+    for writer in {logger.writer for logger in loggers}:
+        writer.stop()
+        if writer.stream is not sys.stdout:
+            writer.stream.close()
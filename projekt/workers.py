@@ -0,0 +1,247 @@
+from multiprocessing.connection import Connection as Pipe, wait
+from typing import NamedTuple
+import itertools
+import multiprocessing
+import signal
+import threading
+import time
+import utils
+from metrics import Metrics
+
+WORKER_START_TIMEOUT = 60.0 # a worker may prefill its keypair pool before it listens
+WORKER_REQUEST_TIMEOUT = 10.0
+WORKER_EXIT_MARGIN = 2.0 # on top of the workers' own shutdown timeout
+
+
+class ConnectionSummary(NamedTuple):
+    """What `ls` shows of a connection served by a worker process."""
+    client_id: int
+    addr: tuple
+    frames_in: int
+    frames_out: int
+    bytes_in: int
+    bytes_out: int
+    channel_summary: list
+
+    @classmethod
+    def of(cls, connection):
+        return cls(connection.client_id, connection.addr, connection.frames_in,
+                   connection.frames_out, connection.bytes_in, connection.bytes_out,
+                   connection.channel_summary)
+
+
+# console commands a worker answers, by name
+WORKER_COMMANDS = {
+    "connections": lambda server: [ConnectionSummary.of(connection)
+                                   for connection in server.connection_handler.snapshot()],
+    "end": lambda server, client_id: server.connection_handler.close_connection(client_id),
+    "close_all": lambda server: server.connection_handler.close_all_connections(),
+    "metrics": lambda server: server.metrics.snapshot(),
+    # the worker's own copies are written or dropped within the wait
+    "broadcast": lambda server, text: server.connection_handler.broadcast(text).wait().totals(),
+}
+
+
+def run_worker(worker_id, workers, control: Pipe, options: dict):
+    """Entry point of a worker process: serve the port next to the other workers
+    and answer the supervisor's commands until it asks for shutdown or is gone."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C is the supervisor's to handle
+    from server import DiffieHellmanServer # server.py imports this module
+    server = DiffieHellmanServer(**options, workers=workers, worker_id=worker_id)
+    try:
+        server.serve()
+        control.send((None, "ready"))
+        while True:
+            try:
+                request_id, command, *args = control.recv()
+            except EOFError:
+                break
+            if command == "shutdown":
+                break
+            control.send((request_id, WORKER_COMMANDS[command](server, *args)))
+    finally:
+        server.stop()
+
+
+class WorkerProcess:
+    """The supervisor's end of one worker: its process and control pipe."""
+
+    def __init__(self, context, worker_id, workers, options):
+        self.worker_id = worker_id
+        self.control, child_control = multiprocessing.Pipe()
+        # not a daemon: a worker starts its own --handshake-workers processes
+        self.process = context.Process(target=run_worker, name=f"worker-{worker_id}",
+                                       args=(worker_id, workers, child_control, options))
+        self.process.start()
+        child_control.close()
+        self.lock = threading.Lock() # one request at a time, e.g. console and metrics scrape
+        self.request_ids = itertools.count()
+
+    def wait_until_ready(self):
+        if not self.control.poll(WORKER_START_TIMEOUT):
+            raise RuntimeError(f"worker {self.worker_id} did not start")
+        try:
+            self.control.recv()
+        except EOFError:
+            raise RuntimeError(f"worker {self.worker_id} exited while starting") from None
+
+    def send(self, command, *args):
+        """Send a request, return its id, None if the worker is gone."""
+        request_id = next(self.request_ids)
+        try:
+            self.control.send((request_id, command, *args))
+        except OSError:
+            return None
+        return request_id
+
+    def receive(self, request_id, deadline):
+        """The answer to a request, None if it does not come before the deadline."""
+        try:
+            while self.control.poll(max(deadline - time.monotonic(), 0)):
+                answered, result = self.control.recv()
+                if answered == request_id:
+                    return result
+                # the answer to an earlier request that timed out
+        except (OSError, EOFError):
+            pass
+        return None
+
+
+class WorkerPool(threading.Thread):
+    """Drop-in replacement for server.ConnectionsHandler whose connections are
+    served by worker processes.
+
+    Each worker binds the port with SO_REUSEPORT and runs its own
+    ConnectionsHandler or AsyncConnectionsHandler, so the kernel spreads new
+    connections between the processes and the encryption of different
+    clients runs on different cores. Worker w numbers its connections w,
+    w + N, w + 2N..., so `end` asks a single worker. Console commands are
+    forwarded over a pipe per worker. This thread restarts a worker that dies.
+    """
+
+    def __init__(self, workers, options: dict, log: utils.Logger,
+                 shutdown_timeout=utils.DEFAULT_SHUTDOWN_TIMEOUT):
+        super().__init__(daemon=True)
+        # spawn: forking a process that already runs threads is unsafe
+        self.context = multiprocessing.get_context("spawn")
+        self.size = workers
+        self.options = options
+        self.log = log.child("WorkerPool: ")
+        self.shutdown_timeout = shutdown_timeout
+        self.workers: list[WorkerProcess] = []
+        self.stop_event = threading.Event()
+        self.wakeup_reader, self.wakeup_writer = multiprocessing.Pipe(duplex=False)
+
+    def start(self):
+        """Start the workers and return once every one of them listens."""
+        self.workers = [WorkerProcess(self.context, worker_id, self.size, self.options)
+                        for worker_id in range(self.size)]
+        try:
+            for worker in self.workers:
+                worker.wait_until_ready()
+        except RuntimeError:
+            self.stop_workers()
+            raise
+        super().start()
+
+    def run(self):
+        """Restart workers that exit until stopped."""
+        while not self.stop_event.is_set():
+            sentinels = {worker.process.sentinel: worker for worker in self.workers}
+            for ready in wait([*sentinels, self.wakeup_reader]):
+                if self.stop_event.is_set() or ready is self.wakeup_reader:
+                    break
+                worker = sentinels[ready]
+                worker.process.join() # reap it
+                self.log.error("Worker {} exited with code {}, restarting it",
+                               worker.worker_id, worker.process.exitcode)
+                replacement = WorkerProcess(self.context, worker.worker_id, self.size,
+                                            self.options)
+                try:
+                    replacement.wait_until_ready()
+                except RuntimeError as e:
+                    self.log.error("{}", e)
+                self.workers[worker.worker_id] = replacement
+
+    def stop(self):
+        """Shut the workers down together, each closes its connections within
+        shutdown_timeout, and kill the ones still running after it."""
+        self.stop_event.set()
+        self.wakeup_writer.send(None)
+        if self.is_alive():
+            self.join()
+        self.stop_workers()
+
+    def stop_workers(self):
+        for worker in self.workers:
+            worker.send("shutdown")
+        deadline = time.monotonic() + self.shutdown_timeout + WORKER_EXIT_MARGIN
+        for worker in self.workers:
+            worker.process.join(max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                self.log.error("Worker {} did not exit in time, killing it", worker.worker_id)
+                worker.process.kill()
+                worker.process.join()
+
+    def ask_all(self, command, *args, timeout=WORKER_REQUEST_TIMEOUT):
+        """Ask every worker at once; the answers in worker order, None where a
+        worker is gone or busy for longer than the timeout."""
+        workers = list(self.workers)
+        for worker in workers:
+            worker.lock.acquire()
+        try:
+            request_ids = [worker.send(command, *args) for worker in workers]
+            deadline = time.monotonic() + timeout
+            return [worker.receive(request_id, deadline) if request_id is not None else None
+                    for worker, request_id in zip(workers, request_ids)]
+        finally:
+            for worker in workers:
+                worker.lock.release()
+
+    def snapshot(self) -> list[ConnectionSummary]:
+        """The connections of all workers, ordered by id."""
+        connections = []
+        for answer in self.ask_all("connections"):
+            connections += answer or []
+        return sorted(connections, key=lambda connection: connection.client_id)
+
+    @property
+    def connections(self):
+        return {connection.client_id: connection for connection in self.snapshot()}
+
+    def broadcast(self, text) -> utils.BroadcastReport:
+        """Send `text` to the clients of every worker, the report adds up theirs."""
+        report = utils.BroadcastReport()
+        for totals in self.ask_all("broadcast", text):
+            if totals is not None:
+                report.merge(totals)
+        return report
+
+    def close_all_connections(self):
+        self.log.info("Closing all connections")
+        self.ask_all("close_all", timeout=self.shutdown_timeout + WORKER_EXIT_MARGIN)
+
+    def close_connection(self, id):
+        """Close a specific connection by id, False if there is none."""
+        worker = self.workers[id % self.size]
+        with worker.lock:
+            request_id = worker.send("end", id)
+            if request_id is None:
+                return False
+            deadline = time.monotonic() + self.shutdown_timeout + WORKER_EXIT_MARGIN
+            return bool(worker.receive(request_id, deadline))
+
+
+class WorkerMetrics(Metrics):
+    """The supervisor's metrics, a snapshot adds up the snapshots of the workers."""
+
+    def __init__(self, pool: WorkerPool):
+        super().__init__()
+        self.pool = pool
+
+    def snapshot(self):
+        total = super().snapshot()
+        for shard in self.pool.ask_all("metrics"):
+            if shard is not None:
+                total.merge(shard)
+        return total